@@ -3,8 +3,13 @@
 from optparse import OptionParser
 import valon_synth
 from mts_api import MTSAPI
+from mts_link import read_link_cache
+from mts_regmap import MAX7301, MAX7301_CONF, MTSRegisterMap, REGMAP, load_register_map, max7301_ports
+from mts_telemetry import MTSSubscription, MTSTelemetry, MTSTelemetryStore, SHM
+from mts_usb import AUTO, discover
+from mts_worker import MTSWorker, serialised
 from valon_api import MTSvalon
-import numpy, string, time
+import numpy, os, string, sys, time
 
 import mts_config
 
@@ -18,7 +23,68 @@ def debug_cmd(addr, cmd):
 # verify cmd sent to match data read from register via port
 def verify_cmd(data,cmd):
   if DEBUG_COMM: print 'data = 0x%08x'% (data)
-  if ('0x%08x'%data) != ('0x%08x'%cmd): raise RuntimeError('Port read error:\nCmd sent 0x%08x not same as cmd read 0x%08x'%(cmd, data))
+  if data != cmd: raise RuntimeError('Port read error:\nCmd sent 0x%08x not same as cmd read 0x%08x'%(cmd, data))
+
+# read-back verification modes for register writes
+VERIFY_ALWAYS  = 'always'  # verify every write
+VERIFY_FINAL   = 'final'   # verify only the final write of each command sequence
+VERIFY_SAMPLED = 'sampled' # verify every N-th write
+VERIFY_OFF     = 'off'     # no read-back verification
+
+class MTSVerify:
+  """
+  Read-back verification policy applied to register writes, keeping count of verified and skipped writes and mismatches
+
+  @param mode   String: Verification mode, one of VERIFY_ALWAYS, VERIFY_FINAL, VERIFY_SAMPLED or VERIFY_OFF
+  @param sample Integer: Verify every sample-th write in VERIFY_SAMPLED mode
+  """
+  modes = [VERIFY_ALWAYS, VERIFY_FINAL, VERIFY_SAMPLED, VERIFY_OFF]
+
+  def __init__(self, mode=VERIFY_ALWAYS, sample=10):
+    if mode not in self.modes: raise RuntimeError('Unknown verification mode %s' % mode)
+    self.mode = mode
+    self.sample = sample
+    self.reset()
+
+  def reset(self):
+    """Reset verification counters"""
+    self.writes     = 0
+    self.verified   = 0
+    self.skipped    = 0
+    self.mismatches = 0
+
+  def select(self, final=False, mode=None):
+    """
+    Decide if a register write must be verified
+
+    @param final Boolean: Write is the final write of a command sequence
+    @param mode  String: [Optional] Verification mode overriding the policy mode for this write
+
+    @return Boolean: True if the data must be read back and verified
+    """
+    if mode is None: mode = self.mode
+    if mode not in self.modes: raise RuntimeError('Unknown verification mode %s' % mode)
+    self.writes += 1
+    if mode == VERIFY_ALWAYS: check = True
+    elif mode == VERIFY_FINAL: check = final
+    elif mode == VERIFY_SAMPLED: check = (self.writes % self.sample) == 0
+    else: check = False
+    if not check: self.skipped += 1
+    return check
+
+  def verify(self, data, cmd):
+    """
+    Verify data read back from a register matches the command written
+
+    @param data Integer: Data read from register
+    @param cmd  Integer: Command written to register
+    """
+    self.verified += 1
+    try:
+      verify_cmd(data, cmd)
+    except RuntimeError:
+      self.mismatches += 1
+      raise
 
 # construct lookup table from calibration measurements
 def read_calib_data(calib_file):
@@ -38,6 +104,14 @@ def read_calib_data(calib_file):
   fin.close()
   return [ucs_cal, cs_cal]
 
+def burst_stats(samples):
+  """
+  @param samples Array: Samples of a burst acquisition
+
+  @return Dictionary: The samples with their mean, standard deviation, minimum and maximum
+  """
+  return {'samples' : samples, 'mean' : samples.mean(), 'std' : samples.std(), 'min' : samples.min(), 'max' : samples.max()}
+
 class mts_mod(MTSvalon):
   device = {
       "ad7888" : {
@@ -75,6 +149,7 @@ class mts_mod(MTSvalon):
           "register" : 3,
           "cmd" : [ ],
           "set_mask" : 0x00000100,
+          "shift" : 0,
       },
 
       "cw" : {
@@ -96,6 +171,7 @@ class mts_mod(MTSvalon):
           "register" : 3,
           "cmd" : [ ],
           "set_mask" : 0x01000000,
+          "shift" : 16,
       },
 
       "lock" : {
@@ -113,36 +189,213 @@ class mts_mod(MTSvalon):
       }
   }
 
-  def __init__(self, mts_obj, module, valon=None, synth=None):
+  # Signal path switches, which block the signal path when set
+  PATH_SWITCHES = [ 'ns_switch', 'cw_switch' ]
+
+  # MAX7301 port registers read back for a warm start, ports 4-11 and 28-31, with the registers of the init sequence
+  WARM_REGS = [ 0x44, 0x5c ]
+
+  # AD7888 conversion step (V), and the control words selecting the temperature and power detector channels
+  ADC_VOLT = 610.351e-6
+  ADC_TEMP = 0x3000
+  ADC_PWR  = 0x800
+
+  # register map compiled from the built-in device and component tables, used if no register map is given
+  builtin_regmap = None
+
+  def __init__(self, mts_obj, module, valon=None, synth=None, verify=None, warm=False, regmap=None):
 
-    for dev in self.device.keys():
-      if VERBOSE: print "init", dev
-      # use reg_chanelsel register to identify device
-      addr = mts_obj.__get_address__(mod=module,reg=0)
-      cmd = self.device[dev]["channel"]
-      if DEBUG_CMD: debug_cmd(addr,cmd)
-      mts_obj.write(addr, cmd)
-      # verify data read back from register
-      verify_cmd(mts_obj.read(addr),cmd)
-
-      # use device write register (reg_ad7888_wr, reg_max7301_wr) to send init data
-      addr = mts_obj.__get_address__(mod=module,reg=self.device[dev]['register'])
-      for cmd in self.device[dev]["init"]:
-        set_cmd = self.device[dev]["set_mask"] | cmd
-        if DEBUG_CMD: debug_cmd(addr,set_cmd)
-        mts_obj.write(addr, set_cmd)
-        # verify data read back from register
-        verify_cmd(mts_obj.read(addr),set_cmd)
-        if DEBUG_CMD: debug_cmd(addr,cmd)
-        mts_obj.write(addr, cmd)
-        # verify data read back from register
-        verify_cmd(mts_obj.read(addr),cmd)
-      if DEBUG_CMD or DEBUG_COMM: print
     self.module = module
     self.mts = mts_obj
+    if regmap is None:
+      if mts_mod.builtin_regmap is None: mts_mod.builtin_regmap = MTSRegisterMap(mts_mod.device, mts_mod.component)
+      regmap = mts_mod.builtin_regmap
+    # validated tables of the register map and the frame sequences compiled for this module
+    self.device = regmap.device
+    self.component = regmap.component
+    self.map = regmap.module(module)
     self.synth = synth
     self.valon = valon
+    # read-back verification policy, may be shared between modules
+    if verify is None: verify = MTSVerify()
+    self.verify = verify
+    # shadow of the MAX7301 port levels, read back for a warm start and updated by apply
+    self.ports = {}
+    # module name and the telemetry sinks detector reads are passed to, assigned by MTS for combiners
+    self.name = None
+    self.sinks = []
+    self.warm = False
+    if warm:
+      self.warm = self.__warm__()
+      return
+    for dev in self.device.keys():
+      if VERBOSE: print "init", dev
+      # select device and strobe init data into the device write register (reg_ad7888_wr, reg_max7301_wr)
+      self.__send__(self.map.init[dev])
+
+  def __worker__(self):
+    return self.mts.worker
+
+  def __publish__(self, samples):
+    """
+    Pass detector reads to the telemetry sinks, see MTS.add_sink
+
+    @param samples List: (channel, value) pairs, channel 'power' or 'temperature'
+    """
+    if not self.sinks: return
+    now = time.time()
+    for sink in list(self.sinks):
+      for [channel, value] in samples: sink(self.name, channel, now, value)
+
+  def __warm__(self):
+    """
+    Read back the MAX7301 configuration and port levels to find if the module was initiated by a previous session.
+    Only the MAX7301 init commands whose register does not hold the init data are sent again,
+    and the port levels are kept of the port groups whose configuration matches the init sequence.
+    The other devices cannot be read back and their init sequences are always sent.
+
+    @return Boolean: True if the device configuration matches the init sequence
+    """
+    init = self.device[MAX7301]['init']
+    regs = [cmd >> 8 for cmd in init]
+    values = dict(zip(regs + self.WARM_REGS, self.max7301_read(regs + self.WARM_REGS)))
+    stale = [cmd for cmd in init if values[cmd >> 8] != (cmd & 0xFF)]
+    stale_regs = [cmd >> 8 for cmd in stale]
+    # port levels are valid for the port groups whose configuration register matches,
+    # unless the device was in shutdown, i.e. the configuration register 0x04 does not match
+    if 0x04 not in stale_regs:
+      for reg in self.WARM_REGS:
+        ports = max7301_ports(reg)
+        for bit in range(len(ports)):
+          conf = MAX7301_CONF[0]+ports[bit]//4-1
+          if conf in regs and conf not in stale_regs: self.ports[ports[bit]] = (values[reg] >> bit) & 0x1
+    for dev in self.device.keys():
+      if dev != MAX7301: self.__send__(self.map.init[dev])
+    if stale: self.__send__(self.map.__strobe__(self.device[MAX7301], stale))
+    return not stale
 
+  def __enabled__(self, comp, setting=1):
+    """
+    Check the port levels read back for a warm start
+
+    @param comp    Dictionary: Component description from the component table
+    @param setting Integer: Port level of the component state
+
+    @return Boolean: True if all component ports are at the setting
+    """
+    for cmd in comp['cmd']:
+      if self.ports.get(((cmd >> 8) & 0x7F) - 0x20) != setting: return False
+    return True
+
+  @serialised
+  def max7301_read(self, regs):
+    """
+    Read MAX7301 registers: a read command is strobed into the device write register for every register
+    and the data is read from the device read register, all in a single batched transaction
+
+    @param regs List: MAX7301 command register addresses, e.g. 0x04 for configuration, 0x27 for port 7 or 0x44 for ports 4-11
+
+    @return List: Register data
+    """
+    gpio = self.device['max7301']
+    batch = self.mts.batch()
+    # use reg_chanelsel register to identify device
+    batch.write(self.map.chansel, gpio["channel"])
+    wr_addr = self.map.write[gpio['register']]
+    rd_addr = self.map.read[gpio['register']]
+    reads = []
+    for reg in regs:
+      cmd = (0x80 | reg) << 8
+      batch.write(wr_addr, gpio["set_mask"] | cmd)
+      batch.write(wr_addr, cmd)
+      reads.append(batch.read(rd_addr))
+    data = batch.send()
+    return [data[idx] & 0xFF for idx in reads]
+
+  def __send__(self, cmds, verify=None):
+    """
+    Write a sequence of commands to module registers and verify the data read back from the registers,
+    using a single batched transaction
+
+    @param cmds   List: (address, command) pairs to write in sequence
+    @param verify String: [Optional] Verification mode for this sequence, default is the module verification policy
+    """
+    batch = self.mts.batch()
+    reads = []
+    for idx in range(len(cmds)):
+      [addr, cmd] = cmds[idx]
+      # writes that will not change the register content are skipped
+      if batch.write(addr, cmd) is None: continue
+      if DEBUG_CMD: debug_cmd(addr,cmd)
+      if self.verify.select(final=(idx == len(cmds)-1), mode=verify):
+        reads.append((batch.read(addr), cmd))
+    data = batch.send()
+    for [idx, cmd] in reads:
+      self.verify.verify(data[idx],cmd) # verify data read back from register
+    if DEBUG_CMD or DEBUG_COMM: print
+
+  @serialised
+  def apply(self, states, verbose=False, verify=None, force=False):
+    """
+    Set the state of several components in a single batched transaction.
+    Signal paths are blocked before, and opened after, the other components change, across all device channels.
+    Within each of these steps the component commands are grouped by device channel, starting with the channel
+    already selected, so that the channel select is only written when the channel changes.
+    The ports of MAX7301 components are folded into as few port writes as possible, see MTSModuleMap.gpio_frames,
+    separately for the switches blocking paths, the other components and the switches opening paths,
+    and ports the port shadow shows are already at the requested level are not written.
+
+    @param states  Dictionary: State per component name, e.g. {'ns' : True, 'ns_switch' : False, 'ns_atten' : 10.5},
+                               the port level of switched components or the attenuation (dB) of attenuators
+    @param verbose Boolean: Verbose output messages
+    @param verify  String: [Optional] Read-back verification mode for this call
+    @param force   Boolean: [Optional] Write all ports, even if the port shadow shows they are already set
+    """
+    groups = {}
+    # MAX7301 port levels by rank
+    ranked = [{}, {}, {}]
+    for [name, setting] in states.items():
+      if VERBOSE or verbose: print 'Set %s to' % name, setting
+      rank = 1
+      if name in self.PATH_SWITCHES: rank = [2, 0][bool(setting)]
+      if self.map.gpio.has_key(name):
+        for port in self.map.gpio[name]: ranked[rank][port] = int(bool(setting))
+        continue
+      if self.map.atten.has_key(name): frames = self.map.atten_frames(name, setting)
+      elif self.map.strobe.has_key(name): frames = self.map.strobe[name][bool(setting)]
+      else: raise RuntimeError('Unknown component %s' % name)
+      groups.setdefault((rank, self.component[name]['channel']), []).append((name, frames))
+    # ports written by a rank are known to the port writes of the next rank
+    known = dict(self.ports)
+    levels = {}
+    for rank in range(len(ranked)):
+      if not force and self.mts.trust_shadow:
+        ranked[rank] = dict([(port, level) for [port, level] in ranked[rank].items() if known.get(port) != level])
+      if not ranked[rank]: continue
+      groups.setdefault((rank, self.map.max7301['channel']), []).append((MAX7301, self.map.gpio_frames(ranked[rank], known)))
+      known.update(ranked[rank])
+      levels.update(ranked[rank])
+    # start every rank with the channel already selected
+    selected = self.mts.shadow.get(self.map.chansel)
+    cmds = []
+    for rank in range(len(ranked)):
+      channels = [channel for [group_rank, channel] in groups.keys() if group_rank == rank]
+      for channel in sorted(channels, key=lambda channel: (channel != selected, channel)):
+        # use reg_chanelsel register to identify device
+        if not cmds or channel != selected: cmds.append((self.map.chansel, channel))
+        selected = channel
+        for [name, frames] in sorted(groups[(rank, channel)]):
+          cmds.extend(frames[1:])
+    if not cmds: return
+    try:
+      self.__send__(cmds, verify=verify)
+    except Exception:
+      # port levels are unknown after a failed transaction
+      self.ports.clear()
+      raise
+    self.ports.update(levels)
+
+  @serialised
   def get_freq(self, verbose=False, timeout=-1):
     """
     Returns the current output frequency (MHz) of the CW signal.
@@ -162,6 +415,7 @@ class mts_mod(MTSvalon):
         raise RuntimeError('Cannot connect to Synthesizer: %s' % e)
     return synth_cw_freq
 
+  @serialised
   def set_freq(self, freq_mhz, verbose=False, timeout=-1):
     """
     Sets the frequency (MHz) of the CW signal
@@ -179,170 +433,82 @@ class mts_mod(MTSvalon):
     else:
       raise RuntimeError('No valon synth available for this module')
 
-  def cw_source(self, enable=False, verbose=False):
+  @serialised
+  def cw_source(self, enable=False, verbose=False, verify=None):
     """
     Enable Valon CW source
 
     @param enable  Boolean: True for on and False for off
     @param verbose Boolean: Verbose output messages
+    @param verify  String: [Optional] Read-back verification mode for this call
     """
     if VERBOSE or verbose: print 'Enable cw source', enable
-    cw = self.component['cw']
-    # use reg_chanelsel register to identify device
-    addr = self.mts.__get_address__(mod=self.module,reg=0)
-    cmd = cw["channel"]
-    if DEBUG_CMD: debug_cmd(addr,cmd)
-    self.mts.write(addr, cmd)
-    verify_cmd(self.mts.read(addr),cmd) # verify data read back from register
-    # use device write register (reg_max7301_wr) to send data
-    addr = self.mts.__get_address__(mod=self.module,reg=cw['register'])
-    for cmd in cw["cmd"]:
-        set_cmd = cw["set_mask"] | cmd
-        if DEBUG_CMD: debug_cmd(addr,(set_cmd | enable))
-        self.mts.write(addr, (set_cmd | enable))
-        verify_cmd(self.mts.read(addr),(set_cmd | enable)) # verify data read back from register
-        if DEBUG_CMD: debug_cmd(addr,(cmd | enable))
-        self.mts.write(addr, (cmd | enable))
-        verify_cmd(self.mts.read(addr),(cmd | enable)) # verify data read back from register
-    if DEBUG_CMD or DEBUG_COMM: print
+    self.apply({'cw' : enable}, verify=verify)
 
-  def noise_source(self, enable=False, verbose=False):
+  @serialised
+  def noise_source(self, enable=False, verbose=False, verify=None):
     """
     Enable noise source
 
     @param enable  Boolean: True for on and False for off
     @param verbose Boolean: Verbose output messages
+    @param verify  String: [Optional] Read-back verification mode for this call
     """
     if VERBOSE or verbose: print 'Enable noise source', `enable` 
-    ns = self.component['ns']
-    # use reg_chanelsel register to identify component
-    addr = self.mts.__get_address__(mod=self.module,reg=0)
-    cmd = ns["channel"]
-    if DEBUG_CMD: debug_cmd(addr,cmd)
-    self.mts.write(addr, cmd)
-    verify_cmd(self.mts.read(addr),cmd) # verify data read back from register
-    # use component write register (reg_max7301_wr) to send data
-    addr = self.mts.__get_address__(mod=self.module,reg=ns['register'])
-    for cmd in ns["cmd"]:
-        set_cmd = ns["set_mask"] | cmd
-        if DEBUG_CMD: debug_cmd(addr,(set_cmd | enable))
-        self.mts.write(addr, (set_cmd | enable))
-        verify_cmd(self.mts.read(addr),(set_cmd | enable)) # verify data read back from register
-        if DEBUG_CMD: debug_cmd(addr,(cmd | enable))
-        self.mts.write(addr, (cmd | enable))
-        verify_cmd(self.mts.read(addr),(cmd | enable)) # verify data read back from register
-    if DEBUG_CMD or DEBUG_COMM: print
+    self.apply({'ns' : enable}, verify=verify)
 
-  def power_temp_sensor(self, enable=False, verbose=False):
+  @serialised
+  def power_temp_sensor(self, enable=False, verbose=False, verify=None):
     """
     Enable output from power detector
 
     @param enable  Boolean: True for on and False for off
     @param verbose Boolean: Verbose output messages
+    @param verify  String: [Optional] Read-back verification mode for this call
     """
     if VERBOSE or verbose: print 'Enable power sensor', `enable` 
-    ns = self.component['pwr_switch']
-    # use reg_chanelsel register to identify component
-    addr = self.mts.__get_address__(mod=self.module,reg=0)
-    cmd = ns["channel"]
-    if DEBUG_CMD: debug_cmd(addr,cmd)
-    self.mts.write(addr, cmd)
-    verify_cmd(self.mts.read(addr),cmd) # verify data read back from register
-    # use component write register (reg_max7301_wr) to send data
-    addr = self.mts.__get_address__(mod=self.module,reg=ns['register'])
-    for cmd in ns["cmd"]:
-        set_cmd = ns["set_mask"] | cmd
-        if DEBUG_CMD: debug_cmd(addr,(set_cmd | enable))
-        self.mts.write(addr, (set_cmd | enable))
-        verify_cmd(self.mts.read(addr),(set_cmd | enable)) # verify data read back from register
-        if DEBUG_CMD: debug_cmd(addr,(cmd | enable))
-        self.mts.write(addr, (cmd | enable))
-        verify_cmd(self.mts.read(addr),(cmd | enable)) # verify data read back from register
-    if DEBUG_CMD or DEBUG_COMM: print
+    self.apply({'pwr_switch' : enable}, verify=verify)
 
-  def cw_output(self, enable=True, verbose=False):
+  @serialised
+  def cw_output(self, enable=True, verbose=False, verify=None):
     """
     Enable output by swithing on CW signal path
 
     @param enable  Boolean: True for on and False for off
     @param verbose Boolean: Verbose output messages
+    @param verify  String: [Optional] Read-back verification mode for this call
     """
     if VERBOSE or verbose: print 'Enable cw signal', enable
-    switch_setting = (not enable)
     # switch must be on (1) to prevent signal from flowing
-    cws = self.component['cw_switch']
-    # use reg_chanelsel register to identify device
-    addr = self.mts.__get_address__(mod=self.module,reg=0)
-    cmd = cws["channel"]
-    if DEBUG_CMD: debug_cmd(addr,cmd)
-    self.mts.write(addr, cmd)
-    verify_cmd(self.mts.read(addr),cmd) # verify data read back from register
-    # use device write register (reg_max7301_wr) to send data
-    addr = self.mts.__get_address__(mod=self.module,reg=cws['register'])
-    for cmd in cws["cmd"]:
-        set_cmd = cws["set_mask"] | cmd
-        if DEBUG_CMD: debug_cmd(addr,(set_cmd | switch_setting))
-        self.mts.write(addr, (set_cmd | switch_setting))
-        verify_cmd(self.mts.read(addr),(set_cmd | switch_setting)) # verify data read back from register
-        if DEBUG_CMD: debug_cmd(addr,(cmd | switch_setting))
-        self.mts.write(addr, (cmd | switch_setting))
-        verify_cmd(self.mts.read(addr),(cmd | switch_setting)) # verify data read back from register
-    if DEBUG_CMD or DEBUG_COMM: print
+    self.apply({'cw_switch' : not enable}, verify=verify)
 
-  def noise_output(self, enable=True, verbose=False):
+  @serialised
+  def noise_output(self, enable=True, verbose=False, verify=None):
     """
     Enable output by swithing on noise signal path
 
     @param enable  Boolean: True for on and False for off
     @param verbose Boolean: Verbose output messages
+    @param verify  String: [Optional] Read-back verification mode for this call
     """
     if VERBOSE or verbose: print 'Enable noise output', enable
-    switch_setting = (not enable)
-    nss = self.component['ns_switch']
-    # use reg_chanelsel register to identify device
-    addr = self.mts.__get_address__(mod=self.module,reg=0)
-    cmd = nss["channel"]
-    if DEBUG_CMD: debug_cmd(addr,cmd)
-    self.mts.write(addr, cmd)
-    verify_cmd(self.mts.read(addr),cmd) # verify data read back from register
-    # use device write register (reg_max7301_wr) to send data
-    addr = self.mts.__get_address__(mod=self.module,reg=nss['register'])
-    for cmd in nss["cmd"]:
-        set_cmd = nss["set_mask"] | cmd
-        if DEBUG_CMD: debug_cmd(addr,(set_cmd | switch_setting))
-        self.mts.write(addr, (set_cmd | switch_setting))
-        verify_cmd(self.mts.read(addr),(set_cmd | switch_setting)) # verify data read back from register
-        if DEBUG_CMD: debug_cmd(addr,(cmd | switch_setting))
-        self.mts.write(addr, (cmd | switch_setting))
-        verify_cmd(self.mts.read(addr),(cmd | switch_setting)) # verify data read back from register
-    if DEBUG_CMD or DEBUG_COMM: print
+    # switch must be on (1) to prevent signal from flowing
+    self.apply({'ns_switch' : not enable}, verify=verify)
 
-  def set_cw_atten(self, atten, verbose=False):
+  @serialised
+  def set_cw_atten(self, atten, verbose=False, verify=None):
     """
     Set attenuator in CW signal path
 
     @param atten   Float: Amount of attenuation (dB) to apply
     @param verbose Boolean: Verbose output messages
+    @param verify  String: [Optional] Read-back verification mode for this call
     """
     if VERBOSE or verbose: print 'Setting CW attenuation to ', atten, 'dB'
-    step = int(atten*2)
-    cwatten = self.component['cw_atten']
-    # use reg_chanelsel register to identify device
-    addr = self.mts.__get_address__(mod=self.module,reg=0)
-    cmd = cwatten["channel"]
-    if DEBUG_CMD: debug_cmd(addr,cmd)
-    self.mts.write(addr, cwatten["channel"])
-    verify_cmd(self.mts.read(addr),cmd) # verify data read back from register
-    # use device write register (reg_zx76_wr) to send data
-    addr = self.mts.__get_address__(mod=self.module,reg=cwatten['register'])
-    if DEBUG_CMD: debug_cmd(addr,(cwatten["set_mask"]+(step<<16)))
-    self.mts.write(addr, (cwatten["set_mask"]+(step<<16)))
-    verify_cmd(self.mts.read(addr),(cwatten["set_mask"]+(step<<16))) # verify data read back from register
-    if DEBUG_CMD: debug_cmd(addr,(step<<16))
-    self.mts.write(addr, (step<<16))
-    verify_cmd(self.mts.read(addr),(step<<16)) # verify data read back from register
-    if DEBUG_CMD or DEBUG_COMM: print
+    # select device and strobe the attenuator step into the device write register (reg_zx76_wr)
+    self.apply({'cw_atten' : atten}, verify=verify)
 
+  @serialised
   def get_cw_atten(self):
     """
     Get current attenuation of CW signal path
@@ -350,38 +516,26 @@ class mts_mod(MTSvalon):
     @return Float: Attenuation (dB)
     """
     cwatten = self.component['cw_atten']
-    addr = self.mts.__get_address__(mod=self.module,reg=cwatten['register'])
+    addr = self.map.write[cwatten['register']]
     if DEBUG_CMD: print "0x%04x" % (addr)
     data = self.mts.read(addr)
     if DEBUG_COMM: print 'data = 0x%08x'% (data)
     return float(data>>16)/2.
 
-  def set_noise_atten(self, atten, verbose=False):
+  @serialised
+  def set_noise_atten(self, atten, verbose=False, verify=None):
     """
     Set attenuator in noise signal path
 
     @param atten   Float: Amount of attenuation (dB) to apply
     @param verbose Boolean: Verbose output messages
+    @param verify  String: [Optional] Read-back verification mode for this call
     """
     if VERBOSE or verbose: print 'Setting noise attenuation to ', atten, 'dB'
-    step = int(atten*2)
-    nsatten = self.component['ns_atten']
-    # use reg_chanelsel register to identify device
-    addr = self.mts.__get_address__(mod=self.module,reg=0)
-    cmd = nsatten["channel"]
-    if DEBUG_CMD: debug_cmd(addr,cmd)
-    self.mts.write(addr, nsatten["channel"])
-    verify_cmd(self.mts.read(addr),cmd) # verify data read back from register
-    # use device write register (reg_zx76_wr) to send data
-    addr = self.mts.__get_address__(mod=self.module,reg=nsatten['register'])
-    if DEBUG_CMD: debug_cmd(addr,nsatten["set_mask"]+step)
-    self.mts.write(addr, (nsatten["set_mask"]+step))
-    verify_cmd(self.mts.read(addr),(nsatten["set_mask"]+step)) # verify data read back from register
-    if DEBUG_CMD: debug_cmd(addr,step)
-    self.mts.write(addr, (step))
-    verify_cmd(self.mts.read(addr),step) # verify data read back from register
-    if DEBUG_CMD or DEBUG_COMM: print
+    # select device and strobe the attenuator step into the device write register (reg_zx76_wr)
+    self.apply({'ns_atten' : atten}, verify=verify)
 
+  @serialised
   def get_noise_atten(self):
     """
     Get current attenuation of noise signal path
@@ -389,20 +543,23 @@ class mts_mod(MTSvalon):
     @return Float: Attenuation (dB)
     """
     nsatten = self.component['ns_atten']
-    addr = self.mts.__get_address__(mod=self.module,reg=nsatten['register'])
+    addr = self.map.write[nsatten['register']]
     if DEBUG_CMD: print "0x%04x" % (addr)
     data = self.mts.read(addr)
     if DEBUG_COMM: print 'data = 0x%08x'% (data)
     return float(data)/2.
 
-  def set_comb_atten(self, atten, verbose=False):
+  @serialised
+  def set_comb_atten(self, atten, verbose=False, verify=None):
     """
     Set attenuator of combiner module
 
     @param atten   Float: Amount of attenuation (dB) to apply
     @param verbose Boolean: Verbose output messages
+    @param verify  String: [Optional] Read-back verification mode for this call
     """
-    self.set_noise_atten(atten, verbose)
+    self.set_noise_atten(atten, verbose, verify=verify)
+  @serialised
   def get_comb_atten(self):
     """
     Get current attenuation of combiner module
@@ -411,127 +568,169 @@ class mts_mod(MTSvalon):
     """
     return self.get_noise_atten()
 
-  def select_valon(self, verbose=False):
+  @serialised
+  def select_valon(self, verbose=False, verify=None):
     """
     To set a CW signal the relevant module valon must be selected via the MTS controller
+
+    @param verbose Boolean: [Optional] Verbose output messages
+    @param verify  String: [Optional] Read-back verification mode for this call
     """
     if VERBOSE or verbose: print 'select valon for module ', self.module
     # use reg_chanelsel register of module 0 to identify valon index
-    addr = self.mts.__get_address__(mod=0,reg=0)
-    if DEBUG_CMD: print "0x%04x" % addr, "0x%08x" % self.module
-    self.mts.write(addr, self.module)
-    verify_cmd(self.mts.read(addr),self.module) # verify data read back from register
-    if DEBUG_CMD or DEBUG_COMM: print
+    self.__send__(self.map.select_valon, verify=verify)
 
-  def valon_lock(self, verbose=False):
+  @serialised
+  def valon_lock(self, verbose=False, verify=None):
     if VERBOSE or verbose: print 'Read valon lock detect'
-    valon_lock = self.component['lock']
-    # use reg_chanelsel register to identify device
-    addr = self.mts.__get_address__(mod=self.module,reg=0)
-    cmd = valon_lock["channel"]
-    if DEBUG_CMD: debug_cmd(addr,cmd)
-    self.mts.write(addr, valon_lock['channel'])
-    verify_cmd(self.mts.read(addr),cmd) # verify data read back from register
-    # use device write register (reg_max7301_wr) to send data
-    addr = self.mts.__get_address__(mod=self.module,reg=valon_lock['register'])
-    for cmd in valon_lock["cmd"]:
-        set_cmd = valon_lock["set_mask"] | cmd
-        if DEBUG_CMD: debug_cmd(addr,set_cmd)
-        self.mts.write(addr, set_cmd)
-        verify_cmd(self.mts.read(addr),set_cmd) # verify data read back from register
-        if DEBUG_CMD: debug_cmd(addr,cmd)
-        self.mts.write(addr, cmd)
-        verify_cmd(self.mts.read(addr),cmd) # verify data read back from register
+    self.apply({'lock' : 0}, verify=verify)
     if DEBUG_CMD: addr = self.mts.__get_address__(mod=self.module,reg=6); print hex(addr)
     if DEBUG_COMM: addr = self.mts.__get_address__(mod=self.module,reg=6); data = self.mts.read(addr); print 'data = 0x%08x'% (data)
     if DEBUG_CMD or DEBUG_COMM: print
 
-  def get_environment(self):
+  @serialised
+  def get_environment(self, samples=None):
     """
-    Read current temperature and power from power detector in combiner module
+    Read current temperature and power from power detector in combiner module.
+    A burst of samples conversions per channel is read back in the same single batched transaction,
+    the ADC converting the temperature and power channels alternately.
 
-    @return Float: Power (mV/dBm)
-    @return Float: Temperature (mV/deg)
+    @param samples Integer: [Optional] Number of conversions per channel for a burst acquisition
+
+    @return Float: Power (mV/dBm), or for a burst a dictionary with the 'samples' array and 'mean', 'std', 'min' and 'max'
+    @return Float: Temperature (mV/deg), or for a burst a dictionary as for power
     """
-    conv_factor = 610.351e-6 # V
+    conv_factor = self.ADC_VOLT # V
     adc = self.device['ad7888']
+    # all conversions are read back in a single batched transaction
+    batch = self.mts.batch()
     # use reg_chanelsel register to identify device
-    addr = self.mts.__get_address__(mod=self.module,reg=0)
+    addr = self.map.chansel
     if DEBUG_CMD: print hex(addr), "0x%08x" % adc["channel"]
-    self.mts.write(addr, adc["channel"])
+    batch.write(addr, adc["channel"])
+    if DEBUG_COMM: batch.read(addr)
     # use device write register (reg_ad7888_wr) to send data
-    if DEBUG_COMM: data = self.mts.read(addr); print 'data = 0x%08x'% (data)
-    addr = self.mts.__get_address__(mod=self.module,reg=adc['register'])
-    # toggle run bit
-    cmd = adc['init'][0]
-    set_cmd = adc["set_mask"] | cmd
-    if DEBUG_CMD: print hex(addr), "0x%08x" % set_cmd
-    self.mts.write(addr, set_cmd)
-    if DEBUG_COMM: data = self.mts.read(addr); print 'data = 0x%08x'% (data)
-    if DEBUG_CMD: print hex(addr), "0x%08x" % cmd
-    self.mts.write(addr, cmd)
-    if DEBUG_COMM: data = self.mts.read(addr); print 'data = 0x%08x'% (data)
-    # read init val
-    addr = self.mts.__get_address__(mod=self.module, reg=adc['register'], read=True)
-    if DEBUG_CMD: print "0x%04x" % (addr)
-    data = self.mts.read(addr)
-    if DEBUG_COMM: print 'data = 0x%08x'% (data)
-    # write to get temp
-    addr = self.mts.__get_address__(mod=self.module,reg=adc['register'])
-    cmd = adc['init'][1]
-    set_cmd = adc["set_mask"] | cmd
-    if DEBUG_CMD: print hex(addr), "0x%08x" % set_cmd
-    self.mts.write(addr, set_cmd)
-    if DEBUG_COMM: data = self.mts.read(addr); print 'data = 0x%08x'% (data)
-    if DEBUG_CMD: print hex(addr), "0x%08x" % cmd
-    self.mts.write(addr, cmd)
-    if DEBUG_COMM: data = self.mts.read(addr); print 'data = 0x%08x'% (data)
-    # read temp
-    addr = self.mts.__get_address__(mod=self.module, reg=adc['register'], read=True)
-    if DEBUG_CMD: print "0x%04x" % (addr)
-    data = self.mts.read(addr)
-    if DEBUG_COMM: print 'data = 0x%08x'% (data)
-    temp_mv_per_deg = float(data)*conv_factor
-    # write to get power
-    addr = self.mts.__get_address__(mod=self.module,reg=adc['register'])
-    cmd = adc['init'][1]
-    set_cmd = adc["set_mask"] | cmd
-    if DEBUG_CMD: print hex(addr), "0x%08x" % set_cmd
-    self.mts.write(addr, set_cmd)
-    if DEBUG_COMM: data = self.mts.read(addr); print 'data = 0x%08x'% (data)
-    if DEBUG_CMD: print hex(addr), "0x%08x" % cmd
-    self.mts.write(addr, cmd)
-    if DEBUG_COMM: data = self.mts.read(addr); print 'data = 0x%08x'% (data)
-    # read power
-    addr = self.mts.__get_address__(mod=self.module, reg=adc['register'], read=True)
-    if DEBUG_CMD: print "0x%04x" % (addr)
-    data = self.mts.read(addr)
-    if DEBUG_COMM: print 'data = 0x%08x'% (data)
-    pwr_mv_per_dbm = float(data)*conv_factor
+    wr_addr = self.map.write[adc['register']]
+    rd_addr = self.map.read[adc['register']]
+    # toggle run bit and read init val, then write to get temp and power,
+    # every transfer returns the conversion of the channel selected by the previous transfer
+    if samples is not None and samples < 1: raise RuntimeError('Cannot acquire %s samples' % samples)
+    burst = samples or 1
+    reads = []
+    for cmd in [adc['init'][0]] + [adc['init'][1], adc['init'][0]]*(burst-1) + [adc['init'][1], adc['init'][1]]:
+      set_cmd = adc["set_mask"] | cmd
+      if DEBUG_CMD: print hex(wr_addr), "0x%08x" % set_cmd
+      batch.write(wr_addr, set_cmd)
+      if DEBUG_COMM: batch.read(wr_addr)
+      if DEBUG_CMD: print hex(wr_addr), "0x%08x" % cmd
+      batch.write(wr_addr, cmd)
+      if DEBUG_COMM: batch.read(wr_addr)
+      if DEBUG_CMD: print "0x%04x" % (rd_addr)
+      reads.append(batch.read(rd_addr))
+    data = batch.send()
+    if DEBUG_COMM:
+      for value in data:
+        if value is not True: print 'data = 0x%08x'% (value)
     if DEBUG_CMD or DEBUG_COMM: print
-    return [pwr_mv_per_dbm, temp_mv_per_deg]
+    if samples is None:
+      temp_mv_per_deg = float(data[reads[1]])*conv_factor
+      pwr_mv_per_dbm = float(data[reads[2]])*conv_factor
+      self.__publish__([('power', pwr_mv_per_dbm), ('temperature', temp_mv_per_deg)])
+      return [pwr_mv_per_dbm, temp_mv_per_deg]
+    temp_mv_per_deg = numpy.array([data[idx] for idx in reads[1::2]], dtype=float)*conv_factor
+    pwr_mv_per_dbm = numpy.array([data[idx] for idx in reads[2::2]], dtype=float)*conv_factor
+    [pwr, temp] = [burst_stats(pwr_mv_per_dbm), burst_stats(temp_mv_per_deg)]
+    self.__publish__([('power', pwr['mean']), ('temperature', temp['mean'])])
+    return [pwr, temp]
+
+  @serialised
+  def get_power(self):
+    """
+    Read the power detector of a combiner module
+
+    @return Float: Power (mV/dBm)
+    """
+    pwr_mv_per_dbm = self.__adc_read__(self.ADC_PWR)
+    self.__publish__([('power', pwr_mv_per_dbm)])
+    return pwr_mv_per_dbm
+
+  @serialised
+  def get_temperature(self):
+    """
+    Read the temperature sensor of a combiner module
+
+    @return Float: Temperature (mV/deg)
+    """
+    temp_mv_per_deg = self.__adc_read__(self.ADC_TEMP)
+    self.__publish__([('temperature', temp_mv_per_deg)])
+    return temp_mv_per_deg
+
+  def __adc_read__(self, cmd):
+    """
+    Convert a single ADC channel in a single batched transaction.
+    Every AD7888 transfer returns the conversion of the channel selected by the previous transfer,
+    the controller shadow of the device write register holds the control word of the previous transfer,
+    so the channel is only selected with an extra transfer if the ADC has a different configuration.
+
+    @param cmd Integer: AD7888 control word selecting the channel
+
+    @return Float: Conversion (mV)
+    """
+    adc = self.device['ad7888']
+    wr_addr = self.map.write[adc['register']]
+    rd_addr = self.map.read[adc['register']]
+    cmds = [cmd]
+    if not self.mts.trust_shadow or self.mts.shadow.get(wr_addr) != cmd: cmds = [cmd, cmd]
+    batch = self.mts.batch()
+    # use reg_chanelsel register to identify device
+    batch.write(self.map.chansel, adc["channel"])
+    for cmd in cmds:
+      if DEBUG_CMD: print hex(wr_addr), "0x%08x" % (adc["set_mask"] | cmd)
+      batch.write(wr_addr, adc["set_mask"] | cmd)
+      batch.write(wr_addr, cmd)
+    read = batch.read(rd_addr)
+    data = batch.send()
+    if DEBUG_COMM: print 'data = 0x%08x'% (data[read])
+    return float(data[read])*self.ADC_VOLT
 
 
 class MTS(MTSAPI):
   """
   Initializing a MTS object will create an interface to the various modules and available devices.
   All available modules will be initiated, all sources enables and all signal path outputs disabled, ready for usage.
+  With lazy=True modules are initiated on first use instead.
   All implementation constants will be assigned.
 
-  @param port  String: Series port associated with MTS controller
-  @param baudrate Integer: Baudrate of MTS controller series connection
-  @param valon String: Series port associated with Valon controller
+  @param port  String: Series port associated with MTS controller, 'auto' finds the port by USB id, see mts_usb.discover
+  @param baudrate Integer: Baudrate of MTS controller series connection, default is the baudrate remembered for the port or BAUDRATE
+  @param valon String: Series port associated with Valon controller, 'auto' finds the port by USB id
   @param synth Integer: Synthesizer to connect to from ValonSynth interface
   @param timeout Integer: Time for waiting on response from Series ports
   @param config_file String: Name of file containing MTS setup and usage parameters
+  @param calib_dir String: Directory containing the noise and CW calibration tables
+  @param write_behind Boolean: Do not wait for controller acknowledgement of register writes, errors are raised at the next read or flush
+  @param trust_shadow Boolean: Skip channel select writes when the controller shadow shows the channel is already selected
+  @param capture String: Name of capture file to record all controller transactions
+  @param verify String: Read-back verification mode for register writes: 'always', 'final', 'sampled' or 'off'
+  @param sample Integer: Verify every sample-th register write when verify mode is 'sampled'
+  @param retries Integer: Number of times a controller transaction is repeated after resynchronising a broken link
+  @param threaded Boolean: Execute all operations on a worker thread, so that multiple threads can share the MTS, see start_worker
+  @param warm Boolean: Read back the module states and keep the state of modules initiated by a previous session,
+                       only enabling sources that are off, instead of initiating all modules
+  @param regmap_file String: Register map file of the module devices and components, the built-in tables are used if the file does not exist
+  @param lazy Boolean: Initiate modules on first access, e.g. mts.comb1 or mts.select_combiner('comb1') initiates comb1 and its sources,
+                       instead of initiating all available modules, see prefetch.
+                       exit only switches off the sources initiated during the session
+  @param adaptive Boolean: Derive controller response deadlines from the observed round trip times, with timeout as the maximum
 
   """
-  PORT     = '/dev/ttyUSB0'
+  PORT     = AUTO
   BAUDRATE = 115200
-  VALON    = '/dev/ttyUSB1'
+  VALON    = AUTO
   # this is a hardwired setup inside the MTS, so it will not be available for users to select SYNTH_A through this interface
   SYNTH    = valon_synth.SYNTH_B
   CONFIG   = '/etc/mts/mts_default'
+  CALIB    = '/etc/mts'
 
   src_dict = {
     'ucs1' : { 'module' : 1 , 'available' : True },
@@ -542,103 +741,286 @@ class MTS(MTSAPI):
     'comb1': { 'module' : 4 , 'available' : True},
     'comb2': { 'module' : 5 , 'available' : True}
   }
+  # background telemetry poller, see start_telemetry, and shared telemetry store, see publish_telemetry
+  telemetry = None
+  store = None
 
   # Initialize MTS comms ports for control and valon settings
-  def __init__(self, port=PORT, baudrate=BAUDRATE, valon=VALON, synth=SYNTH, timeout=1, config_file=CONFIG):
+  def __init__(self, port=PORT, baudrate=None, valon=VALON, synth=SYNTH, timeout=1, config_file=CONFIG, calib_dir=CALIB, write_behind=False, trust_shadow=True, capture=None, verify=VERIFY_ALWAYS, sample=10, retries=MTSAPI.RETRIES, threaded=False, warm=False, lazy=False, regmap_file=REGMAP, adaptive=True):
+    # Find the USB serial ports of the controller and valon
+    auto = [device for [device, name] in [('controller', port), ('valon', valon)] if name == AUTO]
+    if auto:
+      found = discover(auto)
+      if port == AUTO:
+        if not found.has_key('controller'): raise RuntimeError('Cannot find MTS controller on any USB serial port')
+        port = found['controller']
+      if valon == AUTO:
+        valon = found.get('valon')
+        if not valon: print 'No valon synthesizer found, CW frequency control not available'
+      print 'MTS controller on %s, valon on %s' % (port, valon)
     # Set up serial comms to mts controller
-    self.ctrl = MTSAPI(port, baudrate)
+    cached = None
+    if baudrate is None and isinstance(port, basestring):
+      # start at the baudrate found by MTSAPI.probe_baudrate
+      cached = read_link_cache(port).get('baudrate')
+    self.ctrl = MTSAPI(port, cached or baudrate or self.BAUDRATE, timeout=timeout, write_behind=write_behind, trust_shadow=trust_shadow, capture=capture, retries=retries, adaptive=adaptive)
     try:
-      self.ctrl.ping()
+      try:
+        self.ctrl.ping()
+      except Exception:
+        if not cached or cached == self.BAUDRATE: raise
+        # firmware changed since the baudrate was probed
+        self.ctrl.port.baudrate = self.BAUDRATE
+        self.ctrl.port.flushInput()
+        self.ctrl.ping()
     except Exception as e:
       # Closing before exit
       self.ctrl.__close__()
       raise RuntimeError('Cannot ping controller: Error received\n%s' % (e))
       sys.exit(1)
 
+    # read-back verification policy shared by all modules
+    self.verify = MTSVerify(mode=verify, sample=sample)
+    # telemetry sinks shared by all combiner modules
+    self.sinks = []
+    # register map shared by all modules
+    self.regmap = load_register_map(regmap_file, device=mts_mod.device, component=mts_mod.component)
+
     # Get setup parameters
     self.config=mts_config.conf(config_file)
     self.MIN_BASE = self.config.get_float('kat7','min_base_freq_mhz')
     self.MAX_BASE = self.config.get_float('kat7','max_base_freq_mhz')
     # read calibration data for output signals
-    [self.UCS_NOISE, self.CS_NOISE] = read_calib_data('/etc/mts/noise_calib_table.data')
-    [self.UCS_CW, self.CS_CW] = read_calib_data('/etc/mts/cw_calib_table.data')
-
-    # a for loop is used to prevent duplication of code:
-    #   # uncorrelated source 1
-    #   self.ucs1 = mts_mod(self.ctrl, self.module['ucs1'])
-    #   # switch on all components in signal path, but leave the switch open
-    #   self.ucs1.noise_source(enable=True)
-    #   self.ucs1.noise_output(enable=True)
-    #   # uncorrelated source 2
-    #   self.ucs2 = mts_mod(self.ctrl, self.module['ucs2'])
-    #   self.ucs2.noise_source(enable=True)
-    #   self.ucs2.noise_output(enable=True)
-    for key in self.src_dict.keys():
-        print 'Initiating %s, module %d'%(key, self.src_dict[key]['module'])
-        obj = mts_mod(self.ctrl, self.src_dict[key]['module'], valon=valon, synth=synth)
-        # assign the object to self from the key name:
-        #  e.g. create object self.ucs1 from the key='ucs1'
-        self.__dict__[key] = obj
-        # if 'available' is true, the assigned object attribute will be switched on or off
-        if self.src_dict[key]['available']:
-            # switch off signal paths
-            obj.noise_output(enable=False)
-            obj.cw_output(enable=False)
-            # switch on signal sources
-            obj.noise_source(enable=True)
-            obj.cw_source(enable=True)
-            # set attenuator to max attenuation
-            max_atten = self.config.get_float(key, 'max_atten')
-            obj.set_noise_atten(atten=max_atten) # dB
-            obj.set_cw_atten(atten=max_atten) # dB
-            # set config values
-            obj.MIN_ATTEN = self.config.get_float(key,'min_atten')
-            obj.MAX_ATTEN = self.config.get_float(key,'max_atten')
-            obj.MIN_NOISE = self.config.get_float(key,'min_noise_freq_mhz')
-            obj.MAX_NOISE = self.config.get_float(key,'max_noise_freq_mhz')
-            obj.MIN_CW = self.config.get_float(key,'min_cw_freq_mhz')
-            obj.MAX_CW = self.config.get_float(key,'max_cw_freq_mhz')
-
-    for key in self.cmb_dict.keys():
-        print 'Initiating %s, module %d'%(key, self.cmb_dict[key]['module'])
-        obj = mts_mod(self.ctrl, self.cmb_dict[key]['module'])
-        # assign the object to self from the key name:
-        self.__dict__[key] = obj
-        # if 'available' is true, the assigned object attribute will be switched on or off
-        if self.cmb_dict[key]['available']:
-            obj.power_temp_sensor(enable=True)
-            min_atten = self.config.get_float(key, 'min_atten')
-            obj.set_comb_atten(atten=min_atten) # dB
-            # set config values
-            obj.MIN_ATTEN = self.config.get_float(key,'min_atten')
-            obj.MAX_ATTEN = self.config.get_float(key,'max_atten')
-            obj.MIN_NOISE = self.config.get_float(key,'min_noise_freq_mhz')
-            obj.MAX_NOISE = self.config.get_float(key,'max_noise_freq_mhz')
-            obj.MIN_CW = self.config.get_float(key,'min_cw_freq_mhz')
-            obj.MAX_CW = self.config.get_float(key,'max_cw_freq_mhz')
-            # assign associated source modules
-            uncorr_src = self.config.get_str(key, 'ucs')
-            if self.src_dict.has_key(uncorr_src): obj.ucs = self.__dict__[uncorr_src]
-            corr_src = self.config.get_str(key, 'cs')
-            if self.src_dict.has_key(corr_src): obj.cs = self.__dict__[corr_src]
+    [self.UCS_NOISE, self.CS_NOISE] = read_calib_data(os.path.join(calib_dir, 'noise_calib_table.data'))
+    [self.UCS_CW, self.CS_CW] = read_calib_data(os.path.join(calib_dir, 'cw_calib_table.data'))
+
+    # modules are initiated here, or on first access if lazy, see __getattr__ and prefetch
+    self.valon = valon
+    self.synth = synth
+    self.warm  = warm
+    if threaded: self.start_worker()
+    if not lazy: self.prefetch()
+
+  def __getattr__(self, name):
+    # only called for attributes not found, i.e. modules not initiated yet
+    # special names, e.g. looked up by copy and pickle, are never modules, and a module cannot be initiated
+    # without the controller, e.g. when __init__ failed, so neither touches instance attributes that may be missing
+    if name.startswith('__') or not self.__dict__.has_key('ctrl'): raise AttributeError(name)
+    if self.__class__.src_dict.has_key(name) or self.__class__.cmb_dict.has_key(name):
+      return self.__init_module__(name)
+    raise AttributeError(name)
+
+  def prefetch(self):
+    """
+    Initiate all modules not initiated yet, instead of on first access
+    """
+    for key in self.src_dict.keys() + self.cmb_dict.keys():
+      getattr(self, key)
+
+  @serialised
+  def __init_module__(self, key):
+    # another thread may have initiated the module while this call was queued
+    if not self.__dict__.has_key(key):
+      if self.src_dict.has_key(key): self.__init_source__(key)
+      else: self.__init_combiner__(key)
+    return self.__dict__[key]
+
+  def __init_source__(self, key):
+    print 'Initiating %s, module %d'%(key, self.src_dict[key]['module'])
+    obj = mts_mod(self.ctrl, self.src_dict[key]['module'], valon=self.valon, synth=self.synth, verify=self.verify, warm=self.warm, regmap=self.regmap)
+    # assign the object to self from the key name:
+    #  e.g. create object self.ucs1 from the key='ucs1'
+    self.__dict__[key] = obj
+    # keep signal paths and attenuators set by the previous session
+    if self.src_dict[key]['available'] and obj.warm:
+      obj.apply(dict([(comp, True) for comp in ['ns', 'cw'] if not obj.__enabled__(obj.component[comp])]))
+    # if 'available' is true, the assigned object attribute will be switched on or off
+    elif self.src_dict[key]['available']:
+      # switch off signal paths, switch on signal sources and set attenuators to max attenuation
+      max_atten = self.config.get_float(key, 'max_atten')
+      obj.apply({'ns_switch' : True, 'cw_switch' : True, 'ns' : True, 'cw' : True, 'ns_atten' : max_atten, 'cw_atten' : max_atten})
+    if self.src_dict[key]['available']:
+      # set config values
+      obj.MIN_ATTEN = self.config.get_float(key,'min_atten')
+      obj.MAX_ATTEN = self.config.get_float(key,'max_atten')
+      obj.MIN_NOISE = self.config.get_float(key,'min_noise_freq_mhz')
+      obj.MAX_NOISE = self.config.get_float(key,'max_noise_freq_mhz')
+      obj.MIN_CW = self.config.get_float(key,'min_cw_freq_mhz')
+      obj.MAX_CW = self.config.get_float(key,'max_cw_freq_mhz')
+
+  def __init_combiner__(self, key):
+    print 'Initiating %s, module %d'%(key, self.cmb_dict[key]['module'])
+    obj = mts_mod(self.ctrl, self.cmb_dict[key]['module'], verify=self.verify, warm=self.warm, regmap=self.regmap)
+    obj.name = key
+    obj.sinks = self.sinks
+    # assign the object to self from the key name:
+    self.__dict__[key] = obj
+    # keep the attenuator set by the previous session
+    if self.cmb_dict[key]['available'] and obj.warm:
+      if not obj.__enabled__(obj.component['pwr_switch']): obj.power_temp_sensor(enable=True)
+    # if 'available' is true, the assigned object attribute will be switched on or off
+    elif self.cmb_dict[key]['available']:
+      obj.power_temp_sensor(enable=True)
+      min_atten = self.config.get_float(key, 'min_atten')
+      obj.set_comb_atten(atten=min_atten) # dB
+    if self.cmb_dict[key]['available']:
+      # set config values
+      obj.MIN_ATTEN = self.config.get_float(key,'min_atten')
+      obj.MAX_ATTEN = self.config.get_float(key,'max_atten')
+      obj.MIN_NOISE = self.config.get_float(key,'min_noise_freq_mhz')
+      obj.MAX_NOISE = self.config.get_float(key,'max_noise_freq_mhz')
+      obj.MIN_CW = self.config.get_float(key,'min_cw_freq_mhz')
+      obj.MAX_CW = self.config.get_float(key,'max_cw_freq_mhz')
+      # assign associated source modules, initiating them if needed
+      uncorr_src = self.config.get_str(key, 'ucs')
+      if self.src_dict.has_key(uncorr_src): obj.ucs = getattr(self, uncorr_src)
+      corr_src = self.config.get_str(key, 'cs')
+      if self.src_dict.has_key(corr_src): obj.cs = getattr(self, corr_src)
+
+  def __worker__(self):
+    return self.ctrl.worker
+
+  def start_worker(self):
+    """
+    Start a worker thread that owns the controller link.
+    MTS and module operations called from any thread are queued and executed one at a time on the worker,
+    so that the register sequences of concurrent operations do not interleave.
+    """
+    if self.ctrl.worker: return
+    self.ctrl.worker = MTSWorker()
+    self.ctrl.worker.start()
+
+  def stop_worker(self):
+    """Complete queued operations, stop the worker thread and return to executing operations in the calling thread"""
+    worker = self.ctrl.worker
+    if not worker: return
+    worker.stop()
+    self.ctrl.worker = None
+
+  def submit(self, func, *args, **kwargs):
+    """
+    Execute an operation on the worker thread without waiting for it to complete
+
+    @param func   Function: Operation to execute, e.g. mts.set_noise or mts.comb1.get_environment
+    @param args   List: Positional arguments of the operation
+    @param kwargs Dictionary: Keyword arguments of the operation
+
+    @return Object: MTSFuture, whose result method waits for and returns the result of the operation
+    """
+    self.start_worker()
+    return self.ctrl.worker.submit(func, *args, **kwargs)
+
+  def start_telemetry(self, combiners=None, rate=1., size=3600):
+    """
+    Start polling the combiner power detectors and temperature sensors in the background.
+    The worker thread is started, so that the polls and foreground operations do not interleave.
+
+    @param combiners List: [Optional] Combiner modules to poll, default is all combiners
+    @param rate      Float: [Optional] Number of polls per second
+    @param size      Integer: [Optional] Number of samples kept per channel
+
+    @return Object: MTSTelemetry, with latest, last and stats queries of the samples
+    """
+    self.stop_telemetry()
+    self.start_worker()
+    self.telemetry = MTSTelemetry(self, combiners=combiners, rate=rate, size=size)
+    self.telemetry.start()
+    return self.telemetry
+
+  def stop_telemetry(self):
+    """Stop the background telemetry poller, the samples remain available"""
+    if self.telemetry: self.telemetry.stop()
+
+  def add_sink(self, sink):
+    """
+    Pass every combiner detector read to a telemetry sink, called on the thread executing the read
+
+    @param sink Function: Called as sink(comb, channel, timestamp, value), channel 'power' (mV/dBm) or 'temperature' (mV/deg)
+    """
+    if sink not in self.sinks: self.sinks.append(sink)
+
+  def remove_sink(self, sink):
+    """
+    @param sink Function: Telemetry sink added with add_sink
+    """
+    if sink in self.sinks: self.sinks.remove(sink)
+
+  def subscribe(self, comb, channel='power', above=None, below=None, hysteresis=0., rate=None, callback=None, queue=None):
+    """
+    Notify a subscriber when the power or temperature of a combiner crosses a threshold or changes too fast,
+    see mts_telemetry.MTSSubscription for the conditions and events.
+    Conditions are evaluated on every detector read, the telemetry poller is started if it is not running,
+    so that all subscribers share the same polls of the controller.
+
+    @param comb       String: Combiner module, e.g. 'comb1'
+    @param channel    String: [Optional] 'power' (mV/dBm) or 'temperature' (mV/deg)
+    @param above      Float: [Optional] Trigger when the value rises above this threshold
+    @param below      Float: [Optional] Trigger when the value falls below this threshold
+    @param hysteresis Float: [Optional] Distance past a threshold the value must return before the condition is armed again
+    @param rate       Float: [Optional] Trigger when the value changes faster than this rate (per second)
+    @param callback   Function: [Optional] Called as callback(event) on the worker thread, it must not block
+    @param queue      Object: [Optional] Queue the events are put on, a new Queue if no callback is given
+
+    @return Object: MTSSubscription, wait for events with its get method
+    """
+    if not self.cmb_dict.has_key(comb): raise RuntimeError('Unknown combiner %s' % comb)
+    subscription = MTSSubscription(comb, channel, above=above, below=below, hysteresis=hysteresis, rate=rate, callback=callback, queue=queue)
+    self.add_sink(subscription)
+    if not (self.telemetry and self.telemetry.isAlive()): self.start_telemetry()
+    return subscription
+
+  def unsubscribe(self, subscription):
+    """
+    @param subscription Object: MTSSubscription returned by subscribe
+    """
+    self.remove_sink(subscription)
+
+  def publish_telemetry(self, path=SHM, size=3600):
+    """
+    Publish every combiner detector read to a memory-mapped file, where other local processes read the samples
+    with mts_telemetry.MTSTelemetryReader without access to the controller.
+    Start a telemetry poller, see start_telemetry, to publish at a fixed rate.
+
+    @param path String: [Optional] Shared telemetry file
+    @param size Integer: [Optional] Number of samples kept per channel
+
+    @return Object: MTSTelemetryStore
+    """
+    self.unpublish_telemetry()
+    self.store = MTSTelemetryStore(path, combiners=sorted(self.cmb_dict.keys()), size=size)
+    self.add_sink(self.store.publish)
+    return self.store
+
+  def unpublish_telemetry(self):
+    """Stop publishing detector reads, the shared telemetry file keeps the samples published"""
+    if not self.store: return
+    self.remove_sink(self.store.publish)
+    self.store.close()
+    self.store = None
 
   def exit(self):
     """
     Exiting the MTS interface will return all device states in the MTS to most optimal.
     This includes disabling all module sources and setting the output signal switches to lowest power
    """
+    try:
+      self.stop_telemetry()
+      self.unpublish_telemetry()
+      self.__shutdown__()
+    finally:
+      self.stop_worker()
+      # Closing before exit
+      self.ctrl.__close__()
+
+  @serialised
+  def __shutdown__(self):
     # switch off all components in signal path, but leave the switch closed for min power consumption
+    # modules never initiated during a lazy session are not changed
     for key in self.src_dict.keys():
-      if self.src_dict[key]['available']:
+      if self.src_dict[key]['available'] and self.__dict__.has_key(key):
         obj = self.__dict__[key]
-        # switch off signal sources
-        obj.noise_source(enable=False)
-        obj.cw_source(enable=False)
-        # switch on signal paths
-        obj.noise_output(enable=True)
-        obj.cw_output(enable=True)
-    # Closing before exit
-    self.ctrl.__close__()
+        # switch off signal sources and switch on signal paths
+        obj.apply({'ns' : False, 'cw' : False, 'ns_switch' : False, 'cw_switch' : False})
 
   def select_combiner(self, comb, verbose=False):
     """
@@ -649,9 +1031,9 @@ class MTS(MTSAPI):
 
     @return        Object: Combiner object from MTS
     """
-    if self.__dict__.has_key(comb):
-      # identify object
-      return self.__dict__[comb]
+    if self.cmb_dict.has_key(comb):
+      # identify object, initiating it on first use
+      return getattr(self, comb)
     else: raise RuntimeError('Output module %s not available' % comb)
 
 
@@ -706,10 +1088,11 @@ class MTS(MTSAPI):
    """
     if not cal_tbl: cal_tbl = self.UCS_NOISE
     cal_tbl = numpy.array(cal_tbl)
-    if not sensor: sensor = comb.get_environment()[0]
+    if not sensor: sensor = comb.get_power()
     amp_idx = numpy.argmin(abs(sensor - cal_tbl[:,1]))
     return cal_tbl[amp_idx,2]
 
+  @serialised
   def set_noise(self, output, uncorr_pwr=None, corr_pwr=None):
     """
     Enable either or both the uncorrelated and correlated noise signals of a selected combiner output.
@@ -723,14 +1106,14 @@ class MTS(MTSAPI):
     # convert power to attenuation and enable signal output
     def enable_noise(comb, src, pwr, cal_tbl):
       self.__set_pwr__(comb, src, pwr, cal_tbl=cal_tbl, signal='noise')
-      src.noise_source(enable=True)
-      src.noise_output(enable=True)
+      src.apply({'ns' : True, 'ns_switch' : False})
     combiner = self.select_combiner(comb=output)
     if uncorr_pwr:
       enable_noise(comb=combiner, src=combiner.ucs, pwr=uncorr_pwr, cal_tbl=self.UCS_NOISE)
     if corr_pwr:
       enable_noise(comb=combiner, src=combiner.cs, pwr=corr_pwr, cal_tbl=self.CS_NOISE)
 
+  @serialised
   def get_noise(self, output, cal_tbl=None):
     """
     Read the noise power measured at a selected output combiner module.
@@ -743,6 +1126,7 @@ class MTS(MTSAPI):
     if not cal_tbl: cal_tbl=self.UCS_NOISE
     return self.__get_pwr__(comb=self.select_combiner(comb=output), cal_tbl=cal_tbl)
 
+  @serialised
   def disable_noise(self, output, uncorr_src=False, corr_src=False):
     """
     Disable either or both the uncorrelated and correlated noise signals of a selected combiner output.
@@ -759,6 +1143,7 @@ class MTS(MTSAPI):
     if corr_src:
       combiner.cs.noise_output(enable=False)
 
+  @serialised
   def set_cw(self, output, uncorr_pwr=None, uncorr_freq=None, corr_pwr=None, corr_freq=None):
     """
     Enable either or both the uncorrelated and correlated CW signals of a selected combiner output.
@@ -774,8 +1159,7 @@ class MTS(MTSAPI):
     # convert power to attenuation, set CW frequency and enable signal output
     def enable_cw(comb, src, pwr, cal_tbl):
       self.__set_pwr__(comb, src, pwr, cal_tbl=cal_tbl, signal='cw')
-      src.cw_source(enable=True)
-      src.cw_output(enable=True)
+      src.apply({'cw' : True, 'cw_switch' : False})
     combiner = self.select_combiner(comb=output)
     if uncorr_pwr:
       enable_cw(comb=combiner, src=combiner.ucs, pwr=uncorr_pwr, cal_tbl=self.UCS_CW)
@@ -788,6 +1172,7 @@ class MTS(MTSAPI):
         combiner.cs.set_freq(freq_mhz=corr_freq)
         if abs(combiner.cs.get_freq()-corr_freq)>0: raise RuntimeError('Could not set requested frequency %f MHz' % freq_mhz)
 
+  @serialised
   def get_cw(self, output, cal_tbl=None):
     """
     Read the CW power measured at a selected output combiner module.
@@ -800,6 +1185,7 @@ class MTS(MTSAPI):
     if not cal_tbl: cal_tbl=self.UCS_CW
     return self.__get_pwr__(comb=self.select_combiner(comb=output), cal_tbl=cal_tbl)
 
+  @serialised
   def disable_cw(self, output, uncorr_src=False, corr_src=False):
     """
     Disable either or both the uncorrelated and correlated CW signals of a selected combiner output.
@@ -816,6 +1202,7 @@ class MTS(MTSAPI):
     if corr_src:
       combiner.cs.cw_output(enable=False)
 
+  @serialised
   def get_freq(self, output, uncorr_src=False, corr_src=False):
     """
     Read the CW frequency of the selected source at the requested combiner output.
@@ -830,6 +1217,7 @@ class MTS(MTSAPI):
     if uncorr_src: return combiner.ucs.get_freq()
     if corr_src: return combiner.cs.get_freq()
 
+  @serialised
   def set_freq(self, output, uncorr_freq=None, corr_freq=None):
     """
     Set the CW frequency of the selected source at the requested combiner output.
@@ -890,18 +1278,18 @@ if __name__ == '__main__':
   parser.add_option('-p', '--port',
                     action='store',
                     dest='tty',
-                    default='/dev/ttyUSB0',
-                    help='Set serial port, default is \'%default\'.')
+                    default='auto',
+                    help='Set serial port, default is \'%default\' to find the port by USB id.')
   parser.add_option('-v', '--valon',
                     action='store',
                     dest='cwtty',
-                    default='/dev/ttyUSB1',
-                    help='Set serial port, default is \'%default\'.')
+                    default='auto',
+                    help='Set serial port, default is \'%default\' to find the port by USB id.')
   parser.add_option('-b', '--baud',
                     action='store',
                     dest='baudrate',
-                    default=115200,
-                    help='Set serial port baudrate, default is \'%default\'.')
+                    default=None,
+                    help='Set serial port baudrate, default is the baudrate remembered for the port or 115200.')
   parser.add_option('-c', '--config',
                     action='store',
                     dest='config_file',
@@ -916,8 +1304,10 @@ if __name__ == '__main__':
 
   print 'Initiating all controller modules...'
   start=time.time()
-  mts = MTS(port=opts.tty, baudrate=int(opts.baudrate), valon=opts.cwtty, config_file=opts.config_file)
+  mts = MTS(port=opts.tty, baudrate=opts.baudrate and int(opts.baudrate), valon=opts.cwtty, config_file=opts.config_file)
   print 'Initiation takes %.4f seconds' %(time.time()-start)
+  print mts.ctrl.stats.report()
+  mts.ctrl.stats_reset()
 
 ##Verify output measured from combiner is similar for both correlated and uncorrelated sources
   output = mts.select_combiner(opts.combiner)
@@ -1031,6 +1421,7 @@ if __name__ == '__main__':
   start=time.time()
   mts.exit()
   print 'Exiting takes %.4f seconds' %(time.time()-start)
+  print mts.ctrl.stats.report()
 
 # -fin-
 
@@ -0,0 +1,461 @@
+#!/usr/bin/python
+
+from optparse import OptionParser
+from mts_api import MTSAPI, MTSBatch, DeviceError, LinkError
+from mts_codec import RTRNS, CTRL_READ
+from mts_link import LINK_CACHE, set_low_latency, write_link_cache
+import trollius as asyncio
+from trollius import From, Return
+import collections
+import serial
+import sys, time
+
+## Event loop transport for the MTS controller serial protocol
+#  Frames and return values are those of MTSAPI, but requests are coroutines that do not block the event loop.
+#  Requests issued concurrently are pipelined: every frame is sent as soon as the controller buffer has room
+#  and the responses, which the controller returns in order, are matched against a FIFO of outstanding requests.
+#  Every MTSAPI entry point that talks to the controller is a coroutine here, to be called with yield From.
+
+class MTSAIO(MTSAPI):
+  """
+  Set up non-blocking serial communication to the MTS controller board on an event loop.
+  ping, read, write, flush, resync and probe_baudrate are coroutines raising the same DeviceError as the MTSAPI calls.
+
+  @param port     String: USB port allocated to device when connected, or an opened serial port with a fileno
+  @param baudrate Integer: Baudrate of serial communication
+  @param timeout  Integer; [Option] Maximum time (s) to wait for the response to the oldest outstanding request,
+                           the deadline adapts to the observed round trip times
+  @param loop     Object: [Option] Event loop, default is the current event loop
+  @param trust_shadow Boolean: [Option] Skip writes that would not change the value of a register listed in SHADOW_REGS
+  @param capture  String: [Option] Name of capture file to record all frames sent and received
+
+  @return      Handle: Handle to event loop transport object
+  """
+  # Number of response bytes returned by the controller for each control sequence
+  RTRN_SIZE     = { MTSAPI.CTRL_PING : 1, MTSAPI.CTRL_WRITE : 1, MTSAPI.CTRL_READ : 5 }
+
+  def __init__(self, port='/dev/ttyUSB0', baudrate=115200, timeout=1, loop=None, trust_shadow=True, capture=None):
+    if isinstance(port, basestring):
+      # reads return immediately with whatever data is available
+      port = serial.Serial(port=port, baudrate=baudrate, timeout=0)
+      set_low_latency(port)
+    MTSAPI.__init__(self, port=port, timeout=timeout, trust_shadow=trust_shadow, capture=capture)
+    self.loop    = loop or asyncio.get_event_loop()
+    # Outstanding requests in the order sent: [future, ctrl, address, data, seq, time sent, frame size]
+    self.queue     = collections.deque()
+    self.in_flight = 0
+    self.rtrn      = bytearray()
+    self.timer     = None
+    self.sending   = asyncio.Lock(loop=self.loop)
+    # Resync in progress, new requests are held back until the link is in sync
+    self.resyncing = None
+    self.loop.add_reader(self.port.fileno(), self.__data_ready__)
+
+  def __close__(self):
+    """Fail outstanding requests and close serial connection"""
+    self.loop.remove_reader(self.port.fileno())
+    if self.resyncing: self.resyncing.cancel()
+    self.__fail__('Serial port closed', DeviceError)
+    # Closing before exit
+    print 'Closing port %s' % self.port.name
+    self.port.close()
+    self.stop_capture()
+
+  def set_write_behind(self, enable=True, max_pending=None, max_delay=None):
+    """
+    Write-behind is not used on the event loop: writes issued concurrently are already pipelined
+    and each write returns once acknowledged.
+
+    @param enable Boolean: Only False is accepted
+    """
+    if enable: raise DeviceError('Error', 'Write-behind is not supported on the event loop, issue concurrent writes instead')
+
+  def batch(self):
+    """
+    Create a transaction batch whose frames are sent as concurrent, pipelined requests
+
+    @return Object: MTSAIOBatch handle
+    """
+    return MTSAIOBatch(self)
+
+  def __data_ready__(self):
+    """Event loop reader callback: match response bytes against the outstanding requests"""
+    try:
+      self.rtrn.extend(bytearray(self.port.read(max(self.port.inWaiting(), 1))))
+    except Exception as e:
+      self.__fail__(str(e))
+      return
+    while self.queue and len(self.rtrn) >= self.RTRN_SIZE[self.queue[0][1]]:
+      [future, ctrl, address, data, seq, sent, size] = self.queue[0]
+      if ctrl == self.CTRL_READ: [rtrn_val, data] = RTRNS[CTRL_READ].unpack_from(self.rtrn)
+      else: rtrn_val = self.rtrn[0]
+      if ctrl != self.CTRL_PING and (rtrn_val == ord(self.RTRN_OVERFLOW) or (rtrn_val != ord(self.RTRN_SUCCESS) and not self.RTRN_ERRORS.has_key(chr(rtrn_val)))):
+        # framing was lost, as for MTSAPI.__transact__
+        self.__fail__(self.__rtrn_msg__(rtrn_val))
+        return
+      self.queue.popleft()
+      self.in_flight -= size
+      del self.rtrn[:self.RTRN_SIZE[ctrl]]
+      self.__received__(seq, ctrl, address, data, rtrn_val, time.time()-sent)
+      if not future.done(): future.set_result((rtrn_val, data))
+    if not self.queue:
+      # unsolicited bytes
+      del self.rtrn[:]
+    self.__arm__()
+
+  def __arm__(self):
+    """Schedule the response timeout of the oldest outstanding request"""
+    if self.timer: self.timer.cancel()
+    self.timer = None
+    if self.queue:
+      timeout = self.deadlines.deadline({ord(self.queue[0][1]) : 1})
+      self.timer = self.loop.call_later(max(self.queue[0][5]+timeout-time.time(), 0), self.__fail__, 'No response received')
+
+  def __fail__(self, msg, error=LinkError):
+    """
+    Fail all outstanding requests, the position of later responses in the byte stream is unknown
+
+    @param msg   String: Error message
+    @param error Class: [Optional] Exception raised by the requests, a LinkError is retried after a resync
+    """
+    if self.timer: self.timer.cancel()
+    self.timer = None
+    while self.queue:
+      [future, ctrl, address, data, seq, sent, size] = self.queue.popleft()
+      self.__received__(seq, ctrl, address, data, None)
+      if not future.done(): future.set_exception(error('Error', msg))
+    self.in_flight = 0
+    del self.rtrn[:]
+    # controller state is unknown after a missing response
+    self.invalidate()
+    try:
+      self.port.flushInput()
+    except Exception:
+      pass
+
+  @asyncio.coroutine
+  def __request__(self, ctrl, address=0, data=None):
+    """
+    Send a frame once the controller buffer has room and wait for its response
+
+    @param ctrl    String: Control sequence
+    @param address Integer: Register address
+    @param data    Integer: [Optional] Data to write to register
+
+    @return Tuple: (return value, data written or read)
+    """
+    if ctrl == self.CTRL_PING: frame = bytearray(self.CTRL_PING)
+    else: frame = self.__frame__(ctrl, address, data)
+    # frames are sent in the order requested, also while waiting for room in the controller buffer
+    yield From(self.sending.acquire())
+    try:
+      while self.queue and self.in_flight+len(frame) > self.BUFFER_SIZE:
+        yield From(asyncio.wait([self.queue[0][0]], loop=self.loop))
+      future = asyncio.Future(loop=self.loop)
+      seq = self.__sent__(ctrl, address, data or 0)
+      self.queue.append([future, ctrl, address, data, seq, time.time(), len(frame)])
+      self.in_flight += len(frame)
+      try:
+        self.port.write(frame)
+      except Exception as e:
+        self.__fail__(str(e))
+        raise DeviceError('Fatal', str(e))
+      if len(self.queue) == 1: self.__arm__()
+    finally:
+      self.sending.release()
+    rtrn = yield From(future)
+    raise Return(rtrn)
+
+  @asyncio.coroutine
+  def __synced__(self):
+    """Wait for a resync in progress before sending new requests"""
+    if self.resyncing: yield From(self.resyncing)
+
+  @asyncio.coroutine
+  def flush(self):
+    """
+    Barrier: wait for a resync in progress and the responses of all outstanding requests.
+    Failed requests raise their DeviceError in the coroutine that issued them.
+
+    @return Boolean: True
+    """
+    yield From(self.__synced__())
+    futures = [request[0] for request in self.queue]
+    if futures: yield From(asyncio.wait(futures, loop=self.loop))
+    raise Return(True)
+
+  @asyncio.coroutine
+  def resync(self):
+    """
+    Re-establish framing with the controller after a link error, see MTSAPI.resync.
+    Requests failed by the same link error share a single resync.
+
+    @return Boolean: True once the link is in sync, else a DeviceError is raised
+    """
+    if not self.resyncing:
+      self.resyncing = asyncio.ensure_future(self.__resync__(), loop=self.loop)
+    rtrn = yield From(self.resyncing)
+    raise Return(rtrn)
+
+  @asyncio.coroutine
+  def __resync__(self):
+    """Discard stale bytes and ping, with increasing delays, until the controller echoes the ping with no trailing bytes"""
+    try:
+      self.stats.resyncs += 1
+      # requests sent since the link error may be answered out of frame
+      self.__fail__('Link resynchronised')
+      delay = self.BACKOFF
+      for attempt in range(self.retries+1):
+        yield From(asyncio.sleep(delay, loop=self.loop))
+        self.__drain__()
+        del self.rtrn[:]
+        try:
+          yield From(self.__ping__())
+          if not self.port.inWaiting(): raise Return(True)
+        except DeviceError:
+          pass
+        delay = min(2*delay, self.MAX_BACKOFF)
+      raise DeviceError('Fatal', 'Could not resynchronise with controller after %d attempts' % (self.retries+1))
+    finally:
+      self.resyncing = None
+
+  @asyncio.coroutine
+  def __retry__(self, ctrl, address, data=None):
+    """
+    Send a single read or write frame, resynchronising and repeating the request after a link error.
+    Register reads and writes are idempotent, so repeating a request that may have been applied is safe.
+
+    @param ctrl    String: Control sequence, CTRL_READ or CTRL_WRITE
+    @param address Integer: Register address
+    @param data    Integer: [Optional] Data to write to register
+
+    @return Tuple: (return value, data written or read)
+    """
+    for attempt in range(self.retries+1):
+      yield From(self.__synced__())
+      try:
+        rtrn = yield From(self.__request__(ctrl, address, data))
+        raise Return(rtrn)
+      except LinkError:
+        if attempt >= self.retries: raise
+        self.stats.retries += 1
+        yield From(self.resync())
+
+  @asyncio.coroutine
+  def ping(self):
+    """Ping open serial port"""
+    yield From(self.__synced__())
+    rtrn = yield From(self.__ping__())
+    raise Return(rtrn)
+
+  @asyncio.coroutine
+  def __ping__(self):
+    """Ping the controller, without waiting for a resync in progress"""
+    try:
+      [rtrn_val, data] = yield From(self.__request__(self.CTRL_PING))
+    except DeviceError:
+      rtrn_val = None
+    if rtrn_val != ord(self.CTRL_PING):
+      raise DeviceError('Fatal', 'Could not ping serial port')
+    raise Return(True)
+
+  @asyncio.coroutine
+  def write(self, address, data, force=False):
+    """
+    Writes data to a register address
+
+    @param address Interger: Register address to write data to
+    @param data:   String: Data to write to register
+    @param force   Boolean: [Optional] Write to the register even if the shadow shows the data is already set
+
+    @return Boolean: Indicating if 'write' to register was successful.
+    """
+    if not force and self.__shadowed__(address, data): raise Return(True)
+    # requests issued after this write must see the new value
+    self.shadow[address] = data
+    try:
+      [rtrn_val, data] = yield From(self.__retry__(self.CTRL_WRITE, address, data))
+    except DeviceError as de:
+      self.invalidate(address)
+      raise DeviceError(de.level, 'Could not write data to serial port:\n %s' % de.msg)
+    if ord(self.RTRN_SUCCESS) != rtrn_val:
+      self.invalidate(address)
+      raise DeviceError('Error', 'Could not write data to serial port:\n %s' % self.__rtrn_msg__(rtrn_val))
+    raise Return(True)
+
+  @asyncio.coroutine
+  def read(self, address):
+    """
+    Reads data to a register address
+
+    @param Integer: Register address to read from
+
+    @return String: Data read form register
+    """
+    try:
+      [rtrn_val, data] = yield From(self.__retry__(self.CTRL_READ, address))
+    except DeviceError as de:
+      raise DeviceError(de.level, 'Could not read data from serial port:\n %s' % de.msg)
+    if ord(self.RTRN_SUCCESS) != rtrn_val:
+      raise DeviceError('Error', 'Could not read data from serial port:\n %s' % self.__rtrn_msg__(rtrn_val))
+    raise Return(data)
+
+  @asyncio.coroutine
+  def probe_baudrate(self, baudrates=None, count=50, cache=LINK_CACHE):
+    """
+    Measure the throughput and error rate of ping and register read loops at candidate baudrates,
+    and leave the port at the fastest baudrate that completed without errors, see MTSAPI.probe_baudrate.
+
+    @param baudrates List: [Optional] Baudrates to try, default is BAUDRATES
+    @param count     Integer: [Optional] Number of ping and read pairs at each baudrate
+    @param cache     String: [Optional] Link cache file to remember the selected baudrate of the port, None to not remember it
+
+    @return Dictionary: (transactions per second, errors) for each baudrate tried
+    """
+    yield From(self.flush())
+    if baudrates is None: baudrates = self.BAUDRATES
+    address = self.__get_address__(mod=1, reg=0)
+    [baudrate, timeout, retries] = [self.port.baudrate, self.deadlines.timeout, self.retries]
+    results = {}
+    try:
+      self.deadlines.timeout = self.PROBE_TIMEOUT
+      # a missing response is an error of the baudrate, not of the link
+      self.retries = 0
+      for rate in baudrates:
+        self.port.baudrate = rate
+        self.__drain__()
+        # round trips depend on the baudrate
+        self.deadlines.reset()
+        errors = 0
+        start = time.time()
+        for idx in range(count):
+          try:
+            yield From(self.ping())
+            yield From(self.read(address))
+          except DeviceError:
+            errors += 1
+            self.__drain__()
+            # no response at this baudrate
+            if idx == 0: break
+        if errors and idx == 0: errors = count
+        results[rate] = ((idx+1)*2/(time.time()-start), errors)
+    finally:
+      working = [(tps, rate) for [rate, [tps, errors]] in results.items() if not errors]
+      if working: baudrate = max(working)[1]
+      self.port.baudrate = baudrate
+      self.deadlines.timeout = timeout
+      self.deadlines.reset()
+      self.retries = retries
+      self.__drain__()
+      # garbled frames sent at a wrong baudrate may have changed registers
+      self.invalidate()
+    if working and cache: write_link_cache(self.port.name, cache=cache, baudrate=baudrate)
+    raise Return(results)
+
+class MTSAIOBatch(MTSBatch):
+  """
+  Queue register read and write frames and send them as concurrent requests on the event loop,
+  pipelined as far as the controller buffer allows. send is a coroutine:
+
+    batch = mts.batch()
+    batch.write(address, data)
+    results = yield From(batch.send())
+
+  @param mts_aio Object: MTSAIO handle of the controller event loop transport
+
+  @return      Handle: Handle to transaction batch object
+  """
+  def __exit__(self, exc_type, exc_value, traceback):
+    # frames are only sent by the send coroutine, the shadow of writes left unsent is unknown
+    for [ctrl, address, data] in self.frames:
+      if ctrl == MTSAPI.CTRL_WRITE: self.mts_api.invalidate(address)
+    self.frames = []
+    return False
+
+  @asyncio.coroutine
+  def send(self, raise_errors=True):
+    """
+    Send all queued frames to the controller as concurrent requests and wait for all responses
+
+    @param raise_errors Boolean: [Optional] Raise a DeviceError listing all failed frames, else failures are only recorded in the errors list
+
+    @return List: Result per frame, True for a write and the data read for a read, None if the frame failed
+    """
+    api = self.mts_api
+    frames = self.frames
+    self.frames  = []
+    self.results = []
+    self.errors  = []
+    if not frames: raise Return(self.results)
+    requests = []
+    for [ctrl, address, data] in frames:
+      # the shadow was checked when the write was queued
+      if ctrl == api.CTRL_WRITE: request = api.write(address, data, force=True)
+      else: request = api.read(address)
+      # tasks start in the order created, gather alone does not keep the frame order
+      requests.append(asyncio.ensure_future(request, loop=api.loop))
+    results = yield From(asyncio.gather(*requests, loop=api.loop, return_exceptions=True))
+    for [idx, result] in enumerate(results):
+      if isinstance(result, DeviceError):
+        [ctrl, address, data] = frames[idx]
+        self.errors.append((idx, address, data, result.msg))
+        result = None
+      elif isinstance(result, BaseException):
+        raise result
+      self.results.append(result)
+    if raise_errors and self.errors:
+      msg = 'Batch transaction failed on %d of %d frames:' % (len(self.errors), len(frames))
+      for [idx, address, data, error] in self.errors:
+        if data is None:
+          msg += '\n Frame %d, read address 0x%04x: %s' % (idx, address, error)
+        else:
+          msg += '\n Frame %d, write address 0x%04x data 0x%08x: %s' % (idx, address, data, error)
+      raise DeviceError('Error', msg)
+    raise Return(self.results)
+
+if __name__ == '__main__':
+
+  parser = OptionParser(version="%prog 0.1")
+  parser.add_option('-p', '--port',
+                    action='store',
+                    dest='tty',
+                    default='/dev/ttyUSB0',
+                    help='Set serial port, default is \'%default\'.')
+  parser.add_option('-b', '--baud',
+                    action='store',
+                    dest='baudrate',
+                    default=115200,
+                    help='Set serial port baudrate, default is \'%default\'.')
+  parser.add_option('-n', '--count',
+                    action='store',
+                    dest='count',
+                    default=100,
+                    type=int,
+                    help='Number of pipelined register reads, default is \'%default\'.')
+  (opts, args) = parser.parse_args()
+
+  @asyncio.coroutine
+  def main(mts):
+    yield From(mts.ping())
+    addr=mts.__get_address__(mod=1, reg=0)
+    start=time.time()
+    for count in range(opts.count):
+      yield From(mts.read(addr))
+    print '%d sequential reads take %.4f seconds' % (opts.count, time.time()-start)
+    start=time.time()
+    yield From(asyncio.gather(*[mts.read(addr) for count in range(opts.count)]))
+    print '%d pipelined reads take %.4f seconds' % (opts.count, time.time()-start)
+
+  loop = asyncio.get_event_loop()
+  mts = MTSAIO(port=opts.tty, baudrate=int(opts.baudrate), loop=loop)
+  try:
+    loop.run_until_complete(main(mts))
+  except DeviceError as de:
+    print '%s: %s' % (de.level, de.msg)
+    sys.exit(1)
+  finally:
+    # Closing before exit
+    mts.__close__()
+    loop.close()
+
+# -fin-
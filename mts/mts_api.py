@@ -1,6 +1,12 @@
 #!/usr/bin/python
 
 from optparse import OptionParser
+from mts_capture import MTSCapture, SENT, RECEIVED
+from mts_codec import MTSCodec, FRAMES, RTRN_SIZES, encode_frames, decode_responses
+from mts_link import LINK_CACHE, set_low_latency, write_link_cache
+from mts_regmap import READ_OFFSET
+from mts_stats import MTSStats, MTSDeadlines
+from mts_worker import serialised
 import serial
 import sys, time
 
@@ -11,13 +17,23 @@ class DeviceError(Exception):
     self.level = level
     self.msg   = msg
 
+class LinkError(DeviceError):
+  """Loss of framing on the serial link: a missing or partial response, a buffer overflow or an unexpected return value"""
+  pass
+
 class MTSAPI():
   """
   Set up serial communication to the MTS controller board.
 
-  @param port     String: USB port allocated to device when connected
+  @param port     String: USB port allocated to device when connected, or an object with the serial port interface such as MTSReplay
   @param baudrate Integer: Baudrate of serial communication
   @param timeout  Integer; [Option] To prevent serial port from waiting for ever to establish connection
+  @param write_behind Boolean: [Option] Return from register writes without waiting for the acknowledgement, see set_write_behind
+  @param trust_shadow Boolean: [Option] Skip writes that would not change the value of a register listed in SHADOW_REGS
+  @param capture  String: [Option] Name of capture file to record all frames sent and received, see start_capture
+  @param retries  Integer: [Option] Number of times a read or write is repeated after resynchronising a broken link, see resync
+  @param adaptive Boolean: [Option] Wait for responses until a deadline derived from the observed round trip times,
+                           with timeout as the maximum, instead of always waiting timeout, see mts_stats.MTSDeadlines
 
   @return      Handle: Handle to synthesize object
   """
@@ -29,14 +45,68 @@ class MTSAPI():
   RTRN_OVERFLOW = '\xfd' # A buffer overflow occurred
   RTRN_BUSERROR = '\xfe' # There was a internal bus error (slave timeout or other)
   RTRN_CMDERROR = '\xff' # The command was not recognized
+  RTRN_ERRORS   = {
+    RTRN_OVERFLOW : 'Buffer overflow occurred',
+    RTRN_BUSERROR : 'Internal bus error',
+    RTRN_CMDERROR : 'Command not recognized',
+  }
+  # Number of bytes the controller can buffer, batched transactions are sent in chunks not exceeding this size
+  BUFFER_SIZE   = 64
+  # Number of response bytes returned by the controller for each control sequence
+  RTRN_SIZE     = { CTRL_WRITE : 1, CTRL_READ : 5 }
+  # Number of seconds a write-behind acknowledgement may remain unchecked
+  MAX_DELAY     = 0.05
+  # Module registers whose writes are skipped when the shadow shows the value is already set (reg_chanelsel)
+  SHADOW_REGS   = [0]
+  # Candidate baudrates of the controller USB serial bridge, and the response timeout (s) while probing
+  BAUDRATES     = [115200, 230400, 460800, 921600]
+  PROBE_TIMEOUT = 0.1
+  # Retries after a link error, with the delay (s) before the first resync ping doubling up to MAX_BACKOFF
+  RETRIES       = 3
+  BACKOFF       = 0.01
+  MAX_BACKOFF   = 0.5
+
+  def __init__(self, port='/dev/ttyUSB0', baudrate=115200, timeout=1, write_behind=False, trust_shadow=True, capture=None, retries=RETRIES, adaptive=True):
+
+    self.retries = retries
+    # Worker thread serialising access from multiple threads, see mts_worker
+    self.worker  = None
+    # Frame and response buffers
+    self.codec   = MTSCodec()
+    # Frame sequence number, transaction statistics and capture
+    self.seq     = 0
+    self.stats   = MTSStats()
+    self.capture = None
+    # Response deadlines adapted to the observed round trip times, the port timeout is the static fallback
+    if not isinstance(port, basestring): timeout = getattr(port, 'timeout', None) or timeout
+    self.deadlines = MTSDeadlines(timeout, adaptive=adaptive)
+    if capture: self.start_capture(capture)
 
-  def __init__(self, port='/dev/ttyUSB0', baudrate=115200, timeout=1):
+    # Shadow of the last known value of every written register address
+    self.shadow       = {}
+    self.shadow_regs  = list(self.SHADOW_REGS)
+    self.trust_shadow = trust_shadow
+    self.skipped      = 0
+
+    # Write-behind queue of (address, data, seq, time sent) writes awaiting acknowledgement
+    self.write_behind   = False
+    self.pending        = []
+    self.pending_errors = []
+    self.pending_since  = 0
+    self.max_pending    = self.BUFFER_SIZE // len(self.__frame__(self.CTRL_WRITE, 0, 0))
+    self.max_delay      = self.MAX_DELAY
 
     # Set up serial comms
-    self.port = serial.Serial(port=port, baudrate=baudrate, timeout=timeout)
+    if isinstance(port, basestring):
+      self.port = serial.Serial(port=port, baudrate=baudrate, timeout=timeout)
+      set_low_latency(self.port)
+    else:
+      # serial port replacement
+      self.port = port
     # Establish communication
     try:
-     self.port.open()
+      # serial.Serial opens the port when constructed with a port name
+      if not self.port.isOpen(): self.port.open()
     except Exception as e:
       raise DeviceError('Fatal', str(e)) 
     # Initiate data transfer
@@ -54,6 +124,10 @@ class MTSAPI():
       except Exception as e:
         raise DeviceError('Fatal', str(e)) 
       raise DeviceError('Fatal', 'Serial port %s not open, cleanup and exit' % self.port.name) 
+    if write_behind: self.set_write_behind()
+
+  def __worker__(self):
+    return self.worker
 
   def __get_address__(self, mod, reg, read=False):
     """
@@ -68,55 +142,350 @@ class MTSAPI():
     addr = ((mod << 12) | reg) | read << 2
     return addr
 
+  def __frame__(self, ctrl, address, data=None):
+    """
+    Build the byte sequence sent to the controller for a single read or write
+
+    @param ctrl    String: Control sequence, CTRL_READ or CTRL_WRITE
+    @param address Integer: Register address
+    @param data    Integer: [Optional] Data to write to register
+
+    @return Bytearray: Frame to write to serial port
+    """
+    if data is None: return bytearray(FRAMES[ord(ctrl)].pack(ord(ctrl), address))
+    return bytearray(FRAMES[ord(ctrl)].pack(ord(ctrl), address, data))
+
+  def __shadowed__(self, address, data):
+    """
+    Check if a register write can be skipped because the register is known to contain the data already
+
+    @param address Integer: Register address to write data to
+    @param data    Integer: Data to write to register
+
+    @return Boolean: True if the write will not change hardware state
+    """
+    if not self.trust_shadow: return False
+    if (address & 0xFFF) not in self.shadow_regs: return False
+    if self.shadow.get(address) != data: return False
+    self.skipped += 1
+    return True
+
+  def invalidate(self, address=None):
+    """
+    Forget the shadow value of a register, forcing the next write to be sent to the controller
+
+    @param address Integer: [Optional] Register address, if not specified the complete shadow is cleared
+    """
+    if address is None: self.shadow.clear()
+    elif self.shadow.has_key(address): del self.shadow[address]
+
+  def start_capture(self, capture):
+    """
+    Record every frame sent to and received from the controller to a capture file
+
+    @param capture String: Name of capture file to create, or a MTSCapture object
+    """
+    self.stop_capture()
+    if isinstance(capture, basestring): capture = MTSCapture(capture)
+    self.capture = capture
+
+  def stop_capture(self):
+    """Stop recording frames and close the capture file"""
+    if self.capture: self.capture.close()
+    self.capture = None
+
+  def __sent__(self, ctrl, address=0, data=0):
+    """
+    Number a frame sent to the controller and record it in the capture
+
+    @param ctrl    String: Control sequence
+    @param address Integer: Register address
+    @param data    Integer: Data written
+
+    @return Integer: Frame sequence number
+    """
+    self.seq += 1
+    if self.capture: self.capture.record(self.seq, SENT, ord(ctrl), address, data)
+    return self.seq
+
+  def __received__(self, seq, ctrl, address=0, data=0, status=0, latency=0, batch=False):
+    """
+    Account for a frame response received from the controller in the statistics and capture
+
+    @param seq     Integer: Sequence number of the frame sent
+    @param ctrl    String: Control sequence
+    @param address Integer: Register address
+    @param data    Integer: Data written or read
+    @param status  Integer: Return value, None if no response was received
+    @param latency Float: Time (s) from sending the frame to receiving the response, or its share of the batch round trip
+    @param batch   Boolean: [Optional] True if the frame was sent together with other frames, see MTSDeadlines
+    """
+    self.stats.record(ord(ctrl), address, latency, status)
+    self.deadlines.record(ord(ctrl), latency, status, batch=batch)
+    # reading a write register returns the register content, writes update the shadow when sent
+    if ctrl == self.CTRL_READ and status == ord(self.RTRN_SUCCESS) and not address & READ_OFFSET: self.shadow[address] = data
+    if self.capture and status is not None: self.capture.record(seq, RECEIVED, ord(ctrl), address, data, status)
+
+  def stats_snapshot(self):
+    """
+    Copy of the link statistics: transactions by type, bytes, errors by return value and latency histograms
+
+    @return Dictionary: Statistics snapshot, see MTSStats.snapshot
+    """
+    return self.stats.snapshot()
+
+  def stats_reset(self):
+    """Clear the link statistics"""
+    self.stats.reset()
+
+  def __wait__(self, counts):
+    """
+    Set the port timeout to the deadline for the responses to the transactions sent
+
+    @param counts Dictionary: Number of transactions of each control sequence, e.g. {CTRL_READ : 1}
+    """
+    timeout = self.deadlines.deadline(counts)
+    # reconfiguring the port is a system call, only change the timeout when the deadline changes
+    if timeout != self.port.timeout: self.port.timeout = timeout
+
+  def __rtrn_msg__(self, rtrn_val):
+    """
+    Describe the error indicated by a controller return value
+
+    @param rtrn_val Integer: Return value read from serial port
+
+    @return String: Error message
+    """
+    if self.RTRN_ERRORS.has_key(chr(rtrn_val)):
+      return self.RTRN_ERRORS[chr(rtrn_val)]
+    return 'Unknown return value %s' % (hex(rtrn_val))
+
   def __close__(self):
     """Close serial connection"""
-    # Closing before exit
-    print 'Closing port %s' % self.port.name
-    self.port.close()
+    try:
+      # check outstanding write-behind acknowledgements
+      self.flush()
+    finally:
+      # Closing before exit
+      print 'Closing port %s' % self.port.name
+      self.port.close()
+      self.stop_capture()
+
+  def set_write_behind(self, enable=True, max_pending=None, max_delay=None):
+    """
+    Enable write-behind mode: register writes are sent immediately, but return without waiting for the acknowledgement.
+    Queued acknowledgements are checked at the next barrier, being a read, ping, batch with reads or explicit flush,
+    or once max_pending writes are outstanding or max_delay seconds have passed.
+    No timer runs: max_delay is checked at the next write or batch, including writes skipped by the shadow,
+    so acknowledgements of the last writes before an idle period are only checked when the link is used again.
+    Failed writes raise a DeviceError at that barrier, listing the offending address and data.
+
+    @param enable      Boolean: True to enable, False to flush outstanding writes and return to blocking writes
+    @param max_pending Integer: [Optional] Maximum number of unacknowledged writes, default is what fits in the controller buffer
+    @param max_delay   Float: [Optional] Maximum time (s) a write remains unacknowledged
+    """
+    if not enable: self.flush()
+    self.write_behind = enable
+    if max_pending: self.max_pending = max_pending
+    if max_delay is not None: self.max_delay = max_delay
+
+  def __defer__(self, frames, writes):
+    """
+    Send write frames without waiting for the acknowledgement
+
+    @param frames Bytearray: Write frames to send to the controller
+    @param writes List: (address, data) of each write in the frames
+    """
+    if len(self.pending)+len(writes) > self.max_pending: self.flush()
+    if not self.pending: self.pending_since = time.time()
+    writes = [(address, data, self.__sent__(self.CTRL_WRITE, address, data), time.time()) for [address, data] in writes]
+    self.port.write(frames)
+    self.pending.extend(writes)
+    # check acknowledgements already received without blocking
+    self.__acknowledge__(bytearray(self.port.read(min(self.port.inWaiting(), len(self.pending)))))
+    self.__expire__()
+
+  def __expire__(self):
+    """Flush queued writes once the oldest has remained unacknowledged for max_delay seconds"""
+    if self.pending and (time.time()-self.pending_since) >= self.max_delay: self.flush()
+
+  def __acknowledge__(self, rtrn_array):
+    """
+    Match acknowledgement bytes against the oldest queued writes, recording failed writes
+
+    @param rtrn_array Bytearray: Return values read from serial port
+    """
+    for rtrn_val in rtrn_array:
+      [address, data, seq, sent] = self.pending.pop(0)
+      self.__received__(seq, self.CTRL_WRITE, address, data, rtrn_val, time.time()-sent)
+      if ord(self.RTRN_SUCCESS) != rtrn_val:
+        self.invalidate(address)
+        self.pending_errors.append((address, data, self.__rtrn_msg__(rtrn_val)))
+
+  @serialised
+  def flush(self):
+    """
+    Write-behind barrier: wait for the acknowledgement of every queued write
+
+    @return Boolean: Indicating if all queued writes were successful, else a DeviceError is raised
+    """
+    if self.pending:
+      self.__wait__({ord(self.CTRL_WRITE) : len(self.pending)})
+      self.__acknowledge__(bytearray(self.port.read(len(self.pending))))
+      # writes not acknowledged before the port timeout
+      for [address, data, seq, sent] in self.pending:
+        self.__received__(seq, self.CTRL_WRITE, address, data, None)
+        self.invalidate(address)
+        self.pending_errors.append((address, data, 'No acknowledgement received'))
+    # resync pings the controller, the errors of the writes flushed are raised once the link is in sync
+    errors = self.pending_errors
+    self.pending_errors = []
+    if self.pending:
+      # late acknowledgements must not be taken as responses to later frames
+      self.pending = []
+      self.resync()
+    if errors:
+      msg = 'Could not write data to serial port:'
+      for [address, data, error] in errors:
+        msg += '\n Write address 0x%04x data 0x%08x: %s' % (address, data, error)
+      raise DeviceError('Error', msg)
+    return True
+
+  def __drain__(self):
+    """Discard all bytes received from the controller"""
+    self.port.flushInput()
+    while self.port.inWaiting():
+      self.port.read(self.port.inWaiting())
+
+  @serialised
+  def resync(self):
+    """
+    Re-establish framing with the controller after a link error:
+    discard stale bytes and ping, with increasing delays, until the controller echoes the ping with no trailing bytes.
+    The shadow is cleared since writes in flight may or may not have been applied.
+
+    @return Boolean: True once the link is in sync, else a DeviceError is raised
+    """
+    self.stats.resyncs += 1
+    self.invalidate()
+    delay = self.BACKOFF
+    for attempt in range(self.retries+1):
+      time.sleep(delay)
+      self.__drain__()
+      try:
+        # outstanding writes were discarded, ping without a write-behind barrier
+        self.__ping__()
+        if not self.port.inWaiting(): return True
+      except DeviceError:
+        pass
+      delay = min(2*delay, self.MAX_BACKOFF)
+    raise DeviceError('Fatal', 'Could not resynchronise with controller after %d attempts' % (self.retries+1))
+
+  def __transact__(self, ctrl, address, data=None):
+    """
+    Send a single read or write frame and wait for the response
+
+    @param ctrl    String: Control sequence, CTRL_READ or CTRL_WRITE
+    @param address Integer: Register address
+    @param data    Integer: [Optional] Data to write to register
+
+    @return Tuple: (return value, data read or None), a LinkError is raised if framing was lost
+    """
+    if ctrl == self.CTRL_READ: msg = 'Could not read data from serial port:\n %s'
+    else: msg = 'Could not write data to serial port:\n %s'
+    write_array = self.codec.encode(ctrl, address, data)
+    seq = self.__sent__(ctrl, address, data or 0)
+    self.__wait__({ord(ctrl) : 1})
+    sent = time.time()
+    self.port.write(write_array)
+    size = self.codec.receive(self.port, ctrl)
+    if size < self.RTRN_SIZE[ctrl]:
+      self.__received__(seq, ctrl, address, data or 0, None)
+      if size: raise LinkError('Error', msg % 'Partial response received')
+      raise LinkError('Error', msg % 'No response received')
+    latency = time.time()-sent
+    [rtrn_val, value] = self.codec.decode(ctrl)
+    if value is None: self.__received__(seq, ctrl, address, data, rtrn_val, latency)
+    else: self.__received__(seq, ctrl, address, value, rtrn_val, latency)
+    if rtrn_val == ord(self.RTRN_OVERFLOW) or (rtrn_val != ord(self.RTRN_SUCCESS) and not self.RTRN_ERRORS.has_key(chr(rtrn_val))):
+      raise LinkError('Error', msg % self.__rtrn_msg__(rtrn_val))
+    return (rtrn_val, value)
+
+  def __retry__(self, ctrl, address, data=None):
+    """
+    Send a single read or write frame, resynchronising and repeating the transaction after a link error.
+    Register reads and writes are idempotent, so repeating a transaction that may have been applied is safe.
 
+    @param ctrl    String: Control sequence, CTRL_READ or CTRL_WRITE
+    @param address Integer: Register address
+    @param data    Integer: [Optional] Data to write to register
+
+    @return Tuple: (return value, data read or None)
+    """
+    for attempt in range(self.retries+1):
+      try:
+        return self.__transact__(ctrl, address, data)
+      except LinkError:
+        if attempt >= self.retries: raise
+        self.stats.retries += 1
+        self.resync()
+
+  @serialised
   def ping(self):
     """Ping open serial port"""
+    self.flush()
+    return self.__ping__()
+
+  def __ping__(self):
+    """Ping the controller, without checking outstanding write-behind acknowledgements"""
     # try to ping the controller
-    self.port.write(bytearray(self.CTRL_PING))
+    seq = self.__sent__(self.CTRL_PING)
+    self.__wait__({ord(self.CTRL_PING) : 1})
+    sent = time.time()
+    self.port.write(self.codec.encode(self.CTRL_PING))
 #     time.sleep(0.01)
-    rtrn_byte = self.port.read(1)
+    if self.codec.receive(self.port, self.CTRL_PING) < 1:
+      self.__received__(seq, self.CTRL_PING, status=None)
+      raise DeviceError('Fatal', 'Could not ping serial port')
+    [rtrn_byte, data] = self.codec.decode(self.CTRL_PING)
+    self.__received__(seq, self.CTRL_PING, status=rtrn_byte, latency=time.time()-sent)
     # print `self.CTRL_PING`, `rtrn_byte`
-    if ord(rtrn_byte) != ord(self.CTRL_PING):
+    if rtrn_byte != ord(self.CTRL_PING):
       raise DeviceError('Fatal', 'Could not ping serial port')
     return True 
 
-  def write(self, address, data):
+  @serialised
+  def write(self, address, data, force=False):
     """
     Writes data to a register address
 
     @param address Interger: Register address to write data to
     @param data:   String: Data to write to register
+    @param force   Boolean: [Optional] Write to the register even if the shadow shows the data is already set
 
     @return Boolean: Indicating if 'write' to register was successful.
     """
 
-    write_array = bytearray()
+    self.__expire__()
+    if not force and self.__shadowed__(address, data): return True
     # write data to the controller
-    write_array.append(self.CTRL_WRITE)
-    for byte in range(0,2):
-      write_array.append((address >> (byte*8)) & 0xFF)
-    for byte in range(0,4):
-      write_array.append((data >> (byte*8)) & 0xFF)
+    if self.write_behind:
+      self.shadow[address] = data
+      self.__defer__(self.codec.encode(self.CTRL_WRITE, address, data), [(address, data)])
+      return True
     # print 'writing:', `write_array`
-    self.port.write(write_array)
-#     time.sleep(0.01) # time.sleep(0.5)
-    rtrn_val = bytearray(self.port.read(1))[0]
+    try:
+      [rtrn_val, value] = self.__retry__(self.CTRL_WRITE, address, data)
+    except DeviceError:
+      self.invalidate(address)
+      raise
     if ord(self.RTRN_SUCCESS) != rtrn_val:
-      if rtrn_val == ord(self.RTRN_OVERFLOW):
-        raise DeviceError('Error', 'Could not write data to serial port:\n Buffer overflow occurred')
-      elif rtrn_val == ord(self.RTRN_BUSERROR):
-        raise DeviceError('Error', 'Could not write data to serial port:\n Internal bus error')
-      elif rtrn_val == ord(self.RTRN_CMDERROR):
-        raise DeviceError('Error', 'Could not write data to serial port:\n Command not recognized')
-      else:
-        raise DeviceError('Error', 'Could not write data to serial port:\n Unknown return value %s' % (hex(rtrn_val)))
+      self.invalidate(address)
+      raise DeviceError('Error', 'Could not write data to serial port:\n %s' % self.__rtrn_msg__(rtrn_val))
+    self.shadow[address] = data
     return True 
 
+  @serialised
   def read(self, address): 
     """
     Reads data to a register address
@@ -125,29 +494,247 @@ class MTSAPI():
 
     @return String: Data read form register
     """
-    write_array = bytearray()
+    self.flush()
     # read data via the controller
-    write_array.append(self.CTRL_READ)
-    for byte in range(0,2):
-      write_array.append((address >> (byte*8)) & 0xFF)
-    self.port.write(write_array)
-    read_array = bytearray(self.port.read(5))
-    # print 'read:', `read_array`
-    rtrn_val = read_array[0]
+    [rtrn_val, data] = self.__retry__(self.CTRL_READ, address)
     if ord(self.RTRN_SUCCESS) != rtrn_val:
-      if rtrn_val == ord(self.RTRN_OVERFLOW):
-        raise DeviceError('Error', 'Could not read data from serial port:\n Buffer overflow occurred')
-      elif rtrn_val == ord(self.RTRN_BUSERROR):
-        raise DeviceError('Error', 'Could not read data from serial port:\n Internal bus error')
-      elif rtrn_val == ord(self.RTRN_CMDERROR):
-        raise DeviceError('Error', 'Could not read data from serial port:\n Command not recognized')
-      else:
-        raise DeviceError('Error', 'Could not read data from serial port:\n Unknown return value %s' % (hex(rtrn_val)))
-    data = 0
-    for byte in range(0,4):
-      data |= read_array[byte + 1] << (byte * 8)
+      raise DeviceError('Error', 'Could not read data from serial port:\n %s' % self.__rtrn_msg__(rtrn_val))
     return data
 
+  @serialised
+  def probe_baudrate(self, baudrates=None, count=50, cache=LINK_CACHE):
+    """
+    Measure the throughput and error rate of ping and register read loops at candidate baudrates,
+    and leave the port at the fastest baudrate that completed without errors.
+    The controller only responds at the baudrate of its firmware, other baudrates fail at the first ping.
+
+    @param baudrates List: [Optional] Baudrates to try, default is BAUDRATES
+    @param count     Integer: [Optional] Number of ping and read pairs at each baudrate
+    @param cache     String: [Optional] Link cache file to remember the selected baudrate of the port, None to not remember it
+
+    @return Dictionary: (transactions per second, errors) for each baudrate tried
+    """
+    self.flush()
+    if baudrates is None: baudrates = self.BAUDRATES
+    address = self.__get_address__(mod=1, reg=0)
+    [baudrate, timeout] = [self.port.baudrate, self.deadlines.timeout]
+    results = {}
+    try:
+      self.deadlines.timeout = self.PROBE_TIMEOUT
+      for rate in baudrates:
+        self.port.baudrate = rate
+        self.port.flushInput()
+        # round trips depend on the baudrate
+        self.deadlines.reset()
+        errors = 0
+        start = time.time()
+        for idx in range(count):
+          try:
+            self.ping()
+            self.read(address)
+          except DeviceError:
+            errors += 1
+            self.port.flushInput()
+            # no response at this baudrate
+            if idx == 0: break
+        if errors and idx == 0: errors = count
+        results[rate] = ((idx+1)*2/(time.time()-start), errors)
+    finally:
+      working = [(tps, rate) for [rate, [tps, errors]] in results.items() if not errors]
+      if working: baudrate = max(working)[1]
+      self.port.baudrate = baudrate
+      self.deadlines.timeout = timeout
+      self.deadlines.reset()
+      self.port.flushInput()
+      # garbled frames sent at a wrong baudrate may have changed registers
+      self.invalidate()
+    if working and cache: write_link_cache(self.port.name, cache=cache, baudrate=baudrate)
+    return results
+
+  def batch(self):
+    """
+    Create a transaction batch to queue many register reads and writes and send them in bulk
+
+    @return Object: MTSBatch handle
+    """
+    return MTSBatch(self)
+
+class MTSBatch():
+  """
+  Queue register read and write frames to the MTS controller and send them as a single transaction.
+  Queued frames are written to the serial port in as few writes as the controller buffer allows
+  and all responses are parsed in bulk.
+
+  @param mts_api Object: MTSAPI handle of the controller serial connection
+
+  @return      Handle: Handle to transaction batch object
+  """
+  def __init__(self, mts_api):
+    self.mts_api = mts_api
+    self.frames  = []
+    self.results = []
+    self.errors  = []
+
+  def __len__(self):
+    return len(self.frames)
+
+  def __worker__(self):
+    return self.mts_api.worker
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    # only send queued frames if no error occurred while building the batch
+    if exc_type is None: self.send()
+    else:
+      for [ctrl, address, data] in self.frames:
+        if ctrl == MTSAPI.CTRL_WRITE: self.mts_api.invalidate(address)
+    return False
+
+  def write(self, address, data, force=False):
+    """
+    Queue data to write to a register address.
+    The write is not queued if the controller shadow shows the register already contains the data.
+
+    @param address Integer: Register address to write data to
+    @param data    Integer: Data to write to register
+    @param force   Boolean: [Optional] Queue the write even if the shadow shows the data is already set
+
+    @return Integer: Index of the frame result in the batch, None if the write was skipped
+    """
+    if not force and self.mts_api.__shadowed__(address, data): return None
+    # later writes in the batch must see this value
+    self.mts_api.shadow[address] = data
+    self.frames.append((MTSAPI.CTRL_WRITE, address, data))
+    return len(self.frames)-1
+
+  def read(self, address):
+    """
+    Queue a read from a register address
+
+    @param address Integer: Register address to read from
+
+    @return Integer: Index of the frame result in the batch
+    """
+    self.frames.append((MTSAPI.CTRL_READ, address, None))
+    return len(self.frames)-1
+
+  def __parse__(self, frames, ctrls, chunks, rtrns):
+    """
+    Decode the responses to the chunks sent and record the result of each frame
+
+    @param frames List: (ctrl, address, data) of every frame in the batch
+    @param ctrls  List: Control sequence (integer) of every frame in the batch
+    @param chunks List: (start, stop, seqs, latency) of each chunk sent
+    @param rtrns  List: Response bytes read for each chunk
+    """
+    if not chunks: return
+    api = self.mts_api
+    [rtrn_vals, values] = decode_responses(''.join(rtrns), sum([ctrls[start:stop] for [start, stop, seqs, latency] in chunks], []))
+    pos = 0
+    for [start, stop, seqs, latency] in chunks:
+      for idx in range(start, stop):
+        [ctrl, address, data] = frames[idx]
+        rtrn_val = rtrn_vals[pos]
+        value = data
+        if ctrl == api.CTRL_READ: value = values[pos]
+        pos += 1
+        api.__received__(seqs[idx-start], ctrl, address, value, rtrn_val, latency, batch=(stop-start > 1))
+        if ord(api.RTRN_SUCCESS) != rtrn_val:
+          if ctrl == api.CTRL_WRITE: api.invalidate(address)
+          self.errors.append((idx, address, data, rtrn_val))
+          self.results[idx] = None
+        elif ctrl == api.CTRL_READ:
+          self.results[idx] = value
+    # the last frame addressing a register sets the shadow, also if a read was parsed after a later write was queued
+    addresses = set()
+    for idx in range(len(frames)-1, -1, -1):
+      [ctrl, address, data] = frames[idx]
+      if address in addresses: continue
+      addresses.add(address)
+      if ctrl == api.CTRL_WRITE and self.results[idx] is True: api.shadow[address] = data
+    del chunks[:]
+    del rtrns[:]
+
+  @serialised
+  def send(self, raise_errors=True):
+    """
+    Send all queued frames to the controller and parse the responses.
+    Frames are grouped into chunks that do not exceed the controller buffer size, each chunk is sent using a single port write.
+    In write-behind mode chunks containing only writes are not waited on and their errors are raised at the next barrier.
+
+    @param raise_errors Boolean: [Optional] Raise a DeviceError listing all failed frames, else failures are only recorded in the errors list
+
+    @return List: Result per frame, True for a write and the data read for a read, None if the frame failed
+    """
+    api = self.mts_api
+    frames = self.frames
+    self.frames  = []
+    self.results = []
+    self.errors  = []
+    api.__expire__()
+    if not frames: return self.results
+    # encode all frames at once, chunks are slices of the encoded frames
+    ctrls = [ord(ctrl) for [ctrl, address, data] in frames]
+    [encoded, offsets] = encode_frames(ctrls, [address for [ctrl, address, data] in frames], [data or 0 for [ctrl, address, data] in frames])
+    offsets = offsets.tolist()
+    rtrn_sizes = RTRN_SIZES[ctrls].tolist()
+    self.results = [True]*len(frames)
+    # responses are decoded in bulk once all chunks were sent: (start, stop, seqs, latency) and response bytes of each chunk
+    chunks = []
+    rtrns  = []
+    start = 0
+    while start < len(frames):
+      # fill chunk up to controller buffer size
+      rtrn_size = 0
+      stop = start
+      while stop < len(frames):
+        size = max(offsets[stop+1]-offsets[start], rtrn_size+rtrn_sizes[stop])
+        if stop > start and size > api.BUFFER_SIZE: break
+        rtrn_size += rtrn_sizes[stop]
+        stop += 1
+      chunk = encoded[offsets[start]:offsets[stop]]
+      if api.write_behind and rtrn_size == (stop-start)*api.RTRN_SIZE[api.CTRL_WRITE]:
+        api.__defer__(chunk, [(address, data) for [ctrl, address, data] in frames[start:stop]])
+        start = stop
+        continue
+      # responses of outstanding writes precede the responses to this chunk
+      api.flush()
+      reads = ctrls[start:stop].count(ord(api.CTRL_READ))
+      for attempt in range(api.retries+1):
+        seqs = [api.__sent__(ctrl, address, data) for [ctrl, address, data] in frames[start:stop]]
+        api.__wait__({ord(api.CTRL_READ) : reads, ord(api.CTRL_WRITE) : stop-start-reads})
+        sent = time.time()
+        api.port.write(chunk)
+        read_array = api.port.read(rtrn_size)
+        # each frame accounts for its share of the chunk round trip
+        latency = (time.time()-sent)/(stop-start)
+        if len(read_array) == rtrn_size: break
+        for idx in range(start, stop):
+          api.__received__(seqs[idx-start], frames[idx][0], frames[idx][1], frames[idx][2], None)
+        if attempt >= api.retries:
+          self.__parse__(frames, ctrls, chunks, rtrns)
+          # controller state is unknown after a partial response
+          api.invalidate()
+          raise LinkError('Error', 'Could not complete batch transaction:\n Expected %d bytes from serial port, received %d' % (rtrn_size, len(read_array)))
+        # the chunk only contains register reads and writes, which are safe to repeat
+        api.stats.retries += 1
+        api.resync()
+      chunks.append((start, stop, seqs, latency))
+      rtrns.append(read_array)
+      start = stop
+    self.__parse__(frames, ctrls, chunks, rtrns)
+    if raise_errors and self.errors:
+      msg = 'Batch transaction failed on %d of %d frames:' % (len(self.errors), len(frames))
+      for [idx, address, data, rtrn_val] in self.errors:
+        if data is None:
+          msg += '\n Frame %d, read address 0x%04x: %s' % (idx, address, api.__rtrn_msg__(rtrn_val))
+        else:
+          msg += '\n Frame %d, write address 0x%04x data 0x%08x: %s' % (idx, address, data, api.__rtrn_msg__(rtrn_val))
+      raise DeviceError('Error', msg)
+    return self.results
+
 if __name__ == '__main__':
 
   parser = OptionParser(version="%prog 0.1")
@@ -161,10 +748,20 @@ if __name__ == '__main__':
                     dest='baudrate',
                     default=115200,
                     help='Set serial port baudrate, default is \'%default\'.')
+  parser.add_option('--probe',
+                    action='store_true',
+                    dest='probe',
+                    default=False,
+                    help='Probe candidate baudrates and remember the fastest working baudrate of the port.')
   (opts, args) = parser.parse_args()
 
   # Set up serial comms
   mts = MTSAPI(port=opts.tty, baudrate=int(opts.baudrate))
+  if opts.probe:
+    results = mts.probe_baudrate()
+    for rate in sorted(results.keys()):
+      print '%8d baud: %8.1f transactions/second, %d errors' % ((rate,) + results[rate])
+    print 'Selected %d baud' % mts.port.baudrate
   try:
     mts.ping()
   except DeviceError as de:
@@ -0,0 +1,212 @@
+#!/usr/bin/python
+
+from optparse import OptionParser
+import ctypes, struct, sys, time
+
+## Capture of MTS controller serial transactions to a compact binary file, and replay of a captured session
+#  Every frame sent to and received from the controller is stored as a fixed size record:
+#    timestamp (s), frame sequence number, direction, control sequence, address, data, return value
+
+MAGIC    = 'MTSCAP'
+VERSION  = 1
+HEADER   = struct.Struct('<6sB')
+RECORD   = struct.Struct('<dIBBHIB')
+# Record directions
+SENT     = 0
+RECEIVED = 1
+# Control sequences
+CTRL_PING  = 0x08
+CTRL_READ  = 0x01
+CTRL_WRITE = 0x02
+FRAME_SIZE = { CTRL_PING : 1, CTRL_READ : 3, CTRL_WRITE : 7 }
+
+# clock_gettime clock id of the Linux monotonic clock, and the libraries providing clock_gettime
+CLOCK_MONOTONIC = 1
+LIBRT           = ['librt.so.1', 'libc.so.6']
+
+class timespec(ctypes.Structure):
+  _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+def monotonic_clock():
+  """
+  Find a monotonic clock, so that capture timestamps do not step with wall-clock corrections:
+  time.monotonic on Python 3, else clock_gettime(CLOCK_MONOTONIC) through ctypes on Linux.
+  Elsewhere the wall clock is the fallback and timestamps may step.
+
+  @return Function: Clock returning seconds as a float
+  """
+  if hasattr(time, 'monotonic'): return time.monotonic
+  for name in LIBRT:
+    try:
+      clock_gettime = ctypes.CDLL(name, use_errno=True).clock_gettime
+    except (OSError, AttributeError):
+      continue
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+    def clock():
+      ts = timespec()
+      if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(ts)) != 0:
+        raise OSError(ctypes.get_errno(), 'clock_gettime failed')
+      return ts.tv_sec + ts.tv_nsec*1e-9
+    try:
+      clock()
+    except OSError:
+      continue
+    return clock
+  return time.time
+
+clock = monotonic_clock()
+
+class MTSCapture:
+  """
+  Record controller transactions to a capture file
+
+  @param filename String: Name of capture file to create
+
+  @return      Handle: Handle to capture object
+  """
+  def __init__(self, filename):
+    self.filename = filename
+    self.fout = open(filename, 'wb')
+    self.fout.write(HEADER.pack(MAGIC, VERSION))
+    self.start = clock()
+
+  def record(self, seq, direction, ctrl, address=0, data=0, status=0):
+    """
+    Write a frame record
+
+    @param seq       Integer: Frame sequence number, pairing a received response with the frame sent
+    @param direction Integer: SENT or RECEIVED
+    @param ctrl      Integer: Control sequence of the frame
+    @param address   Integer: Register address
+    @param data      Integer: Data written or read
+    @param status    Integer: Controller return value of a received frame
+    """
+    self.fout.write(RECORD.pack(clock()-self.start, seq & 0xFFFFFFFF, direction, ctrl, address, data or 0, status))
+
+  def close(self):
+    """Close capture file"""
+    self.fout.close()
+
+def read_capture(filename):
+  """
+  Read all records from a capture file
+
+  @param filename String: Name of capture file
+
+  @return List: (timestamp, seq, direction, ctrl, address, data, status) records
+  """
+  fin = open(filename, 'rb')
+  try:
+    [magic, version] = HEADER.unpack(fin.read(HEADER.size))
+    if magic != MAGIC or version != VERSION:
+      raise RuntimeError('%s is not a MTS capture file version %d' % (filename, VERSION))
+    buf = fin.read()
+  finally:
+    fin.close()
+  nr_records = len(buf) // RECORD.size
+  return [RECORD.unpack_from(buf, idx*RECORD.size) for idx in range(nr_records)]
+
+class MTSReplay:
+  """
+  Serial port replacement serving the controller responses of a captured session.
+  Pass the replay object as port to MTSAPI or MTS to run the MTS interface without hardware.
+
+  @param filename String: Name of capture file to replay
+  @param strict   Boolean: [Optional] Raise an error when a frame sent differs from the captured frame
+  @param realtime Boolean: [Optional] Delay responses to reproduce the captured timing, default is to replay at full speed
+
+  @return      Handle: Handle to replay object that behaves as a serial port
+  """
+  def __init__(self, filename, strict=True, realtime=False):
+    self.name = filename
+    self.strict = strict
+    self.realtime = realtime
+    self.timeout = 1
+    self.baudrate = None
+    self.sent = []
+    self.received = {}
+    for record in read_capture(filename):
+      if record[2] == SENT: self.sent.append(record)
+      else: self.received[record[1]] = record
+    self.idx = 0
+    self.buf = bytearray()
+    self.rtrn = bytearray()
+    self.start = clock()
+
+  def isOpen(self):
+    return True
+  def open(self):
+    pass
+  def close(self):
+    pass
+  def flushInput(self):
+    self.rtrn = bytearray()
+  def flushOutput(self):
+    pass
+  def inWaiting(self):
+    return len(self.rtrn)
+
+  def write(self, data):
+    """Match frames sent against the captured session and queue the captured responses"""
+    self.buf.extend(bytearray(data))
+    while self.buf and FRAME_SIZE.has_key(self.buf[0]) and len(self.buf) >= FRAME_SIZE[self.buf[0]]:
+      frame = self.buf[:FRAME_SIZE[self.buf[0]]]
+      del self.buf[:len(frame)]
+      [ctrl, address, value] = [frame[0], 0, 0]
+      if len(frame) > 1: address = frame[1] | (frame[2] << 8)
+      if len(frame) > 3: value = frame[3] | (frame[4] << 8) | (frame[5] << 16) | (frame[6] << 24)
+      if self.idx >= len(self.sent):
+        raise RuntimeError('Replay of %s exhausted after %d frames' % (self.name, self.idx))
+      [timestamp, seq, direction, cap_ctrl, cap_address, cap_data, status] = self.sent[self.idx]
+      self.idx += 1
+      if self.strict and (ctrl, address, value) != (cap_ctrl, cap_address, cap_data):
+        raise RuntimeError('Replay diverged from %s at frame %d:\n sent ctrl 0x%02x address 0x%04x data 0x%08x, captured ctrl 0x%02x address 0x%04x data 0x%08x'
+                           % (self.name, self.idx-1, ctrl, address, value, cap_ctrl, cap_address, cap_data))
+      if not self.received.has_key(seq): continue # no response was captured
+      [timestamp, seq, direction, cap_ctrl, cap_address, cap_data, status] = self.received[seq]
+      if self.realtime and timestamp > (clock()-self.start): time.sleep(timestamp-(clock()-self.start))
+      self.rtrn.append(status)
+      if cap_ctrl == CTRL_READ:
+        self.rtrn.extend(struct.pack('<I', cap_data))
+    if self.buf and not FRAME_SIZE.has_key(self.buf[0]):
+      raise RuntimeError('Replay received unknown control sequence 0x%02x' % self.buf[0])
+    return len(data)
+
+  def read(self, size=1):
+    """Return captured response bytes"""
+    data = str(self.rtrn[:size])
+    del self.rtrn[:size]
+    return data
+
+if __name__ == '__main__':
+
+  parser = OptionParser(usage="%prog [options] capture_file [capture_file]", version="%prog 0.1")
+  parser.add_option('-n', '--count',
+                    action='store',
+                    dest='count',
+                    default=10,
+                    type=int,
+                    help='Number of differences to list when comparing 2 captures, default is \'%default\'.')
+  (opts, args) = parser.parse_args()
+  if len(args) not in [1, 2]:
+    parser.print_help()
+    sys.exit(1)
+
+  names = { CTRL_PING : 'ping', CTRL_READ : 'read', CTRL_WRITE : 'write' }
+  if len(args) == 1:
+    # dump the transaction stream
+    for [timestamp, seq, direction, ctrl, address, data, status] in read_capture(args[0]):
+      print '%12.6f %8d %s %-5s 0x%04x 0x%08x 0x%02x' % (timestamp, seq, '><'[direction], names.get(ctrl, hex(ctrl)), address, data, status)
+  else:
+    # compare the frames sent in 2 sessions
+    [first, second] = [[record[3:6] for record in read_capture(name) if record[2] == SENT] for name in args]
+    print '%s: %d frames, %s: %d frames' % (args[0], len(first), args[1], len(second))
+    count = 0
+    for idx in range(max(len(first), len(second))):
+      if idx < len(first) and idx < len(second) and first[idx] == second[idx]: continue
+      print 'frame %d:' % idx, first[idx:idx+1], second[idx:idx+1]
+      count += 1
+      if count >= opts.count: break
+
+# -fin-
+
@@ -0,0 +1,125 @@
+#!/usr/bin/python
+
+import numpy
+import struct
+
+## Encoding of MTS controller frames and decoding of controller responses
+#  Frames are the control sequence, the 16 bit register address and, for writes, the 32 bit data
+#  Responses are the return value and, for reads, the 32 bit data
+#  All fields are little-endian
+
+CTRL_PING  = 0x08
+CTRL_READ  = 0x01
+CTRL_WRITE = 0x02
+# Frame and response layouts of each control sequence
+FRAMES = { CTRL_PING : struct.Struct('<B'), CTRL_READ : struct.Struct('<BH'), CTRL_WRITE : struct.Struct('<BHI') }
+RTRNS  = { CTRL_PING : struct.Struct('<B'), CTRL_READ : struct.Struct('<BI'), CTRL_WRITE : struct.Struct('<B') }
+# Frame and response sizes indexed by control sequence
+FRAME_SIZES = numpy.zeros(256, dtype=numpy.int64)
+RTRN_SIZES  = numpy.zeros(256, dtype=numpy.int64)
+for ctrl in FRAMES.keys():
+  FRAME_SIZES[ctrl] = FRAMES[ctrl].size
+  RTRN_SIZES[ctrl]  = RTRNS[ctrl].size
+
+class MTSCodec:
+  """
+  Encode single frames and decode single responses using buffers allocated once per control sequence.
+  A buffer is reused by the next call for the same control sequence.
+
+  @return      Handle: Handle to codec object
+  """
+  def __init__(self):
+    self.frames = dict([(chr(ctrl), (FRAMES[ctrl], bytearray(FRAMES[ctrl].size))) for ctrl in FRAMES.keys()])
+    self.rtrns  = dict([(chr(ctrl), (RTRNS[ctrl], bytearray(RTRNS[ctrl].size))) for ctrl in RTRNS.keys()])
+
+  def encode(self, ctrl, address=0, data=0):
+    """
+    Pack a frame into the preallocated frame buffer
+
+    @param ctrl    String: Control sequence
+    @param address Integer: Register address
+    @param data    Integer: [Optional] Data to write to register
+
+    @return Bytearray: Frame buffer
+    """
+    [fmt, buf] = self.frames[ctrl]
+    ctrl = ord(ctrl)
+    if ctrl == CTRL_WRITE: fmt.pack_into(buf, 0, ctrl, address, data)
+    elif ctrl == CTRL_READ: fmt.pack_into(buf, 0, ctrl, address)
+    else: fmt.pack_into(buf, 0, ctrl)
+    return buf
+
+  def receive(self, port, ctrl):
+    """
+    Read the response to a frame from the serial port into the preallocated response buffer
+
+    @param port Object: Serial port
+    @param ctrl String: Control sequence of the frame sent
+
+    @return Integer: Number of bytes received
+    """
+    buf = self.rtrns[ctrl][1]
+    if hasattr(port, 'readinto'): return port.readinto(buf)
+    data = port.read(len(buf))
+    buf[:len(data)] = data
+    return len(data)
+
+  def decode(self, ctrl):
+    """
+    Unpack the response in the response buffer
+
+    @param ctrl String: Control sequence of the frame sent
+
+    @return Tuple: (return value, data read or None)
+    """
+    [fmt, buf] = self.rtrns[ctrl]
+    if ord(ctrl) == CTRL_READ: return fmt.unpack_from(buf)
+    return (buf[0], None)
+
+def encode_frames(ctrls, addresses, data):
+  """
+  Encode an array of frames in one pass
+
+  @param ctrls     List: Control sequence (integer) of each frame
+  @param addresses List: Register address of each frame
+  @param data      List: Data of each write frame, ignored for other frames
+
+  @return Tuple: (Bytearray frames, Array offset of each frame and the total size)
+  """
+  ctrls = numpy.asarray(ctrls, dtype=numpy.uint8)
+  offsets = numpy.zeros(len(ctrls)+1, dtype=numpy.int64)
+  numpy.cumsum(FRAME_SIZES[ctrls], out=offsets[1:])
+  start = offsets[:-1]
+  buf = numpy.zeros(offsets[-1], dtype=numpy.uint8)
+  buf[start] = ctrls
+  addressed = ctrls != CTRL_PING
+  addresses = numpy.asarray(addresses, dtype=numpy.uint32)[addressed]
+  buf[start[addressed]+1] = addresses & 0xFF
+  buf[start[addressed]+2] = (addresses >> 8) & 0xFF
+  writes = ctrls == CTRL_WRITE
+  data = numpy.asarray(data, dtype=numpy.uint32)[writes]
+  for byte in range(0,4):
+    buf[start[writes]+byte+3] = (data >> (byte*8)) & 0xFF
+  return bytearray(buf.tostring()), offsets
+
+def decode_responses(rtrn, ctrls):
+  """
+  Decode the responses to an array of frames in one pass
+
+  @param rtrn  String: Response bytes read from the serial port
+  @param ctrls List: Control sequence (integer) of each frame sent
+
+  @return Tuple: (List return values, List data read, 0 for frames other than reads)
+  """
+  ctrls = numpy.asarray(ctrls, dtype=numpy.uint8)
+  offsets = numpy.zeros(len(ctrls), dtype=numpy.int64)
+  numpy.cumsum(RTRN_SIZES[ctrls][:-1], out=offsets[1:])
+  buf = numpy.frombuffer(str(rtrn), dtype=numpy.uint8)
+  # int64 values convert to plain integers
+  values = numpy.zeros(len(ctrls), dtype=numpy.int64)
+  reads = ctrls == CTRL_READ
+  for byte in range(0,4):
+    values[reads] |= buf[offsets[reads]+byte+1].astype(numpy.int64) << (byte*8)
+  return buf[offsets].tolist(), values.tolist()
+
+# -fin-
@@ -13,5 +13,9 @@ class conf:
     return int(self.get_param(section, parameter))
   def get_str(self, section, parameter):
     return self.get_param(section, parameter).strip('\'')
+  def sections(self):
+    return list(self.cp)
+  def options(self, section):
+    return list(self.cp[section])
 
 # -fin-
@@ -0,0 +1,221 @@
+#!/usr/bin/python
+
+from optparse import OptionParser
+from mts_api import DeviceError
+import json, os, socket, SocketServer, stat, sys
+
+## MTS daemon holding the controller and Valon ports open, and the client library to access it
+#  Requests and replies are single line JSON objects on a Unix domain socket:
+#    {"op": "set_noise", "args": ["comb1"], "kwargs": {"uncorr_pwr": -27}}
+#    {"op": "set_noise_atten", "module": "ucs1", "kwargs": {"atten": 10}}
+#  The reply is {"result": ...} or {"error": message, "type": exception name, "level": DeviceError level}
+
+SOCKET = '/tmp/mts_daemon.sock'
+# Permissions of the socket: clients of the owner and group of the daemon only
+MODE   = 0660
+# Operations available to clients
+MTS_OPS = ['set_noise', 'get_noise', 'disable_noise', 'set_cw', 'get_cw', 'disable_cw', 'get_freq', 'set_freq']
+MOD_OPS = ['apply', 'cw_source', 'noise_source', 'power_temp_sensor', 'cw_output', 'noise_output',
+           'set_cw_atten', 'get_cw_atten', 'set_noise_atten', 'get_noise_atten', 'set_comb_atten', 'get_comb_atten',
+           'get_environment', 'get_power', 'get_temperature', 'get_freq', 'set_freq']
+
+def encode_value(obj):
+  # numpy values
+  if hasattr(obj, 'tolist'): return obj.tolist()
+  raise TypeError('%r is not JSON serializable' % obj)
+
+class MTSRequestHandler(SocketServer.StreamRequestHandler):
+  """Execute the requests of a client connection, one JSON line per request"""
+  def handle(self):
+    for line in iter(self.rfile.readline, ''):
+      try:
+        request = json.loads(line)
+        reply = {'result' : self.server.execute(request.get('op'), request.get('module'), request.get('args', []), request.get('kwargs', {}))}
+      except Exception as e:
+        reply = {'error' : str(e), 'type' : type(e).__name__}
+        if isinstance(e, DeviceError): reply.update({'error' : e.msg, 'level' : e.level})
+      self.wfile.write(json.dumps(reply, default=encode_value) + '\n')
+      self.wfile.flush()
+
+class MTSDaemon(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+  """
+  Serve MTS operations to clients on a Unix domain socket.
+  The MTS worker thread executes the operations of concurrent clients one at a time.
+
+  @param mts_obj Object: Initiated MTS object
+  @param path    String: [Optional] Unix domain socket to listen on
+  @param mode    Integer: [Optional] Permissions of the socket, connecting requires write permission
+
+  @return      Handle: Handle to daemon object
+  """
+  daemon_threads = True
+
+  def __init__(self, mts_obj, path=SOCKET, mode=MODE):
+    self.mts = mts_obj
+    self.path = path
+    self.bound = False
+    if os.path.exists(path): self.__remove_stale__(path)
+    self.mts.start_worker()
+    # create the socket without permissions for other users, instead of changing them after it was bound
+    umask = os.umask(0777 & ~mode)
+    try:
+      SocketServer.UnixStreamServer.__init__(self, path, MTSRequestHandler)
+    finally:
+      os.umask(umask)
+    os.chmod(path, mode)
+
+  def __remove_stale__(self, path):
+    """
+    Remove the socket file left by a daemon that did not shut down cleanly
+
+    @param path String: Unix domain socket
+    """
+    if not stat.S_ISSOCK(os.stat(path).st_mode): raise RuntimeError('%s exists and is not a socket' % path)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+      sock.connect(path)
+    except socket.error:
+      # nothing is listening
+      os.unlink(path)
+      return
+    finally:
+      sock.close()
+    raise RuntimeError('MTS daemon already listening on %s' % path)
+
+  def execute(self, op, module=None, args=[], kwargs={}):
+    """
+    Execute a whitelisted MTS or module operation
+
+    @param op     String: Operation name
+    @param module String: [Optional] Module name, e.g. 'ucs1' or 'comb1', for module operations
+    @param args   List: Positional arguments
+    @param kwargs Dictionary: Keyword arguments
+
+    @return Object: Result of the operation
+    """
+    kwargs = dict([(str(key), value) for [key, value] in kwargs.items()])
+    if op == 'ping': return self.mts.ctrl.ping()
+    if module is None:
+      if op not in MTS_OPS: raise RuntimeError('Unknown MTS operation %s' % op)
+      return getattr(self.mts, op)(*args, **kwargs)
+    if not (self.mts.src_dict.has_key(module) or self.mts.cmb_dict.has_key(module)):
+      raise RuntimeError('Unknown MTS module %s' % module)
+    if op not in MOD_OPS: raise RuntimeError('Unknown module operation %s' % op)
+    return getattr(getattr(self.mts, module), op)(*args, **kwargs)
+
+  def server_bind(self):
+    SocketServer.UnixStreamServer.server_bind(self)
+    self.bound = True
+
+  def server_close(self):
+    SocketServer.UnixStreamServer.server_close(self)
+    # a failed bind must not remove the socket of another daemon
+    if self.bound and os.path.exists(self.path): os.unlink(self.path)
+
+class MTSClient:
+  """
+  Client of the MTS daemon, MTS operations are called as on a MTS object:
+    client.set_noise('comb1', uncorr_pwr=-27)
+    client.module('ucs1').set_noise_atten(atten=10)
+
+  @param path    String: [Optional] Unix domain socket of the daemon
+  @param timeout Float: [Optional] Time (s) to wait for a reply
+
+  @return      Handle: Handle to client object
+  """
+  def __init__(self, path=SOCKET, timeout=60):
+    self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    self.sock.settimeout(timeout)
+    try:
+      self.sock.connect(path)
+    except socket.error as e:
+      self.sock.close()
+      raise RuntimeError('Cannot connect to MTS daemon at %s: %s' % (path, e))
+    self.rfile = self.sock.makefile('rb')
+
+  def close(self):
+    """Close connection to daemon"""
+    self.rfile.close()
+    self.sock.close()
+
+  def call(self, op, module=None, *args, **kwargs):
+    """
+    Execute an operation on the daemon
+
+    @param op     String: Operation name
+    @param module String: [Optional] Module name for module operations
+
+    @return Object: Result of the operation, errors are raised as DeviceError or RuntimeError
+    """
+    request = {'op' : op, 'args' : args, 'kwargs' : kwargs}
+    if module: request['module'] = module
+    self.sock.sendall(json.dumps(request, default=encode_value) + '\n')
+    line = self.rfile.readline()
+    if not line: raise RuntimeError('MTS daemon closed the connection')
+    reply = json.loads(line)
+    if reply.has_key('error'):
+      if reply.has_key('level'): raise DeviceError(reply['level'], reply['error'])
+      raise RuntimeError('%s: %s' % (reply['type'], reply['error']))
+    return reply['result']
+
+  def ping(self):
+    return self.call('ping')
+
+  def module(self, name):
+    """
+    @param name String: Module name, e.g. 'ucs1' or 'comb1'
+
+    @return Object: Proxy calling the module operations on the daemon
+    """
+    return MTSModuleClient(self, name)
+
+  def __getattr__(self, op):
+    if op not in MTS_OPS: raise AttributeError(op)
+    return lambda *args, **kwargs: self.call(op, None, *args, **kwargs)
+
+class MTSModuleClient:
+  """Proxy of a MTS module on the daemon, see MTSClient.module"""
+  def __init__(self, client, name):
+    self.client = client
+    self.name = name
+
+  def __getattr__(self, op):
+    if op not in MOD_OPS: raise AttributeError(op)
+    return lambda *args, **kwargs: self.client.call(op, self.name, *args, **kwargs)
+
+if __name__ == '__main__':
+
+  parser = OptionParser(usage="%prog [options] operation [args] [key=value]", version="%prog 0.1")
+  parser.add_option('-s', '--socket',
+                    action='store',
+                    dest='socket',
+                    default=SOCKET,
+                    help='MTS daemon socket, default is \'%default\'.')
+  parser.add_option('-m', '--module',
+                    action='store',
+                    dest='module',
+                    default=None,
+                    help='Module name for module operations, e.g. \'ucs1\'.')
+  (opts, args) = parser.parse_args()
+  if len(args) < 1:
+    parser.print_help()
+    sys.exit(1)
+
+  # arguments are JSON values, or strings if not valid JSON
+  def value(arg):
+    try:
+      return json.loads(arg)
+    except ValueError:
+      return arg
+  op_args = [value(arg) for arg in args[1:] if '=' not in arg]
+  op_kwargs = dict([(arg.split('=', 1)[0], value(arg.split('=', 1)[1])) for arg in args[1:] if '=' in arg])
+  client = MTSClient(opts.socket)
+  try:
+    print client.call(args[0], opts.module, *op_args, **op_kwargs)
+  except Exception as e:
+    print e
+    sys.exit(1)
+  finally:
+    client.close()
+
+# -fin-
@@ -0,0 +1,288 @@
+#!/usr/bin/python
+
+from optparse import OptionParser
+import os, select, threading, time, tty
+import numpy
+
+## Software emulation of the MTS controller serial interface on a Linux pseudo-terminal
+#  Implements the framing used by MTSAPI and models the module devices addressed through the controller,
+#  to allow the MTSAPI and MTS interfaces to be exercised and benchmarked without the MTS chassis.
+
+class MTSEmulator:
+  """
+  Emulated MTS controller listening on a pseudo-terminal.
+  Register addresses are decoded as generated by MTSAPI.__get_address__, modules 0 to 5 each have a channel select register
+  and device write registers for the AD7888 ADC, MAX7301 GPIO expander and ZX76 attenuators.
+  Combiner power detector conversions are synthesised from the source states and the calibration tables.
+
+  @param latency   Float: [Optional] Delay (s) added before the controller responds to data received
+  @param baudrate  Integer: [Optional] Throttle the byte rate in both directions to that of a serial line at baudrate
+  @param calib_dir String: [Optional] Directory containing the noise and CW calibration tables
+  @param buffer_size Integer: [Optional] Controller input buffer size, frames exceeding it are dropped with a buffer overflow return value
+  @param noise     Float: [Optional] Standard deviation (ADC codes) of noise added to detector conversions
+
+  @return      Handle: Handle to emulator object
+  """
+  # Control sequences
+  CTRL_PING     = 0x08
+  CTRL_READ     = 0x01
+  CTRL_WRITE    = 0x02
+  RTRN_SUCCESS  = 0x01
+  RTRN_OVERFLOW = 0xfd
+  RTRN_BUSERROR = 0xfe
+  RTRN_CMDERROR = 0xff
+  FRAME_SIZE    = { CTRL_PING : 1, CTRL_READ : 3, CTRL_WRITE : 7 }
+
+  # Module registers
+  REG_CHANELSEL = 0
+  REG_AD7888    = 1
+  REG_MAX7301   = 2
+  REG_ZX76      = 3
+  NR_MODULES    = 6
+  # Channel select values of the module devices
+  CHAN_AD7888   = 0
+  CHAN_MAX7301  = 1
+  CHAN_NS_ATTEN = 2
+  CHAN_CW_ATTEN = 3
+  # Strobe bit of each device write register
+  MASK_AD7888   = 0x00010000
+  MASK_MAX7301  = 0x00010000
+  MASK_NS_ATTEN = 0x00000100
+  MASK_CW_ATTEN = 0x01000000
+  # AD7888 input channels of the combiner power detector
+  ADC_POWER     = 1
+  ADC_TEMP      = 6
+  CONV_FACTOR   = 610.351e-6 # V
+  # MAX7301 ports of the source and combiner components
+  PORTS_NS      = [4, 6, 31]
+  PORT_NS_SW    = 5
+  PORT_LOCK     = 7
+  PORTS_CW      = [28, 29]
+  PORT_CW_SW    = 30
+  PORT_PWR_SW   = 28
+  # Source modules connected to each combiner module, uncorrelated source first
+  COMBINERS     = { 4 : [1, 3], 5 : [2, 3] }
+  CORR_SRC      = [3]
+
+  def __init__(self, latency=0., baudrate=None, calib_dir='/etc/mts', buffer_size=None, noise=1.):
+    self.latency = latency
+    self.baudrate = baudrate
+    self.buffer_size = buffer_size
+    self.noise = noise
+    self.temperature = 25. # deg C
+    self.noise_cal = numpy.loadtxt(os.path.join(calib_dir, 'noise_calib_table.data'), delimiter=',', skiprows=1)
+    self.cw_cal = numpy.loadtxt(os.path.join(calib_dir, 'cw_calib_table.data'), delimiter=',', skiprows=1)
+    self.reset()
+    # Set up pseudo-terminal in raw mode, the slave end is the emulated controller port
+    [self.master, self.slave] = os.openpty()
+    tty.setraw(self.slave)
+    tty.setraw(self.master)
+    self.port = os.ttyname(self.slave)
+    self.thread = None
+    self.running = False
+
+  def reset(self):
+    """Power-on state of all module registers and devices"""
+    self.regs = [{} for mod in range(self.NR_MODULES)]
+    self.adc_chan = [0]*self.NR_MODULES
+    self.adc_data = [0]*self.NR_MODULES
+    self.gpio = [[0]*32 for mod in range(self.NR_MODULES)]
+    self.gpio_conf = [{} for mod in range(self.NR_MODULES)]
+    self.gpio_data = [0]*self.NR_MODULES
+    self.ns_atten = [0]*self.NR_MODULES
+    self.cw_atten = [0]*self.NR_MODULES
+    self.frames = 0
+    self.buf = bytearray()
+
+  def start(self):
+    """Start serving the controller protocol in a background thread"""
+    self.running = True
+    self.thread = threading.Thread(target=self.run)
+    self.thread.setDaemon(True)
+    self.thread.start()
+    return self.port
+
+  def stop(self):
+    """Stop the emulator and close the pseudo-terminal"""
+    self.running = False
+    if self.thread: self.thread.join()
+    os.close(self.master)
+    os.close(self.slave)
+
+  def run(self):
+    """Serve frames received on the pseudo-terminal until stopped"""
+    while self.running:
+      [rlist, wlist, xlist] = select.select([self.master], [], [], 0.1)
+      if not rlist: continue
+      try:
+        data = bytearray(os.read(self.master, 4096))
+      except OSError:
+        break
+      if self.baudrate: time.sleep(len(data)*10./self.baudrate)
+      if self.latency: time.sleep(self.latency)
+      rtrn = self.receive(data)
+      if self.baudrate: time.sleep(len(rtrn)*10./self.baudrate)
+      if rtrn: os.write(self.master, str(rtrn))
+
+  def receive(self, data):
+    """
+    Parse received bytes into frames and execute complete frames
+
+    @param data Bytearray: Bytes received from the serial port
+
+    @return Bytearray: Response bytes
+    """
+    rtrn = bytearray()
+    if self.buffer_size is not None and len(self.buf)+len(data) > self.buffer_size:
+      # input exceeding the controller buffer is lost
+      data = data[:max(self.buffer_size-len(self.buf), 0)]
+      rtrn.append(self.RTRN_OVERFLOW)
+    self.buf.extend(data)
+    while self.buf:
+      ctrl = self.buf[0]
+      if not self.FRAME_SIZE.has_key(ctrl):
+        del self.buf[0]
+        rtrn.append(self.RTRN_CMDERROR)
+        continue
+      size = self.FRAME_SIZE[ctrl]
+      if len(self.buf) < size: break
+      frame = self.buf[:size]
+      del self.buf[:size]
+      self.frames += 1
+      if ctrl == self.CTRL_PING:
+        rtrn.append(self.CTRL_PING)
+        continue
+      address = frame[1] | (frame[2] << 8)
+      [mod, reg] = [address >> 12, address & 0xFFF]
+      if mod >= self.NR_MODULES:
+        status = self.RTRN_BUSERROR
+        value = 0
+      elif ctrl == self.CTRL_READ:
+        status = self.RTRN_SUCCESS
+        value = self.read(mod, reg)
+      else:
+        status = self.RTRN_SUCCESS
+        value = frame[3] | (frame[4] << 8) | (frame[5] << 16) | (frame[6] << 24)
+        self.write(mod, reg, value)
+      rtrn.append(status)
+      if ctrl == self.CTRL_READ:
+        for byte in range(0,4):
+          rtrn.append((value >> (byte*8)) & 0xFF)
+    return rtrn
+
+  def read(self, mod, reg):
+    """Value returned for a register read"""
+    if reg == (self.REG_AD7888 | 0x4): return self.adc_data[mod]
+    if reg == (self.REG_MAX7301 | 0x4): return self.gpio_data[mod]
+    return self.regs[mod].get(reg, 0)
+
+  def write(self, mod, reg, value):
+    """Latch a register write and clock device transfers on a rising strobe bit"""
+    prev = self.regs[mod].get(reg, 0)
+    self.regs[mod][reg] = value
+    chan = self.regs[mod].get(self.REG_CHANELSEL, 0)
+    def strobe(mask):
+      return (value & mask) and not (prev & mask)
+    if reg == self.REG_AD7888 and chan == self.CHAN_AD7888 and strobe(self.MASK_AD7888):
+      self.ad7888(mod, value & 0xFFFF)
+    elif reg == self.REG_MAX7301 and chan == self.CHAN_MAX7301 and strobe(self.MASK_MAX7301):
+      self.max7301(mod, value & 0xFFFF)
+    elif reg == self.REG_ZX76 and chan == self.CHAN_NS_ATTEN and strobe(self.MASK_NS_ATTEN):
+      self.ns_atten[mod] = value & 0xFF
+    elif reg == self.REG_ZX76 and chan == self.CHAN_CW_ATTEN and strobe(self.MASK_CW_ATTEN):
+      self.cw_atten[mod] = (value >> 16) & 0xFF
+
+  def ad7888(self, mod, cmd):
+    """AD7888 transfer: returns the conversion of the channel selected in the previous transfer"""
+    self.adc_data[mod] = self.convert(mod, self.adc_chan[mod])
+    self.adc_chan[mod] = (cmd >> 11) & 0x7
+
+  def max7301(self, mod, cmd):
+    """
+    MAX7301 transfer: command register address in the upper byte and data in the lower byte.
+    Ports 4 to 31 exist, registers 0x40-0x43 address ports 4 up to port 7-10 and registers 0x44-0x5F
+    address up to 8 ports from port addr-0x40, data bit 0 being the first port.
+    """
+    [addr, data] = [(cmd >> 8) & 0x7F, cmd & 0xFF]
+    ports = self.gpio[mod]
+    if 0x40 <= addr <= 0x43: multiple = range(4, addr-0x40+8)
+    else: multiple = range(addr-0x40, min(addr-0x40+8, 32))
+    if cmd & 0x8000:
+      # read command
+      if 0x24 <= addr <= 0x3F: self.gpio_data[mod] = ports[addr-0x20]
+      elif 0x40 <= addr <= 0x5F:
+        self.gpio_data[mod] = sum([ports[multiple[bit]] << bit for bit in range(len(multiple))])
+      else: self.gpio_data[mod] = self.gpio_conf[mod].get(addr, 0)
+    elif 0x24 <= addr <= 0x3F:
+      ports[addr-0x20] = data & 0x1
+    elif 0x40 <= addr <= 0x5F:
+      for bit in range(len(multiple)): ports[multiple[bit]] = (data >> bit) & 0x1
+    elif 0x20 <= addr <= 0x23:
+      # ports 0-3 do not exist
+      pass
+    else:
+      self.gpio_conf[mod][addr] = data
+    # lock detect input follows the valon
+    ports[self.PORT_LOCK] = 1
+
+  def power(self, mod):
+    """Detector power (dBm) at a combiner output from all enabled source signal paths"""
+    paths = []
+    comb_atten = self.ns_atten[mod]/2.
+    for src in self.COMBINERS[mod]:
+      ports = self.gpio[src]
+      col = 4 if src in self.CORR_SRC else 2
+      if min([ports[port] for port in self.PORTS_NS]) and not ports[self.PORT_NS_SW]:
+        paths.append(numpy.interp(self.ns_atten[src]/2.+comb_atten, self.noise_cal[:,0], self.noise_cal[:,col]))
+      if min([ports[port] for port in self.PORTS_CW]) and not ports[self.PORT_CW_SW]:
+        paths.append(numpy.interp(self.cw_atten[src]/2.+comb_atten, self.cw_cal[:,0], self.cw_cal[:,col]))
+    if not paths: return None
+    return 10.*numpy.log10(numpy.sum(10.**(numpy.array(paths)/10.)))
+
+  def convert(self, mod, chan):
+    """AD7888 conversion code for an input channel"""
+    if mod in self.COMBINERS and chan == self.ADC_POWER and self.gpio[mod][self.PORT_PWR_SW]:
+      pwr = self.power(mod)
+      order = numpy.argsort(self.noise_cal[:,2])
+      if pwr is None: volt = self.noise_cal[:,1].max()
+      else: volt = numpy.interp(pwr, self.noise_cal[order,2], self.noise_cal[order,1])
+    elif chan == self.ADC_TEMP:
+      volt = 0.57 + 0.002*(self.temperature-25.)
+    else:
+      volt = 0.
+    code = volt/self.CONV_FACTOR + numpy.random.normal(0., self.noise)
+    return int(min(max(round(code), 0), 0xFFF))
+
+if __name__ == '__main__':
+
+  parser = OptionParser(version="%prog 0.1")
+  parser.add_option('-l', '--latency',
+                    action='store',
+                    dest='latency',
+                    default=0.,
+                    type=float,
+                    help='Response latency in seconds, default is \'%default\'.')
+  parser.add_option('-b', '--baud',
+                    action='store',
+                    dest='baudrate',
+                    default=None,
+                    type=int,
+                    help='Throttle to serial line baudrate, default is no throttling.')
+  parser.add_option('-c', '--calib',
+                    action='store',
+                    dest='calib_dir',
+                    default='/etc/mts',
+                    help='Directory containing calibration tables, default is \'%default\'.')
+  (opts, args) = parser.parse_args()
+
+  emulator = MTSEmulator(latency=opts.latency, baudrate=opts.baudrate, calib_dir=opts.calib_dir)
+  print 'Emulated MTS controller on %s' % emulator.start()
+  try:
+    while True: time.sleep(1)
+  except KeyboardInterrupt:
+    pass
+  emulator.stop()
+  print 'Served %d frames' % emulator.frames
+
+# -fin-
+
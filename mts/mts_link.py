@@ -0,0 +1,90 @@
+#!/usr/bin/python
+
+import array, fcntl, json, os
+
+## Serial link settings: Linux low latency mode and the per port link cache
+#  The link cache remembers settings found for a serial port, such as the best working baudrate,
+#  so that the next session can start with them
+
+LINK_CACHE = os.path.expanduser('~/.mts/link_cache')
+# Linux serial ioctls and the low latency flag of struct serial_struct
+TIOCGSERIAL       = 0x541E
+TIOCSSERIAL       = 0x541F
+ASYNC_LOW_LATENCY = 1 << 13
+
+def set_low_latency(port):
+  """
+  Best effort configuration of a serial port for low latency:
+  the driver low latency flag and, for FTDI bridges, a 1 ms receive latency timer
+
+  @param port Object: Open serial port
+
+  @return Boolean: True if any low latency setting was applied
+  """
+  applied = False
+  try:
+    if hasattr(port, 'set_low_latency_mode'):
+      port.set_low_latency_mode(True)
+    else:
+      # flags is the 5th integer of struct serial_struct
+      buf = array.array('i', [0]*32)
+      fcntl.ioctl(port.fileno(), TIOCGSERIAL, buf)
+      buf[4] |= ASYNC_LOW_LATENCY
+      fcntl.ioctl(port.fileno(), TIOCSSERIAL, buf)
+    applied = True
+  except Exception:
+    pass # not a Linux serial driver
+  try:
+    timer = '/sys/bus/usb-serial/devices/%s/latency_timer' % os.path.basename(os.path.realpath(port.name))
+    if os.path.exists(timer):
+      fout = open(timer, 'w')
+      try:
+        fout.write('1')
+      finally:
+        fout.close()
+      applied = True
+  except (AttributeError, IOError, OSError):
+    pass # requires write access to sysfs
+  return applied
+
+def read_link_cache(port=None, cache=LINK_CACHE):
+  """
+  Read the link cache
+
+  @param port  String: [Optional] Serial port name
+  @param cache String: [Optional] Link cache file
+
+  @return Dictionary: Settings of the port, or the settings of all ports if no port is specified
+  """
+  try:
+    fin = open(cache)
+    try:
+      links = json.load(fin)
+    finally:
+      fin.close()
+  except (IOError, ValueError):
+    links = {}
+  if port is None: return links
+  return links.get(port, {})
+
+def write_link_cache(port, cache=LINK_CACHE, **settings):
+  """
+  Update the settings of a port in the link cache
+
+  @param port     String: Serial port name
+  @param cache    String: [Optional] Link cache file
+  @param settings Dictionary: Settings to store, e.g. baudrate=115200
+  """
+  links = read_link_cache(cache=cache)
+  links.setdefault(port, {}).update(settings)
+  try:
+    if not os.path.isdir(os.path.dirname(cache)): os.makedirs(os.path.dirname(cache))
+    fout = open(cache, 'w')
+    try:
+      json.dump(links, fout, indent=2, sort_keys=True)
+    finally:
+      fout.close()
+  except (IOError, OSError) as e:
+    print 'Could not update link cache %s: %s' % (cache, e)
+
+# -fin-
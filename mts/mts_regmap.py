@@ -0,0 +1,286 @@
+#!/usr/bin/python
+
+from optparse import OptionParser
+import copy, os
+import mts_config
+
+## Register map compiler
+#  The device and component tables describe how every module device and component is addressed:
+#  the channel selected in reg_chanelsel, the write register and the command words strobed into it.
+#  The compiler turns the tables into flat per module tables of (address, data) frame sequences,
+#  one sequence per device init, component state and attenuator step, so that module operations are table lookups.
+
+REGMAP = '/etc/mts/mts_register_map'
+# Module registers
+REG_CHANSEL = 0
+READ_OFFSET = 0x4
+# MAX7301 GPIO expander: single port and multiple port write commands, the ports available,
+# the port configuration registers with 2 bits for each of 4 ports, starting at ports 4-7, and the configuration of an output port
+MAX7301          = 'max7301'
+MAX7301_PORT     = 0x20
+MAX7301_PORTS8   = 0x40
+MAX7301_FIRST    = 4
+MAX7301_LAST     = 31
+MAX7301_CONF     = [0x09, 0x0f]
+MAX7301_OUTPUT   = 0x1
+# Keys required for every device and component
+DEVICE_KEYS    = ['channel', 'register', 'init', 'set_mask']
+COMPONENT_KEYS = ['channel', 'register', 'cmd', 'set_mask']
+
+def max7301_ports(reg):
+  """
+  Ports covered by a MAX7301 multiple port register, data bit 0 is the first port.
+  Registers 0x40-0x43 cover ports 4 up to port 7-10, registers 0x44-0x5F cover 8 ports starting at port reg-0x40,
+  limited to port 31.
+
+  @param reg Integer: MAX7301 command register address, 0x40 to 0x5F
+
+  @return List: Ports, in data bit order
+  """
+  first = reg-MAX7301_PORTS8
+  if first < MAX7301_FIRST: return range(MAX7301_FIRST, first+8)
+  return range(first, min(first+8, MAX7301_LAST+1))
+
+def get_address(mod, reg, read=False):
+  """
+  Register address of a module register, see MTSAPI.__get_address__
+
+  @param mod  Integer: MTS module to address
+  @param reg  Integer: Relevant module register
+  @param read Boolean: [Optional] True returns the relevant 'read' register address
+
+  @return Integer: Register address
+  """
+  return ((mod << 12) | reg) | read << 2
+
+class MTSModuleMap:
+  """
+  Compiled register map of a single module
+
+  @param regmap Object: MTSRegisterMap the module map is compiled from
+  @param module Integer: MTS module number
+
+  @return      Handle: Handle to module map object
+  """
+  def __init__(self, regmap, module):
+    self.module = module
+    # reg_chanelsel of the module and of module 0, which selects the valon of a module
+    self.chansel = get_address(module, REG_CHANSEL)
+    self.select_valon = ((get_address(0, REG_CHANSEL), module),)
+    # device register addresses
+    self.write = {}
+    self.read  = {}
+    for spec in regmap.device.values() + regmap.component.values():
+      self.write[spec['register']] = get_address(module, spec['register'])
+      self.read[spec['register']]  = get_address(module, spec['register'], read=True)
+    # init sequence of each device
+    self.init = {}
+    for [name, dev] in regmap.device.items():
+      self.init[name] = self.__strobe__(dev, dev['init'])
+    # frame sequences of each component state, indexed by the enable setting
+    self.strobe = {}
+    # frame sequences of each attenuator step
+    self.atten = {}
+    for [name, comp] in regmap.component.items():
+      if comp['cmd']:
+        self.strobe[name] = tuple([self.__strobe__(comp, [cmd | setting for cmd in comp['cmd']]) for setting in [0, 1]])
+      if comp.has_key('shift'):
+        steps = comp['set_mask'] >> comp['shift']
+        self.atten[name] = tuple([self.__strobe__(comp, [step << comp['shift']]) for step in range(steps)])
+    # MAX7301 ports configured as outputs by the init sequence, and the ports of components switched by single port commands
+    self.max7301 = regmap.device.get(MAX7301)
+    self.outputs = []
+    self.gpio = {}
+    if self.max7301:
+      for cmd in self.max7301['init']:
+        if MAX7301_CONF[0] <= cmd >> 8 <= MAX7301_CONF[1]:
+          first = 4*((cmd >> 8)-MAX7301_CONF[0]+1)
+          self.outputs += [first+idx for idx in range(4) if (cmd >> 2*idx) & 0x3 == MAX7301_OUTPUT]
+      for [name, comp] in regmap.component.items():
+        if (comp['channel'], comp['register']) != (self.max7301['channel'], self.max7301['register']): continue
+        ports = [(cmd >> 8)-MAX7301_PORT for cmd in comp['cmd']]
+        if ports and min(ports) >= MAX7301_FIRST and max(ports) <= MAX7301_LAST: self.gpio[name] = ports
+
+  def __strobe__(self, spec, cmds):
+    """
+    Frame sequence selecting a device and strobing commands into its write register
+
+    @param spec Dictionary: Device or component description
+    @param cmds List: Command words
+
+    @return Tuple: (address, data) frames to write in sequence
+    """
+    frames = [(self.chansel, spec['channel'])]
+    addr = self.write[spec['register']]
+    for cmd in cmds:
+      frames.append((addr, spec['set_mask'] | cmd))
+      frames.append((addr, cmd))
+    return tuple(frames)
+
+  def gpio_frames(self, levels, known={}):
+    """
+    Frame sequence setting MAX7301 ports. Ports are folded into multiple port writes wherever the levels of
+    all other output ports covered by the write are known, else they are set with single port writes.
+    Of the writes covering the most ports to set, the one rewriting the fewest other output ports,
+    and then covering the fewest ports, is used. Writes to input and unconfigured ports have no effect.
+
+    @param levels Dictionary: Level to set for each port
+    @param known  Dictionary: [Optional] Level known to be set for each port, e.g. the port shadow of the module
+
+    @return Tuple: (address, data) frames setting the ports
+    """
+    known = dict(known)
+    known.update(levels)
+    pending = sorted(levels.keys())
+    cmds = []
+    while pending:
+      first = pending[0]
+      [best, covered, rewritten, size] = [None, [first], 0, 1]
+      for reg in range(MAX7301_PORTS8, MAX7301_PORTS8+MAX7301_LAST+1):
+        ports = max7301_ports(reg)
+        if first not in ports: continue
+        if [port for port in ports if port in self.outputs and not known.has_key(port)]: continue
+        ports_set = [port for port in pending if port in ports]
+        ports_rewritten = len([port for port in ports if port in self.outputs and port not in ports_set])
+        if (len(ports_set), -ports_rewritten, -len(ports)) > (len(covered), -rewritten, -size):
+          [best, covered, rewritten, size] = [reg, ports_set, ports_rewritten, len(ports)]
+      if best is None: cmds.append(((MAX7301_PORT+first) << 8) | levels[first])
+      else:
+        ports = max7301_ports(best)
+        cmds.append((best << 8) | sum([known.get(ports[bit], 0) << bit for bit in range(len(ports))]))
+      pending = [port for port in pending if port not in covered]
+    return self.__strobe__(self.max7301, cmds)
+
+  def atten_frames(self, name, atten):
+    """
+    @param name  String: Attenuator component, e.g. 'ns_atten'
+    @param atten Float: Attenuation (dB), in 0.5 dB steps
+
+    @return Tuple: (address, data) frames setting the attenuator
+    """
+    step = int(atten*2)
+    if step < 0 or step >= len(self.atten[name]): raise RuntimeError('Attenuation %s dB out of range for %s' % (atten, name))
+    return self.atten[name][step]
+
+class MTSRegisterMap:
+  """
+  Validated device and component tables, loaded from a register map file or given as dictionaries.
+  Compiled module maps are cached, see module.
+
+  @param device    Dictionary: Device descriptions: channel, register, init and set_mask
+  @param component Dictionary: Component descriptions: channel, register, cmd and set_mask,
+                               attenuators have no commands and a shift of the attenuator step in the register
+
+  @return      Handle: Handle to register map object
+  """
+  def __init__(self, device, component):
+    self.device = copy.deepcopy(device)
+    self.component = copy.deepcopy(component)
+    self.modules = {}
+    self.validate()
+
+  def validate(self):
+    """Check the device and component tables, raising a RuntimeError for the first problem found"""
+    for [kind, table, keys] in [('device', self.device, DEVICE_KEYS), ('component', self.component, COMPONENT_KEYS)]:
+      for [name, spec] in table.items():
+        for key in keys:
+          if not spec.has_key(key): raise RuntimeError('Register map %s %s has no %s' % (kind, name, key))
+        if spec['register'] == REG_CHANSEL or not 0 < spec['register'] < READ_OFFSET:
+          raise RuntimeError('Register map %s %s: register %d is not a device write register' % (kind, name, spec['register']))
+        if not spec['set_mask'] or spec['set_mask'] & (spec['set_mask']-1):
+          raise RuntimeError('Register map %s %s: set_mask 0x%x is not a single strobe bit' % (kind, name, spec['set_mask']))
+        for cmd in spec.get('init', []) + spec.get('cmd', []):
+          if cmd & ~(spec['set_mask']-1):
+            raise RuntimeError('Register map %s %s: command 0x%x overlaps the strobe bit' % (kind, name, cmd))
+    for [name, comp] in self.component.items():
+      for cmd in comp['cmd']:
+        if cmd & 0x1: raise RuntimeError('Register map component %s: command 0x%x overlaps the enable bit' % (name, cmd))
+      if comp.has_key('shift') and comp['cmd']:
+        raise RuntimeError('Register map component %s: attenuators have no commands' % name)
+      if not comp.has_key('shift') and not comp['cmd']:
+        raise RuntimeError('Register map component %s has no commands' % name)
+      if comp.has_key('shift') and (comp['set_mask'] >> comp['shift']) < 2:
+        raise RuntimeError('Register map component %s: shift %d leaves no attenuator steps' % (name, comp['shift']))
+
+  def module(self, module):
+    """
+    @param module Integer: MTS module number
+
+    @return Object: MTSModuleMap of the module, compiled on first use
+    """
+    if not self.modules.has_key(module): self.modules[module] = MTSModuleMap(self, module)
+    return self.modules[module]
+
+def read_register_map(regmap_file=REGMAP):
+  """
+  Load a register map file: one section per device or component,
+    [device max7301]                  [component ns_atten]
+    channel  = 1                      channel  = 2
+    register = 2                      register = 3
+    init     = 0x401, 0x9d5           cmd      =
+    set_mask = 0x00010000             set_mask = 0x00000100
+                                      shift    = 0
+
+  @param regmap_file String: [Optional] Register map file
+
+  @return Object: MTSRegisterMap
+  """
+  config = mts_config.conf(regmap_file)
+  tables = {'device' : {}, 'component' : {}}
+  for section in config.sections():
+    try:
+      [kind, name] = section.split()
+    except ValueError:
+      raise RuntimeError('Register map section [%s] is not [device name] or [component name]' % section)
+    if not tables.has_key(kind): raise RuntimeError('Register map section [%s] is not [device name] or [component name]' % section)
+    spec = {}
+    for key in config.options(section):
+      value = config.get_str(section, key)
+      try:
+        if key in ['init', 'cmd']: spec[key] = [int(cmd, 0) for cmd in value.split(',') if cmd.strip()]
+        else: spec[key] = int(value, 0)
+      except ValueError:
+        raise RuntimeError('Register map [%s] %s: %s is not a number' % (section, key, value))
+    tables[kind][name] = spec
+  return MTSRegisterMap(tables['device'], tables['component'])
+
+def load_register_map(regmap_file=REGMAP, device=None, component=None):
+  """
+  Load the register map file if it exists, else build the register map from the built-in tables
+
+  @param regmap_file String: [Optional] Register map file
+  @param device      Dictionary: Built-in device table
+  @param component   Dictionary: Built-in component table
+
+  @return Object: MTSRegisterMap
+  """
+  if regmap_file and os.path.exists(regmap_file): return read_register_map(regmap_file)
+  return MTSRegisterMap(device, component)
+
+if __name__ == '__main__':
+
+  parser = OptionParser(usage="%prog [options] [module]", version="%prog 0.1")
+  parser.add_option('-r', '--regmap',
+                    action='store',
+                    dest='regmap_file',
+                    default=REGMAP,
+                    help='Register map file, default is \'%default\'.')
+  (opts, args) = parser.parse_args()
+
+  # validate the register map and print the compiled frames of a module
+  regmap = read_register_map(opts.regmap_file)
+  modmap = regmap.module(len(args) > 0 and int(args[0]) or 1)
+  def frames(seq):
+    return ' '.join(['%04x:%08x' % (addr, data) for [addr, data] in seq])
+  for name in sorted(modmap.init.keys()):
+    print 'init %s' % name, frames(modmap.init[name])
+  for name in sorted(modmap.strobe.keys()):
+    for setting in [0, 1]:
+      print '%s %d' % (name, setting), frames(modmap.strobe[name][setting])
+  for name in sorted(modmap.atten.keys()):
+    print '%s %d steps, max' % (name, len(modmap.atten[name])), frames(modmap.atten[name][-1])
+  print 'max7301 output ports', modmap.outputs
+  for name in sorted(modmap.gpio.keys()):
+    print '%s ports' % name, modmap.gpio[name]
+
+# -fin-
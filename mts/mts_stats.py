@@ -0,0 +1,208 @@
+#!/usr/bin/python
+
+import collections, copy, math
+import numpy
+
+## Always-on transaction counters and latency histograms of the MTS controller link,
+#  and response deadlines adapted to the observed round trip times
+
+class MTSStats:
+  """
+  Count transactions, bytes and errors, and keep log2 bucketed latency histograms per transaction type, module and register.
+  Bucket n counts latencies between 2**(n-1) and 2**n microseconds.
+
+  @return      Handle: Handle to statistics object
+  """
+  # Control sequences and the bytes sent and received for each
+  NAMES       = { 0x08 : 'ping', 0x01 : 'read', 0x02 : 'write' }
+  TX_BYTES    = { 0x08 : 1, 0x01 : 3, 0x02 : 7 }
+  RX_BYTES    = { 0x08 : 1, 0x01 : 5, 0x02 : 1 }
+  SUCCESS     = { 0x08 : 0x08, 0x01 : 0x01, 0x02 : 0x01 }
+  NR_BUCKETS  = 32
+
+  def __init__(self):
+    self.reset()
+
+  def reset(self):
+    """Clear all counters and histograms"""
+    self.transactions = dict([(name, 0) for name in self.NAMES.values()])
+    self.tx_bytes     = 0
+    self.rx_bytes     = 0
+    # errors by return value, None counts responses that were never received
+    self.errors       = {}
+    # (type, module, register) : bucket counts
+    self.histograms   = {}
+    # link resynchronisations and transactions repeated after a link error
+    self.resyncs      = 0
+    self.retries      = 0
+
+  def record(self, ctrl, address, latency, status):
+    """
+    Account for a completed transaction
+
+    @param ctrl    Integer: Control sequence
+    @param address Integer: Register address
+    @param latency Float: Time (s) from sending the frame to receiving the response
+    @param status  Integer: Return value, None if no response was received
+    """
+    name = self.NAMES[ctrl]
+    self.transactions[name] += 1
+    self.tx_bytes += self.TX_BYTES[ctrl]
+    if status is None:
+      self.errors[None] = self.errors.get(None, 0) + 1
+      return
+    self.rx_bytes += self.RX_BYTES[ctrl]
+    if status != self.SUCCESS[ctrl]: self.errors[status] = self.errors.get(status, 0) + 1
+    bucket = min(max(math.frexp(latency*1e6)[1], 0), self.NR_BUCKETS-1)
+    key = (name, address >> 12, address & 0xFFF)
+    if not self.histograms.has_key(key): self.histograms[key] = [0]*self.NR_BUCKETS
+    self.histograms[key][bucket] += 1
+
+  def snapshot(self):
+    """
+    Copy of the current counters and histograms
+
+    @return Dictionary: transactions, tx_bytes, rx_bytes, errors, resyncs, retries and histograms
+    """
+    return copy.deepcopy({
+      'transactions' : self.transactions,
+      'tx_bytes'     : self.tx_bytes,
+      'rx_bytes'     : self.rx_bytes,
+      'errors'       : self.errors,
+      'resyncs'      : self.resyncs,
+      'retries'      : self.retries,
+      'histograms'   : self.histograms,
+    })
+
+  def histogram(self, name, module=None, register=None):
+    """
+    Latency histogram of a transaction type, summed over all or a selected module and register
+
+    @param name     String: Transaction type, 'ping', 'read' or 'write'
+    @param module   Integer: [Optional] Module number
+    @param register Integer: [Optional] Module register
+
+    @return List: Bucket counts
+    """
+    hist = [0]*self.NR_BUCKETS
+    for [[key_name, key_mod, key_reg], counts] in self.histograms.items():
+      if key_name != name: continue
+      if module is not None and key_mod != module: continue
+      if register is not None and key_reg != register: continue
+      hist = [total+count for [total, count] in zip(hist, counts)]
+    return hist
+
+  def report(self):
+    """
+    Summary of counters and latency histograms per transaction type
+
+    @return String: Printable report
+    """
+    lines = ['Transactions: %s' % ', '.join(['%s %d' % item for item in sorted(self.transactions.items())])]
+    lines.append('Bytes sent %d, received %d' % (self.tx_bytes, self.rx_bytes))
+    if self.errors:
+      lines.append('Errors: %s' % ', '.join(['%s %d' % (status is None and 'timeout' or hex(status), count) for [status, count] in sorted(self.errors.items())]))
+    if self.resyncs or self.retries:
+      lines.append('Link resynchronised %d times, %d transactions repeated' % (self.resyncs, self.retries))
+    for name in sorted(self.transactions.keys()):
+      hist = self.histogram(name)
+      if not sum(hist): continue
+      lines.append('%s latency:' % name)
+      for bucket in range(self.NR_BUCKETS):
+        if hist[bucket]: lines.append('  <= %8d us: %d' % (2**bucket, hist[bucket]))
+    return '\n'.join(lines)
+
+class MTSDeadlines:
+  """
+  Response deadlines derived from the round trip times observed per transaction type:
+  a high percentile of the recent round trips times a safety factor, limited to between floor and the static timeout.
+  Single transactions and transactions sent together in a batch are kept apart: a batched frame only accounts for
+  its share of the batch round trip, which would pull the deadline of a single transaction down.
+  The static timeout is used until enough round trips were observed and after a missed response,
+  until the next response is received, so that recovery from a slow link is not cut short.
+
+  @param timeout     Float: Static timeout (s), also the maximum deadline
+  @param adaptive    Boolean: [Optional] False to always use the static timeout
+  @param window      Integer: [Optional] Number of recent round trips kept per transaction type
+  @param percentile  Float: [Optional] Percentile of the round trips the deadline is based on
+  @param factor      Float: [Optional] Safety factor applied to the percentile
+  @param floor       Float: [Optional] Minimum deadline (s)
+  @param min_samples Integer: [Optional] Round trips needed before adapting the deadline
+
+  @return      Handle: Handle to deadlines object
+  """
+  # Recompute the percentile after this many new round trips
+  UPDATE = 16
+
+  def __init__(self, timeout, adaptive=True, window=256, percentile=99., factor=4., floor=0.005, min_samples=32):
+    self.timeout     = timeout
+    self.adaptive    = adaptive
+    self.window      = window
+    self.percentile  = percentile
+    self.factor      = factor
+    self.floor       = floor
+    self.min_samples = min_samples
+    self.reset()
+
+  def reset(self):
+    """Forget all round trips, e.g. after changing the baudrate"""
+    # control sequence : recent round trips (s), and the percentile of the round trips, of single transactions
+    self.rtts      = {}
+    self.quantiles = {}
+    # control sequence : recent round trip shares (s), and their percentile, of batched transactions
+    self.batch_rtts      = {}
+    self.batch_quantiles = {}
+    self.missed    = False
+
+  def record(self, ctrl, latency, status, batch=False):
+    """
+    Account for a completed transaction
+
+    @param ctrl    Integer: Control sequence
+    @param latency Float: Time (s) from sending the frame to receiving the response, or its share of the batch round trip
+    @param status  Integer: Return value, None if no response was received
+    @param batch   Boolean: [Optional] True if the frame was sent together with other frames
+    """
+    if status is None:
+      self.missed = True
+      return
+    self.missed = False
+    [rtts, quantiles] = [self.rtts, self.quantiles]
+    if batch: [rtts, quantiles] = [self.batch_rtts, self.batch_quantiles]
+    if not rtts.has_key(ctrl): rtts[ctrl] = collections.deque(maxlen=self.window)
+    rtts[ctrl].append(latency)
+    if len(rtts[ctrl]) >= self.min_samples and (not quantiles.has_key(ctrl) or len(rtts[ctrl]) % self.UPDATE == 0):
+      quantiles[ctrl] = numpy.percentile(rtts[ctrl], self.percentile)
+
+  def deadline(self, counts):
+    """
+    Time to wait for the responses to a number of transactions sent together.
+    The deadline of several transactions is based on the batch round trips, if enough were observed.
+
+    @param counts Dictionary: Number of transactions of each control sequence
+
+    @return Float: Deadline (s), rounded up to the millisecond
+    """
+    if not self.adaptive or self.missed: return self.timeout
+    batch = sum(counts.values()) > 1
+    total = 0.
+    for [ctrl, count] in counts.items():
+      if batch and self.batch_quantiles.has_key(ctrl): total += count*self.batch_quantiles[ctrl]
+      elif self.quantiles.has_key(ctrl): total += count*self.quantiles[ctrl]
+      else: return self.timeout
+    return min(max(math.ceil(total*self.factor*1e3)/1e3, self.floor), self.timeout)
+
+  def report(self):
+    """
+    @return String: Printable deadline per transaction type
+    """
+    lines = []
+    for [ctrl, name] in sorted(MTSStats.NAMES.items()):
+      if self.quantiles.has_key(ctrl):
+        lines.append('%s deadline %.1f ms (p%g %.3f ms)' % (name, self.deadline({ctrl : 1})*1e3, self.percentile, self.quantiles[ctrl]*1e3))
+      if self.batch_quantiles.has_key(ctrl):
+        lines.append('batched %s share p%g %.3f ms' % (name, self.percentile, self.batch_quantiles[ctrl]*1e3))
+    return '\n'.join(lines)
+
+# -fin-
+
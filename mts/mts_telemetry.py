@@ -0,0 +1,440 @@
+#!/usr/bin/python
+
+from optparse import OptionParser
+import mmap, Queue, threading, time
+import numpy
+
+## Background telemetry of the combiner power detectors and temperature sensors
+#  A poller thread reads the environment of every combiner at a fixed rate and keeps the timestamped samples
+#  in preallocated ring buffers, one per combiner channel. The reads are queued on the MTS worker thread,
+#  so they interleave with foreground operations without interrupting their register sequences.
+#  The samples of every detector read can also be published to a memory-mapped file, from which any number of
+#  local processes read without access to the controller, see MTSTelemetryStore and MTSTelemetryReader.
+#  Subscriptions evaluate threshold and rate of change conditions on every sample and notify the subscriber
+#  with a callback or a queue only when a condition is met, see MTSSubscription.
+
+# Combiner channels, in the order returned by mts_mod.get_environment
+CHANNELS = ['power', 'temperature']
+# Shared telemetry file layout: a header, a table with the name, sequence counter and sample count of every channel,
+# and a ring of (time, value) samples per channel. The sequence counter is odd while a sample is being written.
+SHM     = '/dev/shm/mts_telemetry'
+MAGIC   = 'MTSTELEM'
+VERSION = 1
+HEADER  = numpy.dtype([('magic', 'S8'), ('version', '<u4'), ('nr_channels', '<u4'), ('size', '<u4'), ('reserved', '<u4')])
+CHANNEL = numpy.dtype([('name', 'S24'), ('seq', '<u8'), ('count', '<u8')])
+SAMPLE  = numpy.dtype([('time', '<f8'), ('value', '<f8')])
+
+class MTSRing:
+  """
+  Fixed size ring buffer of timestamped samples, no memory is allocated when a sample is added
+
+  @param size Integer: Number of samples kept
+
+  @return      Handle: Handle to ring buffer object
+  """
+  def __init__(self, size):
+    self.size  = size
+    self.times = numpy.zeros(size)
+    self.data  = numpy.zeros(size)
+    # total number of samples added
+    self.count = 0
+    self.lock  = threading.Lock()
+
+  def append(self, timestamp, value):
+    """
+    @param timestamp Float: Time (s since epoch) of the sample
+    @param value     Float: Sample value
+    """
+    with self.lock:
+      idx = self.count % self.size
+      self.times[idx] = timestamp
+      self.data[idx]  = value
+      self.count += 1
+
+  def latest(self):
+    """
+    @return List: [time, value] of the latest sample, None if there are no samples
+    """
+    with self.lock:
+      if not self.count: return None
+      idx = (self.count-1) % self.size
+      return [self.times[idx], self.data[idx]]
+
+  def last(self, nr_samples=None):
+    """
+    @param nr_samples Integer: [Optional] Number of samples, default is all samples kept
+
+    @return Array: Times and values of the latest samples, oldest first, in 2 rows
+    """
+    with self.lock:
+      nr_samples = min(nr_samples is None and self.size or nr_samples, self.count, self.size)
+      idx = numpy.arange(self.count-nr_samples, self.count) % self.size
+      return numpy.array([self.times[idx], self.data[idx]])
+
+  def stats(self, window=None, now=None):
+    """
+    @param window Float: [Optional] Only use the samples of the last window seconds, default is all samples kept
+    @param now    Float: [Optional] Time the window ends, default is the current time
+
+    @return Dictionary: Number of samples with their mean, standard deviation, minimum and maximum, None if there are no samples
+    """
+    [times, data] = self.last()
+    if window is not None: data = data[times >= (now or time.time())-window]
+    if not len(data): return None
+    return {'count' : len(data), 'mean' : data.mean(), 'std' : data.std(), 'min' : data.min(), 'max' : data.max()}
+
+class MTSTelemetryStore:
+  """
+  Memory-mapped ring buffers of detector samples, written by a single MTS process, see MTS.publish_telemetry.
+  The publish method is a telemetry sink of the combiner modules.
+
+  @param path      String: [Optional] File to map, preferably on a tmpfs such as /dev/shm
+  @param combiners List: Combiner modules published
+  @param size      Integer: [Optional] Number of samples kept per channel
+
+  @return      Handle: Handle to telemetry store object
+  """
+  def __init__(self, path=SHM, combiners=['comb1', 'comb2'], size=3600):
+    self.path = path
+    self.names = ['%s/%s' % (comb, channel) for comb in combiners for channel in CHANNELS]
+    self.size = size
+    length = HEADER.itemsize + CHANNEL.itemsize*len(self.names) + SAMPLE.itemsize*size*len(self.names)
+    fout = open(path, 'w+b')
+    try:
+      fout.truncate(length)
+      self.mmap = mmap.mmap(fout.fileno(), length)
+    finally:
+      fout.close()
+    [header, self.table, self.data] = map_store(self.mmap, len(self.names), size)
+    self.table['name'] = self.names
+    self.table['seq'] = 0
+    self.table['count'] = 0
+    header['version'] = VERSION
+    header['nr_channels'] = len(self.names)
+    header['size'] = size
+    # readers check the magic last
+    header['magic'] = MAGIC
+    self.index = dict([(self.names[idx], idx) for idx in range(len(self.names))])
+
+  def publish(self, comb, channel, timestamp, value):
+    """
+    Add a sample to the ring of a channel
+
+    @param comb      String: Combiner module, e.g. 'comb1'
+    @param channel   String: 'power' or 'temperature'
+    @param timestamp Float: Time (s since epoch) of the sample
+    @param value     Float: Sample value
+    """
+    idx = self.index.get('%s/%s' % (comb, channel))
+    if idx is None: return
+    seq = self.table['seq']
+    count = self.table['count']
+    seq[idx] += 1
+    self.data[idx, int(count[idx]) % self.size] = (timestamp, value)
+    count[idx] += 1
+    seq[idx] += 1
+
+  def close(self):
+    """Unmap the file, readers keep the samples published"""
+    self.mmap.close()
+
+class MTSTelemetryReader:
+  """
+  Read the samples published by a MTSTelemetryStore, from any process, without locking the writer
+
+  @param path String: [Optional] Shared telemetry file
+
+  @return      Handle: Handle to telemetry reader object
+  """
+  def __init__(self, path=SHM):
+    fin = open(path, 'rb')
+    try:
+      self.mmap = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+    finally:
+      fin.close()
+    header = numpy.frombuffer(self.mmap, dtype=HEADER, count=1)[0]
+    if header['magic'] != MAGIC or header['version'] != VERSION:
+      raise RuntimeError('%s is not a MTS telemetry file of version %d' % (path, VERSION))
+    self.size = int(header['size'])
+    [header, self.table, self.data] = map_store(self.mmap, int(header['nr_channels']), self.size)
+    self.names = list(self.table['name'])
+
+  def channels(self):
+    """
+    @return List: Channel names, e.g. 'comb1/power'
+    """
+    return list(self.names)
+
+  def view(self, comb, channel='power'):
+    """
+    Zero-copy access to the ring of a channel, the samples may change while they are read
+
+    @param comb    String: Combiner module, e.g. 'comb1'
+    @param channel String: [Optional] 'power' (mV/dBm) or 'temperature' (mV/deg)
+
+    @return List: Read-only array of (time, value) samples, and the total number of samples published to the ring
+    """
+    idx = self.names.index('%s/%s' % (comb, channel))
+    return [self.data[idx], int(self.table['count'][idx])]
+
+  def last(self, comb, channel='power', nr_samples=1):
+    """
+    Consistent copy of the latest samples of a channel, retried while the writer adds a sample
+
+    @param comb       String: Combiner module, e.g. 'comb1'
+    @param channel    String: [Optional] 'power' (mV/dBm) or 'temperature' (mV/deg)
+    @param nr_samples Integer: [Optional] Number of samples
+
+    @return Array: (time, value) samples, oldest first
+    """
+    idx = self.names.index('%s/%s' % (comb, channel))
+    seq = self.table['seq']
+    while True:
+      start = int(seq[idx])
+      if start & 1: continue
+      count = int(self.table['count'][idx])
+      nr_samples = min(nr_samples, count, self.size)
+      samples = self.data[idx][numpy.arange(count-nr_samples, count) % self.size]
+      if seq[idx] == start: return samples
+
+  def latest(self, comb, channel='power'):
+    """
+    @param comb    String: Combiner module, e.g. 'comb1'
+    @param channel String: [Optional] 'power' (mV/dBm) or 'temperature' (mV/deg)
+
+    @return List: [time, value] of the latest sample, None if there are no samples
+    """
+    samples = self.last(comb, channel)
+    if not len(samples): return None
+    return [samples['time'][0], samples['value'][0]]
+
+  def close(self):
+    self.mmap.close()
+
+class MTSSubscription:
+  """
+  Threshold and rate of change conditions on a combiner channel, evaluated on every sample passed to it as telemetry sink.
+  A threshold condition triggers once when the value crosses the threshold and is armed again when the value
+  returns past the threshold by the hysteresis, the rate condition triggers once when the rate of change
+  between consecutive samples exceeds the limit and is armed again when it drops below the limit.
+  Events are dictionaries with comb, channel, time, value, rate and the condition: 'above', 'below' or 'rate'.
+
+  @param comb       String: Combiner module, e.g. 'comb1'
+  @param channel    String: [Optional] 'power' (mV/dBm) or 'temperature' (mV/deg)
+  @param above      Float: [Optional] Trigger when the value rises above this threshold
+  @param below      Float: [Optional] Trigger when the value falls below this threshold
+  @param hysteresis Float: [Optional] Distance past a threshold the value must return before the condition is armed again
+  @param rate       Float: [Optional] Trigger when the value changes faster than this rate (per second)
+  @param callback   Function: [Optional] Called as callback(event) on the thread reading the sample, it must not block
+  @param queue      Object: [Optional] Queue the events are put on, a new Queue if no callback is given
+
+  @return      Handle: Handle to subscription object
+  """
+  def __init__(self, comb, channel='power', above=None, below=None, hysteresis=0., rate=None, callback=None, queue=None):
+    if channel not in CHANNELS: raise RuntimeError('Unknown telemetry channel %s' % channel)
+    if above is None and below is None and rate is None: raise RuntimeError('Subscription without a condition')
+    self.comb = comb
+    self.channel = channel
+    self.above = above
+    self.below = below
+    self.hysteresis = hysteresis
+    self.rate = rate
+    self.callback = callback
+    if queue is None and callback is None: queue = Queue.Queue()
+    self.queue = queue
+    # conditions armed, the previous sample, and the errors raised by the callback
+    self.armed = {'above' : True, 'below' : True, 'rate' : True}
+    self.previous = None
+    self.errors = 0
+    self.error = None
+
+  def __call__(self, comb, channel, timestamp, value):
+    if (comb, channel) != (self.comb, self.channel): return
+    rate = None
+    if self.previous and timestamp > self.previous[0]: rate = (value-self.previous[1])/(timestamp-self.previous[0])
+    self.previous = (timestamp, value)
+    events = []
+    if self.above is not None:
+      if self.armed['above'] and value > self.above: events.append('above')
+      self.armed['above'] = value < self.above-self.hysteresis or (self.armed['above'] and value <= self.above)
+    if self.below is not None:
+      if self.armed['below'] and value < self.below: events.append('below')
+      self.armed['below'] = value > self.below+self.hysteresis or (self.armed['below'] and value >= self.below)
+    if self.rate is not None and rate is not None:
+      if self.armed['rate'] and abs(rate) > self.rate: events.append('rate')
+      self.armed['rate'] = abs(rate) <= self.rate
+    for condition in events:
+      self.__notify__({'comb' : comb, 'channel' : channel, 'time' : timestamp, 'value' : value, 'rate' : rate, 'condition' : condition})
+
+  def __notify__(self, event):
+    if self.queue is not None: self.queue.put(event)
+    if self.callback is None: return
+    # errors of the subscriber must not fail the controller operation that read the sample
+    try:
+      self.callback(event)
+    except Exception as e:
+      self.errors += 1
+      self.error = e
+
+  def get(self, timeout=None):
+    """
+    Wait for the next event on the queue of the subscription
+
+    @param timeout Float: [Optional] Maximum time (s) to wait, default is to wait until an event arrives
+
+    @return Dictionary: Event, None if no event arrived before the timeout
+    """
+    try:
+      return self.queue.get(timeout=timeout)
+    except Queue.Empty:
+      return None
+
+def map_store(buf, nr_channels, size):
+  """
+  @param buf         Object: Memory map of a shared telemetry file
+  @param nr_channels Integer: Number of channels
+  @param size        Integer: Number of samples kept per channel
+
+  @return List: Header, channel table and samples arrays, mapped onto the buffer
+  """
+  offset = HEADER.itemsize + CHANNEL.itemsize*nr_channels
+  header = numpy.frombuffer(buf, dtype=HEADER, count=1)[0]
+  table = numpy.frombuffer(buf, dtype=CHANNEL, count=nr_channels, offset=HEADER.itemsize)
+  data = numpy.frombuffer(buf, dtype=SAMPLE, count=nr_channels*size, offset=offset).reshape(nr_channels, size)
+  return [header, table, data]
+
+class MTSTelemetry(threading.Thread):
+  """
+  Thread polling the environment of the combiner modules, see MTS.start_telemetry
+
+  @param mts_obj   Object: MTS object with a running worker thread
+  @param combiners List: [Optional] Combiner modules to poll, default is all combiners
+  @param rate      Float: [Optional] Number of polls per second
+  @param size      Integer: [Optional] Number of samples kept per channel
+
+  @return      Handle: Handle to telemetry thread object
+  """
+  def __init__(self, mts_obj, combiners=None, rate=1., size=3600):
+    threading.Thread.__init__(self, name='mts_telemetry')
+    self.daemon = True
+    self.mts = mts_obj
+    if combiners is None: combiners = sorted(mts_obj.cmb_dict.keys())
+    self.combiners = list(combiners)
+    self.period = 1./rate
+    self.rings = {}
+    for comb in self.combiners:
+      for channel in CHANNELS: self.rings[(comb, channel)] = MTSRing(size)
+    # polls that failed, and the last error raised
+    self.errors = 0
+    self.error  = None
+    self.stopped = threading.Event()
+
+  def run(self):
+    deadline = time.time()
+    while not self.stopped.isSet():
+      for comb in self.combiners:
+        try:
+          values = getattr(self.mts, comb).get_environment()
+        except Exception as e:
+          self.errors += 1
+          self.error = e
+          continue
+        now = time.time()
+        for [channel, value] in zip(CHANNELS, values): self.rings[(comb, channel)].append(now, value)
+      # polls that are due are skipped if the link is busy for longer than a period
+      deadline = max(deadline+self.period, time.time())
+      self.stopped.wait(deadline-time.time())
+
+  def stop(self):
+    """Stop polling, the poll in progress is completed"""
+    self.stopped.set()
+    if threading.current_thread() is not self: self.join()
+
+  def latest(self, comb, channel='power'):
+    """
+    @param comb    String: Combiner module, e.g. 'comb1'
+    @param channel String: [Optional] 'power' (mV/dBm) or 'temperature' (mV/deg)
+
+    @return List: [time, value] of the latest sample, None if there are no samples
+    """
+    return self.rings[(comb, channel)].latest()
+
+  def last(self, comb, channel='power', nr_samples=None):
+    """
+    @param comb       String: Combiner module, e.g. 'comb1'
+    @param channel    String: [Optional] 'power' (mV/dBm) or 'temperature' (mV/deg)
+    @param nr_samples Integer: [Optional] Number of samples, default is all samples kept
+
+    @return Array: Times and values of the latest samples, oldest first, in 2 rows
+    """
+    return self.rings[(comb, channel)].last(nr_samples)
+
+  def stats(self, comb, channel='power', window=None):
+    """
+    @param comb    String: Combiner module, e.g. 'comb1'
+    @param channel String: [Optional] 'power' (mV/dBm) or 'temperature' (mV/deg)
+    @param window  Float: [Optional] Only use the samples of the last window seconds, default is all samples kept
+
+    @return Dictionary: Number of samples with their mean, standard deviation, minimum and maximum, None if there are no samples
+    """
+    return self.rings[(comb, channel)].stats(window)
+
+if __name__ == '__main__':
+  from mts import MTS
+
+  parser = OptionParser(version="%prog 0.1")
+  parser.add_option('-p', '--port',
+                    action='store',
+                    dest='tty',
+                    default='auto',
+                    help='Set serial port, default is \'%default\' to find the port by USB id.')
+  parser.add_option('-c', '--config',
+                    action='store',
+                    dest='config_file',
+                    default='/etc/mts/mts_default',
+                    help='MTS config file, default is \'%default\'.')
+  parser.add_option('-r', '--rate',
+                    action='store',
+                    dest='rate',
+                    type='float',
+                    default=10.,
+                    help='Polls per second, default is \'%default\'.')
+  parser.add_option('-t', '--time',
+                    action='store',
+                    dest='duration',
+                    type='float',
+                    default=10.,
+                    help='Seconds to poll, default is \'%default\'.')
+  parser.add_option('-s', '--shm',
+                    action='store',
+                    dest='shm',
+                    default=None,
+                    help='Publish the samples to a shared telemetry file, e.g. \'%s\'.' % SHM)
+  parser.add_option('--read',
+                    action='store_true',
+                    dest='read',
+                    default=False,
+                    help='Print the latest samples published to the shared telemetry file, without access to the controller.')
+  (opts, args) = parser.parse_args()
+
+  if opts.read:
+    reader = MTSTelemetryReader(opts.shm or SHM)
+    for name in reader.channels():
+      [comb, channel] = name.split('/')
+      print comb, channel, reader.latest(comb, channel)
+    reader.close()
+    raise SystemExit
+
+  mts_obj = MTS(port=opts.tty, valon=None, config_file=opts.config_file)
+  try:
+    if opts.shm: mts_obj.publish_telemetry(opts.shm)
+    telemetry = mts_obj.start_telemetry(rate=opts.rate)
+    time.sleep(opts.duration)
+    for comb in telemetry.combiners:
+      for channel in CHANNELS:
+        print comb, channel, telemetry.stats(comb, channel)
+    print 'Failed polls', telemetry.errors
+  finally:
+    mts_obj.exit()
+
+# -fin-
@@ -0,0 +1,168 @@
+#!/usr/bin/python
+
+from optparse import OptionParser
+from mts_link import LINK_CACHE, read_link_cache, write_link_cache
+import os, serial, time
+import valon_synth
+
+## USB serial port discovery of the MTS controller and the Valon synthesizer
+#  Candidate ports are found by USB vendor and product id in sysfs and confirmed on the serial line:
+#  the controller echoes a ping and the Valon answers a frequency query with a valid checksum.
+#  The ports found are remembered with the USB serial numbers in the link cache, so that later starts skip probing.
+
+AUTO  = 'auto'
+SYSFS = '/sys/bus/usb-serial/devices'
+DEV   = '/dev'
+# USB (vendor, product) ids of the serial bridges
+USB_IDS = {
+  'controller' : [ ('10c4', 'ea60') ], # Cygnal Integrated Products CP210x
+  'valon'      : [ ('0403', '6001') ], # FTDI FT232 USB-Serial (UART)
+}
+# Link cache entry holding the discovered device mapping
+DISCOVERY = 'usb_discovery'
+# Controller ping and its echo
+CTRL_PING  = '\x08'
+BAUDRATE   = 115200
+# Valon 5007 read frequency command, the reply is 24 data bytes and a checksum
+VALON_READ = 0x80
+VALON_RTRN = 25
+VALON_BAUD = 9600
+TIMEOUT    = 0.1
+
+def __sysfs_attr__(path, name):
+  try:
+    fin = open(os.path.join(path, name))
+    try:
+      return fin.read().strip()
+    finally:
+      fin.close()
+  except IOError:
+    return None
+
+def list_ports(sysfs=SYSFS, dev=DEV):
+  """
+  List USB serial ports with the ids of the USB device they belong to
+
+  @param sysfs String: [Optional] sysfs directory of the USB serial ports
+  @param dev   String: [Optional] Directory of the device nodes
+
+  @return List: Dictionaries with port, vid, pid and serial
+  """
+  ports = []
+  if not os.path.isdir(sysfs): return ports
+  for name in sorted(os.listdir(sysfs)):
+    info = {'port' : os.path.join(dev, name), 'vid' : None, 'pid' : None, 'serial' : None}
+    # the USB device is the first parent directory with a vendor id
+    path = os.path.realpath(os.path.join(sysfs, name))
+    while path != os.path.dirname(path):
+      if os.path.exists(os.path.join(path, 'idVendor')):
+        info.update({'vid' : __sysfs_attr__(path, 'idVendor'), 'pid' : __sysfs_attr__(path, 'idProduct'), 'serial' : __sysfs_attr__(path, 'serial')})
+        break
+      path = os.path.dirname(path)
+    ports.append(info)
+  return ports
+
+def ping_controller(port, baudrate=None, timeout=TIMEOUT):
+  """
+  @param port     String: Serial port
+  @param baudrate Integer: [Optional] Baudrate, default is the baudrate remembered for the port or 115200
+  @param timeout  Float: [Optional] Time (s) to wait for the ping echo
+
+  @return Boolean: True if the MTS controller echoes a ping on the port
+  """
+  if baudrate is None: baudrate = read_link_cache(port).get('baudrate', BAUDRATE)
+  try:
+    conn = serial.Serial(port=port, baudrate=baudrate, timeout=timeout)
+  except (serial.SerialException, OSError):
+    return False
+  try:
+    conn.flushInput()
+    conn.write(CTRL_PING)
+    return conn.read(1) == CTRL_PING
+  except (serial.SerialException, OSError):
+    return False
+  finally:
+    conn.close()
+
+def query_valon(port, synth=valon_synth.SYNTH_B, timeout=TIMEOUT*5):
+  """
+  @param port    String: Serial port
+  @param synth   Integer: [Optional] Synthesizer to query
+  @param timeout Float: [Optional] Time (s) to wait for the reply
+
+  @return Boolean: True if a Valon synthesizer answers a frequency query on the port
+  """
+  try:
+    conn = serial.Serial(port=port, baudrate=VALON_BAUD, timeout=timeout)
+  except (serial.SerialException, OSError):
+    return False
+  try:
+    conn.flushInput()
+    conn.write(chr(VALON_READ | synth))
+    rtrn = bytearray(conn.read(VALON_RTRN))
+    return len(rtrn) == VALON_RTRN and sum(rtrn[:-1]) % 256 == rtrn[-1]
+  except (serial.SerialException, OSError):
+    return False
+  finally:
+    conn.close()
+
+CONFIRM = { 'controller' : ping_controller, 'valon' : query_valon }
+
+def discover(devices=None, cache=LINK_CACHE, sysfs=SYSFS, dev=DEV, verbose=False):
+  """
+  Find the serial ports of the MTS devices.
+  A port remembered in the link cache is used without probing if the same USB device is still attached to it,
+  else the ports with the USB ids of the device are confirmed first and then the USB serial ports of unknown bridges.
+
+  @param devices List: [Optional] Devices to find, 'controller' and/or 'valon', default is both
+  @param cache   String: [Optional] Link cache file
+  @param sysfs   String: [Optional] sysfs directory of the USB serial ports
+  @param dev     String: [Optional] Directory of the device nodes
+  @param verbose Boolean: [Optional] Print the ports probed
+
+  @return Dictionary: Port of every device found
+  """
+  if devices is None: devices = USB_IDS.keys()
+  ports = list_ports(sysfs, dev)
+  cached = read_link_cache(DISCOVERY, cache)
+  found = {}
+  for device in devices:
+    entry = cached.get(device, {})
+    for info in ports:
+      if info['port'] == entry.get('port') and info['serial'] == entry.get('serial') and info['port'] not in found.values():
+        found[device] = info['port']
+  for device in devices:
+    if found.has_key(device): continue
+    # ports of the expected USB bridge first, never the bridges of the other devices
+    others = sum([USB_IDS[other] for other in USB_IDS.keys() if other != device], [])
+    candidates = [info for info in ports if (info['vid'], info['pid']) in USB_IDS[device]]
+    candidates += [info for info in ports if info not in candidates and (info['vid'], info['pid']) not in others]
+    for info in candidates:
+      if info['port'] in found.values(): continue
+      if verbose: print 'Probing %s for %s' % (info['port'], device)
+      if CONFIRM[device](info['port']):
+        found[device] = info['port']
+        write_link_cache(DISCOVERY, cache, **{device : {'port' : info['port'], 'serial' : info['serial']}})
+        break
+  return found
+
+if __name__ == '__main__':
+
+  parser = OptionParser(version="%prog 0.1")
+  parser.add_option('--clear',
+                    action='store_true',
+                    dest='clear',
+                    default=False,
+                    help='Forget the remembered ports and probe again.')
+  (opts, args) = parser.parse_args()
+
+  for info in list_ports():
+    print '%s  %s:%s  serial %s' % (info['port'], info['vid'], info['pid'], info['serial'])
+  if opts.clear: write_link_cache(DISCOVERY, controller={}, valon={})
+  start = time.time()
+  found = discover(verbose=True)
+  print 'Discovery takes %.4f seconds' % (time.time()-start)
+  for device in sorted(USB_IDS.keys()):
+    print '%s: %s' % (device, found.get(device, 'not found'))
+
+# -fin-
@@ -0,0 +1,141 @@
+#!/usr/bin/python
+
+import functools, Queue, sys, threading
+
+## Serialised access to the MTS controller from multiple threads
+#  A single worker thread owns the serial port and executes complete logical operations, such as a full
+#  attenuator setting sequence, one at a time from a queue. Callers in other threads wait on a future.
+
+class MTSFuture:
+  """
+  Result of an operation submitted to the worker thread
+
+  @return      Handle: Handle to future object
+  """
+  def __init__(self):
+    self.event = threading.Event()
+    self.value = None
+    self.error = None
+
+  def done(self):
+    """
+    @return Boolean: True once the operation completed
+    """
+    return self.event.isSet()
+
+  def set_result(self, value):
+    self.value = value
+    self.event.set()
+
+  def set_exception(self, error, traceback=None):
+    self.error = (error, traceback)
+    self.event.set()
+
+  def exception(self, timeout=None):
+    """
+    Wait for the operation and return the exception it raised
+
+    @param timeout Float: [Optional] Maximum time (s) to wait, default is to wait until the operation completed
+
+    @return Exception: Exception raised by the operation, None if it was successful
+    """
+    if not self.event.wait(timeout): raise RuntimeError('Timeout waiting for controller operation')
+    if self.error: return self.error[0]
+    return None
+
+  def result(self, timeout=None):
+    """
+    Wait for the operation and return its result, raising the exception raised by the operation
+
+    @param timeout Float: [Optional] Maximum time (s) to wait, default is to wait until the operation completed
+
+    @return Object: Return value of the operation
+    """
+    if not self.event.wait(timeout): raise RuntimeError('Timeout waiting for controller operation')
+    if self.error:
+      [error, traceback] = self.error
+      raise type(error), error, traceback
+    return self.value
+
+class MTSWorker(threading.Thread):
+  """
+  Thread executing controller operations in the order submitted
+
+  @return      Handle: Handle to worker thread object
+  """
+  def __init__(self):
+    threading.Thread.__init__(self, name='mts_worker')
+    self.daemon = True
+    self.queue = Queue.Queue()
+    # set by stop, operations submitted afterwards are rejected instead of queued behind the end of the queue
+    self.lock = threading.Lock()
+    self.stopping = False
+
+  def run(self):
+    while True:
+      item = self.queue.get()
+      if item is None: break
+      [future, func, args, kwargs] = item
+      try:
+        future.set_result(func(*args, **kwargs))
+      except Exception as e:
+        future.set_exception(e, sys.exc_info()[2])
+    # fail operations left behind the end of the queue, so that no caller waits forever
+    while True:
+      try:
+        item = self.queue.get_nowait()
+      except Queue.Empty:
+        break
+      if item is not None: item[0].set_exception(RuntimeError('Controller worker thread stopped'))
+
+  def current(self):
+    """
+    @return Boolean: True if called from the worker thread
+    """
+    return threading.current_thread() is self
+
+  def submit(self, func, *args, **kwargs):
+    """
+    Queue an operation for the worker thread.
+    Operations submitted from the worker thread itself are part of the running operation and execute immediately.
+
+    @param func   Function: Operation to execute
+    @param args   List: Positional arguments of the operation
+    @param kwargs Dictionary: Keyword arguments of the operation
+
+    @return Object: MTSFuture of the operation result
+    """
+    future = MTSFuture()
+    if self.current():
+      try:
+        future.set_result(func(*args, **kwargs))
+      except Exception as e:
+        future.set_exception(e, sys.exc_info()[2])
+    else:
+      with self.lock:
+        if self.stopping or not self.isAlive():
+          future.set_exception(RuntimeError('Controller worker thread is not running'))
+        else:
+          self.queue.put((future, func, args, kwargs))
+    return future
+
+  def stop(self):
+    """Complete all queued operations and end the worker thread, operations submitted from now on are rejected"""
+    with self.lock:
+      if not self.stopping: self.queue.put(None)
+      self.stopping = True
+    if not self.current(): self.join()
+
+def serialised(method):
+  """
+  Decorator executing a controller operation atomically on the worker thread of the object, when a worker is running.
+  The object provides the worker, or None, with a __worker__ method.
+  """
+  @functools.wraps(method)
+  def wrapper(self, *args, **kwargs):
+    worker = self.__worker__()
+    if worker is None or worker.current(): return method(self, *args, **kwargs)
+    return worker.submit(method, self, *args, **kwargs).result()
+  return wrapper
+
+# -fin-
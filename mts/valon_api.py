@@ -4,6 +4,7 @@ from optparse import OptionParser
 import inspect, signal, string
 import valon_synth
 from valon_synth import Synthesizer
+from mts_link import set_low_latency
 
 ## API to NRAO valon 5007 library
 
@@ -35,6 +36,8 @@ class MTSvalon(Synthesizer):
       raise RuntimeError("Unable to open serial port.\nError MSG:\n%s"%err)
     except:
       raise
+    # the Valon baudrate is fixed by valon_synth, only the latency can be reduced
+    set_low_latency(self.conn)
 
     # Add usage instructions for parent call functions
     self.get_vco_range.__func__.__doc__ = "\
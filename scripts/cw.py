@@ -12,13 +12,13 @@ if __name__ == '__main__':
   parser.add_option('-p', '--port',
                     action='store',
                     dest='tty',
-                    default='/dev/ttyUSB1',
-                    help='Set serial port, default is \'%default\'.')
+                    default='auto',
+                    help='Set serial port, default is \'%default\' to find the port by USB id.')
   parser.add_option('-v', '--valon',
                     action='store',
                     dest='cwtty',
-                    default='/dev/ttyUSB0',
-                    help='Set serial port, default is \'%default\'.')
+                    default='auto',
+                    help='Set serial port, default is \'%default\' to find the port by USB id.')
   parser.add_option('-b', '--baud',
                     action='store',
                     dest='baudrate',
@@ -133,13 +133,13 @@ if __name__ == '__main__':
   parser.add_option('-p', '--port',
                     action='store',
                     dest='tty',
-                    default='/dev/ttyUSB1',
-                    help='Set serial port, default is \'%default\'.')
+                    default='auto',
+                    help='Set serial port, default is \'%default\' to find the port by USB id.')
   parser.add_option('-v', '--valon',
                     action='store',
                     dest='cwtty',
-                    default='/dev/ttyUSB0',
-                    help='Set serial port, default is \'%default\'.')
+                    default='auto',
+                    help='Set serial port, default is \'%default\' to find the port by USB id.')
   parser.add_option('-b', '--baud',
                     action='store',
                     dest='baudrate',
@@ -170,6 +170,12 @@ if __name__ == '__main__':
                     dest='tofile',
                     default=None,
                     help='Save calibration measurements to CSV file, default is \'%default\'.')
+  parser.add_option('--retries',
+                    action='store',
+                    dest='retries',
+                    default=10,
+                    type=int,
+                    help='Number of times a controller transaction is repeated after a serial link error, default is \'%default\'.')
   (opts, args) = parser.parse_args()
 
 
@@ -197,7 +203,7 @@ if __name__ == '__main__':
 ##Connection to MTS for calibration
   print 'Initiating all controller modules...'
   start=time.time()
-  mts = MTS(port=opts.tty, baudrate=int(opts.baudrate), valon=opts.cwtty, config_file=opts.config_file)
+  mts = MTS(port=opts.tty, baudrate=int(opts.baudrate), valon=opts.cwtty, config_file=opts.config_file, retries=opts.retries)
   print 'Initiation takes %.4f seconds' %(time.time()-start)
 
 # Use mts parameters to set up default FSU environment for calibration
@@ -278,6 +284,7 @@ if __name__ == '__main__':
           fout.write('%f, %f, %f, %f\n' % (freq, cw_calib['atten'][line], cw_calib['amp'][line], cw_calib['volt'][line]))
         fout.close()
 
+  print mts.ctrl.stats.report()
   print 'Closing all ports...'
   start=time.time()
   try:
@@ -0,0 +1,62 @@
+#!/usr/bin/python
+
+from optparse import OptionParser
+from mts.mts import MTS
+from mts.mts_daemon import MTSDaemon, SOCKET
+import signal, time
+
+##Long running MTS daemon: initiate the MTS once and serve MTS operations to clients on a Unix domain socket
+# Clients use mts.mts_daemon.MTSClient, or from the command line
+#   python -m mts.mts_daemon set_noise comb1 uncorr_pwr=-27
+
+if __name__ == '__main__':
+
+  parser = OptionParser(version="%prog 0.1")
+  parser.add_option('-p', '--port',
+                    action='store',
+                    dest='tty',
+                    default='auto',
+                    help='Set serial port, default is \'%default\' to find the port by USB id.')
+  parser.add_option('-v', '--valon',
+                    action='store',
+                    dest='cwtty',
+                    default='auto',
+                    help='Set serial port, default is \'%default\' to find the port by USB id.')
+  parser.add_option('-b', '--baud',
+                    action='store',
+                    dest='baudrate',
+                    default=None,
+                    help='Set serial port baudrate, default is the baudrate remembered for the port or 115200.')
+  parser.add_option('-c', '--config',
+                    action='store',
+                    dest='config_file',
+                    default='/etc/mts/mts_default',
+                    help='MTS config file, default is \'%default\'.')
+  parser.add_option('-s', '--socket',
+                    action='store',
+                    dest='socket',
+                    default=SOCKET,
+                    help='Unix domain socket to serve clients on, default is \'%default\'.')
+  (opts, args) = parser.parse_args()
+
+  print 'Initiating all controller modules...'
+  start=time.time()
+  mts_obj = MTS(port=opts.tty, baudrate=opts.baudrate and int(opts.baudrate), valon=opts.cwtty, config_file=opts.config_file, threaded=True)
+  print 'Initiation takes %.4f seconds' %(time.time()-start)
+
+  server = MTSDaemon(mts_obj, path=opts.socket)
+  # terminate cleanly on kill
+  def terminate(signum, frame):
+    raise KeyboardInterrupt
+  signal.signal(signal.SIGTERM, terminate)
+  print 'Serving MTS operations on %s' % opts.socket
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    server.server_close()
+    print 'Exit test controller...'
+    mts_obj.exit()
+
+# -fin-
@@ -14,13 +14,13 @@ if __name__ == '__main__':
   parser.add_option('-p', '--port',
                     action='store',
                     dest='tty',
-                    default='/dev/ttyUSB1',
-                    help='Set serial port, default is \'%default\'.')
+                    default='auto',
+                    help='Set serial port, default is \'%default\' to find the port by USB id.')
   parser.add_option('-v', '--valon',
                     action='store',
                     dest='cwtty',
-                    default='/dev/ttyUSB0',
-                    help='Set serial port, default is \'%default\'.')
+                    default='auto',
+                    help='Set serial port, default is \'%default\' to find the port by USB id.')
   parser.add_option('-b', '--baud',
                     action='store',
                     dest='baudrate',
@@ -47,6 +47,12 @@ if __name__ == '__main__':
   print '\nConnect output from %s to spectrum analyser' % opts.combiner
   print 'Available frequency range from %f MHz to %f MHz' % (mts_obj.MIN_BASE, mts_obj.MAX_BASE)
 
+  # output power of a single burst acquisition of 100 sensor readings
+  def burst_pwr(cal_tbl):
+    comb = mts_obj.select_combiner(opts.combiner)
+    [pwr, temp] = comb.get_environment(samples=100)
+    return numpy.array([mts_obj.__get_pwr__(comb=comb, cal_tbl=cal_tbl, sensor=sensor) for sensor in pwr['samples']])
+
   [pwr_mv_per_dbm, temp_mv_per_deg] = mts_obj.select_combiner(opts.combiner).get_environment()
   output_pwr = mts_obj.__get_pwr__(comb=mts_obj.select_combiner(opts.combiner)) # dBm
   print "Amplitude sensor reading of %f mV/dBm translates to %f dBm power" %(pwr_mv_per_dbm, output_pwr)
@@ -58,10 +64,7 @@ if __name__ == '__main__':
   print 'Requested power = %f dBm' % input_pwr
   print 'Output noise signal with power %f dBm' % (mts_obj.get_noise(output=opts.combiner))
 
-  measurements = []
-  for count in range(100):
-    measurements.append(mts_obj.get_noise(output=opts.combiner))
-  measurements = numpy.array(measurements)
+  measurements = burst_pwr(cal_tbl=mts_obj.UCS_NOISE)
   e = abs(measurements - input_pwr)
   pylab.figure()
   pylab.errorbar(range(100), measurements, yerr=e, fmt='ro')
@@ -80,10 +83,7 @@ if __name__ == '__main__':
   print 'Requested power = %f dBm' % input_pwr
   print 'Output noise signal with power %f dBm' % (mts_obj.get_noise(output=opts.combiner, cal_tbl=mts_obj.CS_NOISE))
 
-  measurements = []
-  for count in range(100):
-    measurements.append(mts_obj.get_noise(output=opts.combiner, cal_tbl=mts_obj.CS_NOISE))
-  measurements = numpy.array(measurements)
+  measurements = burst_pwr(cal_tbl=mts_obj.CS_NOISE)
   e = abs(measurements - input_pwr)
   pylab.figure()
   pylab.errorbar(range(100), measurements, yerr=e, fmt='ro')
@@ -104,10 +104,7 @@ if __name__ == '__main__':
   print 'Requested frequency = 220 MHz'
   print 'Output CW signal frequency = %f MHz' % (mts_obj.get_freq(output=opts.combiner, uncorr_src=True))
 
-  measurements = []
-  for count in range(100):
-    measurements.append(mts_obj.get_cw(output=opts.combiner))
-  measurements = numpy.array(measurements)
+  measurements = burst_pwr(cal_tbl=mts_obj.UCS_CW)
   e = abs(measurements - input_pwr)
   pylab.figure()
   pylab.errorbar(range(100), measurements, yerr=e, fmt='ro')
@@ -128,10 +125,7 @@ if __name__ == '__main__':
   print 'Requested frequency = 300 MHz'
   print 'Output CW signal frequency = %f MHz' % (mts_obj.get_freq(output=opts.combiner, corr_src=True))
 
-  measurements = []
-  for count in range(100):
-    measurements.append(mts_obj.get_cw(output=opts.combiner, cal_tbl=mts_obj.CS_CW))
-  measurements = numpy.array(measurements)
+  measurements = burst_pwr(cal_tbl=mts_obj.CS_CW)
   e = abs(measurements - input_pwr)
   pylab.figure()
   pylab.errorbar(range(100), measurements, yerr=e, fmt='ro')
@@ -8,10 +8,10 @@ setup(name = 'mts',
       description = 'Interfaces to KAT-7 Correlator Test System',
       license = 'GPL',
       author = 'Ruby van Rooyen',
-      requires=['valon_synth', 'serial', 'iniparse', 'inspect', 'signal', 'optparse', 'numpy'],
+      requires=['valon_synth', 'serial', 'iniparse', 'inspect', 'signal', 'optparse', 'numpy', 'trollius'],
       provides=['mts'],
       package_dir = {'mts':'mts'},
       packages = ['mts'],
       scripts=glob.glob('scripts/*'),
-      data_files=[('/etc/mts',['etc/mts_default', 'etc/cw_calib_table.data', 'etc/noise_calib_table.data'])]
+      data_files=[('/etc/mts',['etc/mts_default', 'etc/mts_register_map', 'etc/cw_calib_table.data', 'etc/noise_calib_table.data'])]
 )
@@ -0,0 +1,85 @@
+#!/usr/bin/python
+
+from optparse import OptionParser
+from mts.mts_emulator import MTSEmulator
+from mts.mts import MTS
+import time
+
+## Measure MTS initiation time, attenuator sweep and detector read rates against the emulated controller
+
+def bench(port, opts, **kwargs):
+  start=time.time()
+  mts_obj = MTS(port=port, valon=None, config_file=opts.config_file, calib_dir=opts.calib_dir, **kwargs)
+  print '\tinitiation takes %.4f seconds' % (time.time()-start)
+
+  output = mts_obj.select_combiner(opts.combiner)
+  start=time.time()
+  for atten in range(64):
+    output.ucs.set_noise_atten(atten=atten/2.)
+  print '\tnoise attenuator sweep at %.1f steps/second' % (64/(time.time()-start))
+
+  start=time.time()
+  for count in range(opts.count):
+    output.get_environment()
+  print '\tdetector reads at %.1f readings/second' % (opts.count/(time.time()-start))
+
+  start=time.time()
+  mts_obj.set_noise(output=opts.combiner, uncorr_pwr=-27)
+  print '\tset noise takes %.4f seconds, output power %f dBm' % (time.time()-start, mts_obj.get_noise(output=opts.combiner))
+
+  start=time.time()
+  mts_obj.exit()
+  print '\texit takes %.4f seconds' % (time.time()-start)
+
+if __name__ == '__main__':
+
+  parser = OptionParser(version="%prog 0.1")
+  parser.add_option('-l', '--latency',
+                    action='store',
+                    dest='latency',
+                    default=0.001,
+                    type=float,
+                    help='Emulated controller response latency in seconds, default is \'%default\'.')
+  parser.add_option('-b', '--baud',
+                    action='store',
+                    dest='baudrate',
+                    default=115200,
+                    type=int,
+                    help='Emulated serial line baudrate, default is \'%default\'.')
+  parser.add_option('-c', '--config',
+                    action='store',
+                    dest='config_file',
+                    default='etc/mts_default',
+                    help='MTS config file, default is \'%default\'.')
+  parser.add_option('--calib',
+                    action='store',
+                    dest='calib_dir',
+                    default='etc',
+                    help='Directory containing calibration tables, default is \'%default\'.')
+  parser.add_option('-o', '--output',
+                    action='store',
+                    dest='combiner',
+                    default='comb1',
+                    help='Output signal from MTS config file, default is \'%default\'.')
+  parser.add_option('-n', '--count',
+                    action='store',
+                    dest='count',
+                    default=20,
+                    type=int,
+                    help='Number of detector readings, default is \'%default\'.')
+  (opts, args) = parser.parse_args()
+
+  for [label, kwargs] in [
+      ('Verify all writes', {}),
+      ('Verify final write of each sequence', {'verify':'final'}),
+      ('No verification with write-behind', {'verify':'off', 'write_behind':True}),
+    ]:
+    emulator = MTSEmulator(latency=opts.latency, baudrate=opts.baudrate, calib_dir=opts.calib_dir)
+    port = emulator.start()
+    print '\n%s' % label
+    bench(port, opts, **kwargs)
+    emulator.stop()
+    print '\t%d frames served by emulator' % emulator.frames
+
+# -fin-
+
@@ -0,0 +1,100 @@
+#!/usr/bin/python
+
+from optparse import OptionParser
+from mts.mts import MTS
+from mts.mts_emulator import MTSEmulator
+from mts.mts_regmap import max7301_ports
+
+## Check the MAX7301 port writes of the module components against the emulated controller
+
+# MAX7301 multiple port registers and the ports they cover, in data bit order, from the datasheet
+DATASHEET = {
+  0x40 : [4, 5, 6, 7], 0x41 : range(4, 9), 0x42 : range(4, 10), 0x43 : range(4, 11),
+  0x44 : range(4, 12), 0x58 : range(24, 32), 0x5c : [28, 29, 30, 31], 0x5f : [31],
+}
+
+class GPIOEmulator(MTSEmulator):
+  """Emulated controller logging the MAX7301 commands, and the MAX7301 commands and noise attenuator settings, of module 1"""
+  def __init__(self, *args, **kwargs):
+    MTSEmulator.__init__(self, *args, **kwargs)
+    self.cmds = []
+    self.events = []
+
+  def max7301(self, mod, cmd):
+    if mod == 1:
+      self.cmds.append(cmd)
+      self.events.append('%04x' % cmd)
+    MTSEmulator.max7301(self, mod, cmd)
+
+  def write(self, mod, reg, value):
+    atten = self.ns_atten[mod]
+    MTSEmulator.write(self, mod, reg, value)
+    if mod == 1 and self.ns_atten[mod] != atten: self.events.append('ns_atten')
+
+def test_ports():
+  """Multiple port registers cover the datasheet port ranges"""
+  for [reg, ports] in DATASHEET.items():
+    assert max7301_ports(reg) == ports, (hex(reg), max7301_ports(reg))
+
+def test_switch_order(port, emulator, opts):
+  """Switches blocking a path are written before, and switches opening a path after, the sources"""
+  mts_obj = MTS(port=port, valon=None, config_file=opts.config_file, calib_dir=opts.calib_dir, lazy=False)
+  try:
+    # output ports 8-11 are not used by any component and must not be written
+    ports = emulator.gpio[1]
+    ports[8:12] = [1]*4
+    del emulator.cmds[:]
+    mts_obj.ucs1.apply({'ns' : True, 'ns_switch' : False})
+    assert emulator.cmds[-1] == 0x2500, ['%04x' % cmd for cmd in emulator.cmds]
+    assert [ports[4], ports[5], ports[6], ports[31]] == [1, 0, 1, 1], ports
+    del emulator.cmds[:]
+    mts_obj.ucs1.apply({'ns' : False, 'ns_switch' : True})
+    assert emulator.cmds[0] == 0x2501, ['%04x' % cmd for cmd in emulator.cmds]
+    # ports 4 and 6 of the noise source are set with a single write of ports 4-7, port 7 is the lock input
+    assert 0x4002 in emulator.cmds, ['%04x' % cmd for cmd in emulator.cmds]
+    assert [ports[4], ports[5], ports[6], ports[31]] == [0, 1, 0, 0], ports
+    assert ports[8:12] == [1]*4, ports
+  finally:
+    mts_obj.exit()
+
+def test_block_first(port, emulator, opts):
+  """A path is blocked before attenuators change, also if the attenuator channel is already selected"""
+  mts_obj = MTS(port=port, valon=None, config_file=opts.config_file, calib_dir=opts.calib_dir, lazy=False)
+  try:
+    mts_obj.ucs1.apply({'ns_switch' : False})
+    # select the noise attenuator channel
+    mts_obj.ucs1.apply({'ns_atten' : 20})
+    del emulator.events[:]
+    mts_obj.ucs1.apply({'ns_switch' : True, 'ns_atten' : 10})
+    assert emulator.events == ['2501', 'ns_atten'], emulator.events
+  finally:
+    mts_obj.exit()
+
+if __name__ == '__main__':
+
+  parser = OptionParser(version="%prog 0.1")
+  parser.add_option('-c', '--config',
+                    action='store',
+                    dest='config_file',
+                    default='etc/mts_default',
+                    help='MTS config file, default is \'%default\'.')
+  parser.add_option('--calib',
+                    action='store',
+                    dest='calib_dir',
+                    default='etc',
+                    help='Directory containing calibration tables, default is \'%default\'.')
+  (opts, args) = parser.parse_args()
+
+  test_ports()
+  print 'test_ports passed'
+  emulator = GPIOEmulator(calib_dir=opts.calib_dir)
+  port = emulator.start()
+  try:
+    test_switch_order(port, emulator, opts)
+    print 'test_switch_order passed'
+    test_block_first(port, emulator, opts)
+    print 'test_block_first passed'
+  finally:
+    emulator.stop()
+
+# -fin-
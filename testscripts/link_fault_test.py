@@ -0,0 +1,85 @@
+#!/usr/bin/python
+
+from optparse import OptionParser
+from mts.mts_api import MTSAPI, DeviceError
+from mts.mts_aio import MTSAIO
+from mts.mts_emulator import MTSEmulator
+import trollius as asyncio
+from trollius import From
+
+## Exercise the controller link error handling against an emulated controller that loses responses
+
+class FaultyEmulator(MTSEmulator):
+  """Emulated controller dropping the response to the next drop_writes register writes"""
+  drop_writes = 0
+
+  def receive(self, data):
+    rtrn = MTSEmulator.receive(self, data)
+    if self.drop_writes and data and data[0] == self.CTRL_WRITE:
+      self.drop_writes -= 1
+      return rtrn[1:]
+    return rtrn
+
+def test_dropped_ack(port, emulator):
+  """A write-behind write that is never acknowledged is reported at the flush barrier"""
+  mts = MTSAPI(port=port, timeout=0.2, write_behind=True)
+  try:
+    emulator.drop_writes = 1
+    mts.write(mts.__get_address__(mod=1, reg=3), 0x20)
+    try:
+      mts.flush()
+    except DeviceError as de:
+      assert 'No acknowledgement received' in de.msg, de.msg
+    else:
+      raise AssertionError('Lost write-behind acknowledgement not reported')
+    assert mts.stats.resyncs == 1, mts.stats.resyncs
+    # the link is in sync again
+    assert mts.flush()
+    assert mts.ping()
+  finally:
+    mts.__close__()
+
+def test_aio_dropped_ack(port, emulator):
+  """A pipelined write that is never acknowledged is repeated after a resync"""
+  loop = asyncio.new_event_loop()
+  mts = MTSAIO(port=port, timeout=0.2, loop=loop)
+  try:
+    address = mts.__get_address__(mod=1, reg=3)
+    @asyncio.coroutine
+    def main():
+      yield From(mts.ping())
+      emulator.drop_writes = 1
+      # pipelined writes take the acknowledgement of the next write, the last one times out
+      batch = mts.batch()
+      for data in range(0x20, 0x24): batch.write(address, data)
+      results = yield From(batch.send())
+      assert results == [True]*4, results
+      assert (yield From(mts.resync()))
+      assert (yield From(mts.read(address))) == 0x23
+    loop.run_until_complete(main())
+    assert mts.stats.resyncs == 2, mts.stats.resyncs
+    assert mts.stats.retries >= 1, mts.stats.retries
+  finally:
+    mts.__close__()
+    loop.close()
+
+if __name__ == '__main__':
+
+  parser = OptionParser(version="%prog 0.1")
+  parser.add_option('--calib',
+                    action='store',
+                    dest='calib_dir',
+                    default='etc',
+                    help='Directory containing calibration tables, default is \'%default\'.')
+  (opts, args) = parser.parse_args()
+
+  for test in [test_dropped_ack, test_aio_dropped_ack]:
+    emulator = FaultyEmulator(calib_dir=opts.calib_dir)
+    port = emulator.start()
+    try:
+      test(port, emulator)
+      print '%s passed' % test.__name__
+    finally:
+      emulator.stop()
+
+# -fin-